@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# Runs programs/benchmarks/src/*.S (or the benchmarks given as
+# arguments) and compares their cycle counts with programs/benchmarks/baseline.json,
+# see python3 -m harness.bench --help for the options. The test.sh variables
+# (core=pipeline, bpred=1, ...) select the configuration, each has its own baseline.
+#
+#   ./bench.sh                      all benchmarks, fails on a regression over 1%
+#   ./bench.sh --threshold 5        allow 5% more cycles
+#   ./bench.sh --update             record the results as the new baseline
+
+cd "$(dirname "$0")"
+exec python3 -m harness.bench "$@"
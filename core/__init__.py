@@ -1,6 +1,17 @@
 from .alu import ALU
+from .amo import AMOUnit
 from .branch import Branch
+from .cache import DataCache
+from .compressed import Expander
 from .cpu import CPU
+from .csr import CSRUnit
 from .decoder import Decoder
-from .memory import Memory
-from .registers import Registers
\ No newline at end of file
+from .fetch import FetchBuffer
+from .fusion import Fusion
+from .iss import ISS, SimMemory
+from .memory import AddressDecoder, Memory, MemoryUnit, SparseMemory
+from .muldiv import MulDiv
+from .pipeline import PipelinedCPU
+from .predictor import BranchPredictor
+from .registers import Registers
+from .soc import SoC
\ No newline at end of file
@@ -0,0 +1,57 @@
+from nmigen import *
+from nmigen.sim import *
+
+
+class AmoFunc:
+    ADD  = 0b00000
+    SWAP = 0b00001
+    LR   = 0b00010
+    SC   = 0b00011
+    XOR  = 0b00100
+    OR   = 0b01000
+    AND  = 0b01100
+    MIN  = 0b10000
+    MAX  = 0b10100
+    MINU = 0b11000
+    MAXU = 0b11100
+
+
+class AMOUnit(Elaboratable):
+    """RV32A read-modify-write, funct is the instruction's funct5.
+
+    rd_val is what the AMO writes back to memory given the word it read (mem_val) and
+    rs2_val.
+    """
+
+    def __init__(self):
+        self.funct = Signal(5)
+        self.mem_val = Signal(32)
+        self.rs2_val = Signal(32)
+        self.rd_val = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        a = self.mem_val
+        b = self.rs2_val
+        with m.Switch(self.funct):
+            with m.Case(AmoFunc.ADD):
+                m.d.comb += self.rd_val.eq(a + b)
+            with m.Case(AmoFunc.SWAP):
+                m.d.comb += self.rd_val.eq(b)
+            with m.Case(AmoFunc.XOR):
+                m.d.comb += self.rd_val.eq(a ^ b)
+            with m.Case(AmoFunc.OR):
+                m.d.comb += self.rd_val.eq(a | b)
+            with m.Case(AmoFunc.AND):
+                m.d.comb += self.rd_val.eq(a & b)
+            with m.Case(AmoFunc.MIN):
+                m.d.comb += self.rd_val.eq(Mux(a.as_signed() < b.as_signed(), a, b))
+            with m.Case(AmoFunc.MAX):
+                m.d.comb += self.rd_val.eq(Mux(a.as_signed() < b.as_signed(), b, a))
+            with m.Case(AmoFunc.MINU):
+                m.d.comb += self.rd_val.eq(Mux(a < b, a, b))
+            with m.Case(AmoFunc.MAXU):
+                m.d.comb += self.rd_val.eq(Mux(a < b, b, a))
+
+        return m
@@ -0,0 +1,231 @@
+from math import log2
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc.wishbone.bus import CycleType, Interface, MemoryMap
+
+
+class Replacement:
+    LRU    = 'lru'
+    RANDOM = 'random'
+
+
+class DataCache(Elaboratable):
+    def __init__(self, sets=16, ways=2, line_words=4, replacement=Replacement.LRU):
+        assert sets & (sets - 1) == 0
+        assert ways & (ways - 1) == 0
+        assert line_words & (line_words - 1) == 0
+        assert replacement in (Replacement.LRU, Replacement.RANDOM)
+        self.sets = sets
+        self.ways = ways
+        self.line_words = line_words
+        self.replacement = replacement
+
+        self.word_bits = int(log2(line_words))
+        self.index_bits = int(log2(sets))
+        self.tag_bits = 32 - 2 - self.word_bits - self.index_bits
+        self.age_bits = max(1, int(log2(ways)))
+
+        # valid | dirty | tag
+        self.tags = [Memory(width=self.tag_bits + 2, depth=sets) for _ in range(ways)]
+        self.data = [Memory(width=32, depth=sets * line_words) for _ in range(ways)]
+        self.ages = Memory(width=self.age_bits * ways, depth=sets,
+                           init=[self._initial_ages()] * sets)
+
+        # CPU side
+        self.bus = Interface(addr_width=32, data_width=32)
+        self.bus.memory_map = MemoryMap(addr_width=32, data_width=32, alignment=0)
+        # memory side, connected by the CPU to the backing MemoryUnit
+        self.mem_bus = None
+
+        self.hits = Signal(32)
+        self.misses = Signal(32)
+        self.writebacks = Signal(32)
+
+    def _initial_ages(self):
+        return sum(way << (way * self.age_bits) for way in range(self.ways))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        mem = self.mem_bus
+        n = self.line_words
+
+        tag_rd = []
+        tag_wr = []
+        data_rd = []
+        data_wr = []
+        for way in range(self.ways):
+            tag_rd.append(self.tags[way].read_port(domain="comb"))
+            tag_wr.append(self.tags[way].write_port())
+            data_rd.append(self.data[way].read_port(domain="comb"))
+            data_wr.append(self.data[way].write_port())
+            m.submodules[f"tag_rd{way}"] = tag_rd[way]
+            m.submodules[f"tag_wr{way}"] = tag_wr[way]
+            m.submodules[f"data_rd{way}"] = data_rd[way]
+            m.submodules[f"data_wr{way}"] = data_wr[way]
+        m.submodules.ages_rd = ages_rd = self.ages.read_port(domain="comb")
+        m.submodules.ages_wr = ages_wr = self.ages.write_port()
+
+        req_word = bus.adr[2:2 + self.word_bits]
+        req_index = bus.adr[2 + self.word_bits:2 + self.word_bits + self.index_bits]
+        req_tag = bus.adr[2 + self.word_bits + self.index_bits:]
+
+        # line being refilled or written back
+        line_index = Signal(self.index_bits)
+        line_tag = Signal(self.tag_bits)
+        victim_tag = Signal(self.tag_bits)
+        victim = Signal(range(self.ways))
+        issued = Signal(range(n + 1))
+        acked = Signal(range(n + 1))
+        refilled = Signal()
+
+        valid = Signal(self.ways)
+        dirty = Signal(self.ways)
+        tags = [Signal(self.tag_bits, name=f"tag{way}") for way in range(self.ways)]
+        hits = Signal(self.ways)
+        hit = Signal()
+        hit_way = Signal(range(self.ways))
+        for way in range(self.ways):
+            m.d.comb += [
+                Cat(tags[way], dirty[way], valid[way]).eq(tag_rd[way].data),
+                hits[way].eq(valid[way] & (tags[way] == req_tag)),
+            ]
+            with m.If(hits[way]):
+                m.d.comb += hit_way.eq(way)
+        m.d.comb += hit.eq(hits.any())
+
+        # replacement: prefer an invalid way, otherwise the oldest one
+        ages = Array(ages_rd.data[way * self.age_bits:(way + 1) * self.age_bits]
+                     for way in range(self.ways))
+        choice = Signal(range(self.ways))
+        if self.replacement == Replacement.LRU:
+            for way in reversed(range(self.ways)):
+                with m.If(ages[way] == self.ways - 1):
+                    m.d.comb += choice.eq(way)
+        else:
+            lfsr = Signal(16, reset=0xACE1)
+            m.d.sync += lfsr.eq(Cat(lfsr[1:], lfsr[0] ^ lfsr[2] ^ lfsr[3] ^ lfsr[5]))
+            m.d.comb += choice.eq(lfsr[:self.age_bits])
+        for way in reversed(range(self.ways)):
+            with m.If(~valid[way]):
+                m.d.comb += choice.eq(way)
+
+        touched = Signal(range(self.ways))
+        m.d.comb += [
+            ages_rd.addr.eq(req_index),
+            ages_wr.addr.eq(req_index),
+        ]
+        for way in range(self.ways):
+            age = ages_wr.data[way * self.age_bits:(way + 1) * self.age_bits]
+            m.d.comb += age.eq(Mux(way == touched, 0,
+                                   Mux(ages[way] < ages[touched], ages[way] + 1, ages[way])))
+
+        m.d.comb += mem.cyc.eq(0)
+        m.d.sync += bus.ack.eq(0)
+
+        # The memory side is driven as a pipelined master: one word is
+        # requested per cycle, as an incrementing burst, and each ack answers
+        # the oldest request. A stalled request is held until it is taken.
+        taken = Signal()
+        m.d.comb += taken.eq(mem.stb & ~getattr(mem, "stall", Const(0)))
+        if hasattr(mem, "cti"):
+            m.d.comb += mem.cti.eq(Mux(issued == n - 1, CycleType.END_OF_BURST,
+                                       CycleType.INCR_BURST))
+        with m.FSM():
+            with m.State('IDLE'):
+                for way in range(self.ways):
+                    m.d.comb += [
+                        tag_rd[way].addr.eq(req_index),
+                        data_rd[way].addr.eq(Cat(req_word, req_index)),
+                        data_wr[way].addr.eq(Cat(req_word, req_index)),
+                        data_wr[way].data.eq(bus.dat_w),
+                        tag_wr[way].addr.eq(req_index),
+                        tag_wr[way].data.eq(Cat(req_tag, 1, 1)),
+                    ]
+                with m.If(bus.cyc & bus.stb):
+                    with m.If(hit):
+                        m.d.sync += [
+                            bus.ack.eq(1),
+                            bus.dat_r.eq(Array(port.data for port in data_rd)[hit_way]),
+                            refilled.eq(0),
+                        ]
+                        with m.If(~refilled):
+                            m.d.sync += self.hits.eq(self.hits + 1)
+                        m.d.comb += [
+                            touched.eq(hit_way),
+                            ages_wr.en.eq(self.replacement == Replacement.LRU),
+                        ]
+                        with m.If(bus.we):
+                            with m.Switch(hit_way):
+                                for way in range(self.ways):
+                                    with m.Case(way):
+                                        m.d.comb += [
+                                            data_wr[way].en.eq(1),
+                                            tag_wr[way].en.eq(1),
+                                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            self.misses.eq(self.misses + 1),
+                            line_index.eq(req_index),
+                            line_tag.eq(req_tag),
+                            victim.eq(choice),
+                            victim_tag.eq(Array(tags)[choice]),
+                            issued.eq(0),
+                            acked.eq(0),
+                        ]
+                        with m.If((valid & dirty).bit_select(choice, 1)):
+                            m.d.sync += self.writebacks.eq(self.writebacks + 1)
+                            m.next = 'WRITEBACK'
+                        with m.Else():
+                            m.next = 'REFILL'
+
+            with m.State('WRITEBACK'):
+                m.d.comb += [
+                    mem.cyc.eq(1),
+                    mem.stb.eq(issued != n),
+                    mem.we.eq(issued != n),
+                    mem.adr.eq(Cat(Const(0, 2), issued[:self.word_bits], line_index, victim_tag)),
+                    mem.dat_w.eq(Array(port.data for port in data_rd)[victim]),
+                ]
+                for way in range(self.ways):
+                    m.d.comb += data_rd[way].addr.eq(Cat(issued[:self.word_bits], line_index))
+                with m.If(taken):
+                    m.d.sync += issued.eq(issued + 1)
+                with m.If(mem.ack):
+                    m.d.sync += acked.eq(acked + 1)
+                    with m.If(acked == n - 1):
+                        m.d.sync += [
+                            issued.eq(0),
+                            acked.eq(0),
+                        ]
+                        m.next = 'REFILL'
+
+            with m.State('REFILL'):
+                m.d.comb += [
+                    mem.cyc.eq(1),
+                    mem.stb.eq(issued != n),
+                    mem.adr.eq(Cat(Const(0, 2), issued[:self.word_bits], line_index, line_tag)),
+                ]
+                with m.If(taken):
+                    m.d.sync += issued.eq(issued + 1)
+                for way in range(self.ways):
+                    m.d.comb += [
+                        data_wr[way].addr.eq(Cat(acked[:self.word_bits], line_index)),
+                        data_wr[way].data.eq(mem.dat_r),
+                        tag_wr[way].addr.eq(line_index),
+                        tag_wr[way].data.eq(Cat(line_tag, 0, 1)),
+                    ]
+                with m.If(mem.ack):
+                    m.d.sync += acked.eq(acked + 1)
+                    with m.Switch(victim):
+                        for way in range(self.ways):
+                            with m.Case(way):
+                                m.d.comb += data_wr[way].en.eq(1)
+                                with m.If(acked == n - 1):
+                                    m.d.comb += tag_wr[way].en.eq(1)
+                    with m.If(acked == n - 1):
+                        m.d.sync += refilled.eq(1)
+                        m.next = 'IDLE'
+
+        return m
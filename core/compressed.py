@@ -0,0 +1,250 @@
+from nmigen import *
+from nmigen.sim import *
+from core.decoder import Opcode
+
+
+OPCODE_C0 = 0b00
+OPCODE_C1 = 0b01
+OPCODE_C2 = 0b10
+
+
+def is_compressed(half):
+    # the two low bits of a 32-bit instruction are 11
+    return half & 0b11 != 0b11
+
+
+def _bits(value, hi, lo):
+    return (value >> lo) & ((1 << (hi - lo + 1)) - 1)
+
+
+def _sext(value, bits):
+    sign = 1 << (bits - 1)
+    return (value & (sign - 1)) - (value & sign)
+
+
+def _r(opcode, rd, funct3, rs1, rs2, funct7=0):
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 | funct7 << 25
+
+
+def _i(opcode, rd, funct3, rs1, imm):
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | (imm & 0xfff) << 20
+
+
+def _s(opcode, funct3, rs1, rs2, imm):
+    return (opcode | (imm & 0x1f) << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 |
+            _bits(imm, 11, 5) << 25)
+
+
+def _b(opcode, funct3, rs1, rs2, imm):
+    return (opcode | _bits(imm, 11, 11) << 7 | _bits(imm, 4, 1) << 8 | funct3 << 12 |
+            rs1 << 15 | rs2 << 20 | _bits(imm, 10, 5) << 25 | _bits(imm, 12, 12) << 31)
+
+
+def _j(opcode, rd, imm):
+    return (opcode | rd << 7 | _bits(imm, 19, 12) << 12 | _bits(imm, 11, 11) << 20 |
+            _bits(imm, 10, 1) << 21 | _bits(imm, 20, 20) << 31)
+
+
+def expand(half):
+    """The 32-bit instruction a compressed one stands for, None if it is illegal in RV32C
+    without the floating-point loads and stores."""
+    op = half & 0b11
+    funct3 = _bits(half, 15, 13)
+    rd = _bits(half, 11, 7)
+    rs2 = _bits(half, 6, 2)
+    rd_ = 8 + _bits(half, 4, 2)
+    rs1_ = 8 + _bits(half, 9, 7)
+    imm6 = _sext(_bits(half, 12, 12) << 5 | rs2, 6)
+    jimm = _sext(_bits(half, 12, 12) << 11 | _bits(half, 11, 11) << 4 |
+                 _bits(half, 10, 9) << 8 | _bits(half, 8, 8) << 10 | _bits(half, 7, 7) << 6 |
+                 _bits(half, 6, 6) << 7 | _bits(half, 5, 3) << 1 | _bits(half, 2, 2) << 5, 12)
+    bimm = _sext(_bits(half, 12, 12) << 8 | _bits(half, 11, 10) << 3 |
+                 _bits(half, 6, 5) << 6 | _bits(half, 4, 3) << 1 | _bits(half, 2, 2) << 5, 9)
+    wimm = _bits(half, 12, 10) << 3 | _bits(half, 6, 6) << 2 | _bits(half, 5, 5) << 6
+
+    if op == OPCODE_C0:
+        if funct3 == 0b000:
+            # c.addi4spn
+            imm = (_bits(half, 12, 11) << 4 | _bits(half, 10, 7) << 6 |
+                   _bits(half, 6, 6) << 2 | _bits(half, 5, 5) << 3)
+            return _i(Opcode.IMM, rd_, 0b000, 2, imm) if imm else None
+        if funct3 == 0b010:
+            return _i(Opcode.LOAD, rd_, 0b010, rs1_, wimm)
+        if funct3 == 0b110:
+            return _s(Opcode.STORE, 0b010, rs1_, rd_, wimm)
+        return None
+
+    if op == OPCODE_C1:
+        if funct3 == 0b000:
+            return _i(Opcode.IMM, rd, 0b000, rd, imm6)
+        if funct3 in (0b001, 0b101):
+            # c.jal, c.j
+            return _j(Opcode.JAL, 1 if funct3 == 0b001 else 0, jimm)
+        if funct3 == 0b010:
+            return _i(Opcode.IMM, rd, 0b000, 0, imm6)
+        if funct3 == 0b011:
+            if rd == 2:
+                # c.addi16sp
+                imm = _sext(_bits(half, 12, 12) << 9 | _bits(half, 6, 6) << 4 |
+                            _bits(half, 5, 5) << 6 | _bits(half, 4, 3) << 7 |
+                            _bits(half, 2, 2) << 5, 10)
+                return _i(Opcode.IMM, 2, 0b000, 2, imm) if imm else None
+            return Opcode.LUI | rd << 7 | (imm6 << 12) & 0xffff_f000 if imm6 else None
+        if funct3 == 0b100:
+            funct2 = _bits(half, 11, 10)
+            if funct2 in (0b00, 0b01):
+                # c.srli, c.srai; shamt[5] must be zero on RV32
+                if half >> 12 & 1:
+                    return None
+                return _r(Opcode.IMM, rs1_, 0b101, rs1_, rs2, funct2 << 5)
+            if funct2 == 0b10:
+                return _i(Opcode.IMM, rs1_, 0b111, rs1_, imm6)
+            if half >> 12 & 1:
+                return None
+            # c.sub, c.xor, c.or, c.and
+            funct3, funct7 = [(0b000, 0b0100000), (0b100, 0), (0b110, 0),
+                              (0b111, 0)][_bits(half, 6, 5)]
+            return _r(Opcode.REG, rs1_, funct3, rs1_, rd_, funct7)
+        # c.beqz, c.bnez
+        return _b(Opcode.BRANCH, funct3 & 1, rs1_, 0, bimm)
+
+    if op == OPCODE_C2:
+        if funct3 == 0b000:
+            return None if half >> 12 & 1 else _r(Opcode.IMM, rd, 0b001, rd, rs2)
+        if funct3 == 0b010:
+            imm = _bits(half, 12, 12) << 5 | _bits(half, 6, 4) << 2 | _bits(half, 3, 2) << 6
+            return _i(Opcode.LOAD, rd, 0b010, 2, imm) if rd else None
+        if funct3 == 0b100:
+            if not half >> 12 & 1:
+                if rs2:
+                    return _r(Opcode.REG, rd, 0b000, 0, rs2)
+                return _i(Opcode.JALR, 0, 0b000, rd, 0) if rd else None
+            if rs2:
+                return _r(Opcode.REG, rd, 0b000, rd, rs2)
+            if rd:
+                return _i(Opcode.JALR, 1, 0b000, rd, 0)
+            # c.ebreak
+            return _i(Opcode.SYSTEM, 0, 0b000, 0, 1)
+        if funct3 == 0b110:
+            imm = _bits(half, 12, 9) << 2 | _bits(half, 8, 7) << 6
+            return _s(Opcode.STORE, 0b010, 2, rs2, imm)
+        return None
+
+    return None
+
+
+class Expander(Elaboratable):
+    """Combinational RV32C expander, see expand(). Illegal encodings give zero."""
+
+    def __init__(self):
+        self.half = Signal(16)
+        self.inst = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        h = self.half
+        rd = h[7:12]
+        rs2 = h[2:7]
+        rd_ = Cat(h[2:5], C(0b01, 2))
+        rs1_ = Cat(h[7:10], C(0b01, 2))
+        x0 = C(0, 5)
+        x1 = C(1, 5)
+        x2 = C(2, 5)
+
+        # immediates, sign-extended to the width of their 32-bit field
+        imm6 = Cat(h[2:7], Repl(h[12], 7))
+        jimm = Cat(C(0, 1), h[3:6], h[11], h[2], h[7], h[6], h[9:11], h[8], h[12],
+                   Repl(h[12], 9))
+        bimm = Cat(C(0, 1), h[3:5], h[10:12], h[2], h[5:7], h[12], Repl(h[12], 4))
+        wimm = Cat(C(0, 2), h[6], h[10:13], h[5], C(0, 5))
+        spn_imm = Cat(C(0, 2), h[6], h[5], h[11:13], h[7:11], C(0, 2))
+        sp16_imm = Cat(C(0, 4), h[6], h[2], h[5], h[3:5], h[12], Repl(h[12], 2))
+        lwsp_imm = Cat(C(0, 2), h[4:7], h[12], h[2:4], C(0, 4))
+        swsp_imm = Cat(C(0, 2), h[9:13], h[7:9], C(0, 4))
+
+        def r(opcode, rd, funct3, rs1, rs2, funct7=0):
+            return Cat(C(opcode, 7), rd, C(funct3, 3), rs1, rs2, C(funct7, 7))
+
+        def i(opcode, rd, funct3, rs1, imm):
+            return Cat(C(opcode, 7), rd, C(funct3, 3), rs1, imm[:12])
+
+        def s(opcode, funct3, rs1, rs2, imm):
+            return Cat(C(opcode, 7), imm[:5], C(funct3, 3), rs1, rs2, imm[5:12])
+
+        def b(opcode, funct3, rs1, rs2, imm):
+            return Cat(C(opcode, 7), imm[11], imm[1:5], funct3, rs1, rs2, imm[5:11], imm[12])
+
+        def j(opcode, rd, imm):
+            return Cat(C(opcode, 7), rd, imm[12:20], imm[11], imm[1:11], imm[20])
+
+        inst = self.inst
+        with m.Switch(Cat(h[:2], h[13:16])):
+            with m.Case(OPCODE_C0 | 0b000 << 2):
+                with m.If(spn_imm != 0):
+                    m.d.comb += inst.eq(i(Opcode.IMM, rd_, 0b000, x2, spn_imm))
+            with m.Case(OPCODE_C0 | 0b010 << 2):
+                m.d.comb += inst.eq(i(Opcode.LOAD, rd_, 0b010, rs1_, wimm))
+            with m.Case(OPCODE_C0 | 0b110 << 2):
+                m.d.comb += inst.eq(s(Opcode.STORE, 0b010, rs1_, rd_, wimm))
+
+            with m.Case(OPCODE_C1 | 0b000 << 2):
+                m.d.comb += inst.eq(i(Opcode.IMM, rd, 0b000, rd, imm6))
+            with m.Case(OPCODE_C1 | 0b001 << 2):
+                m.d.comb += inst.eq(j(Opcode.JAL, x1, jimm))
+            with m.Case(OPCODE_C1 | 0b010 << 2):
+                m.d.comb += inst.eq(i(Opcode.IMM, rd, 0b000, x0, imm6))
+            with m.Case(OPCODE_C1 | 0b011 << 2):
+                with m.If(rd == 2):
+                    with m.If(sp16_imm != 0):
+                        m.d.comb += inst.eq(i(Opcode.IMM, x2, 0b000, x2, sp16_imm))
+                with m.Elif(imm6 != 0):
+                    m.d.comb += inst.eq(Cat(C(Opcode.LUI, 7), rd, h[2:7], Repl(h[12], 15)))
+            with m.Case(OPCODE_C1 | 0b100 << 2):
+                with m.Switch(h[10:12]):
+                    with m.Case(0b00, 0b01):
+                        with m.If(~h[12]):
+                            m.d.comb += inst.eq(Cat(C(Opcode.IMM, 7), rs1_, C(0b101, 3), rs1_,
+                                                    rs2, C(0, 5), h[10], C(0, 1)))
+                    with m.Case(0b10):
+                        m.d.comb += inst.eq(i(Opcode.IMM, rs1_, 0b111, rs1_, imm6))
+                    with m.Case(0b11):
+                        with m.If(~h[12]):
+                            with m.Switch(h[5:7]):
+                                with m.Case(0b00):
+                                    m.d.comb += inst.eq(r(Opcode.REG, rs1_, 0b000, rs1_, rd_,
+                                                          0b0100000))
+                                with m.Case(0b01):
+                                    m.d.comb += inst.eq(r(Opcode.REG, rs1_, 0b100, rs1_, rd_))
+                                with m.Case(0b10):
+                                    m.d.comb += inst.eq(r(Opcode.REG, rs1_, 0b110, rs1_, rd_))
+                                with m.Case(0b11):
+                                    m.d.comb += inst.eq(r(Opcode.REG, rs1_, 0b111, rs1_, rd_))
+            with m.Case(OPCODE_C1 | 0b101 << 2):
+                m.d.comb += inst.eq(j(Opcode.JAL, x0, jimm))
+            with m.Case(OPCODE_C1 | 0b110 << 2, OPCODE_C1 | 0b111 << 2):
+                m.d.comb += inst.eq(b(Opcode.BRANCH, Cat(h[13], C(0, 2)), rs1_, x0, bimm))
+
+            with m.Case(OPCODE_C2 | 0b000 << 2):
+                with m.If(~h[12]):
+                    m.d.comb += inst.eq(r(Opcode.IMM, rd, 0b001, rd, rs2))
+            with m.Case(OPCODE_C2 | 0b010 << 2):
+                with m.If(rd != 0):
+                    m.d.comb += inst.eq(i(Opcode.LOAD, rd, 0b010, x2, lwsp_imm))
+            with m.Case(OPCODE_C2 | 0b100 << 2):
+                with m.If(~h[12]):
+                    with m.If(rs2 != 0):
+                        m.d.comb += inst.eq(r(Opcode.REG, rd, 0b000, x0, rs2))
+                    with m.Elif(rd != 0):
+                        m.d.comb += inst.eq(i(Opcode.JALR, x0, 0b000, rd, C(0, 12)))
+                with m.Else():
+                    with m.If(rs2 != 0):
+                        m.d.comb += inst.eq(r(Opcode.REG, rd, 0b000, rd, rs2))
+                    with m.Elif(rd != 0):
+                        m.d.comb += inst.eq(i(Opcode.JALR, x1, 0b000, rd, C(0, 12)))
+                    with m.Else():
+                        m.d.comb += inst.eq(i(Opcode.SYSTEM, x0, 0b000, x0, C(1, 12)))
+            with m.Case(OPCODE_C2 | 0b110 << 2):
+                m.d.comb += inst.eq(s(Opcode.STORE, 0b010, x2, rs2, swsp_imm))
+
+        return m
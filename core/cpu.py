@@ -2,27 +2,83 @@ from nmigen import *
 from nmigen.hdl.rec import *
 from nmigen.sim import *
 from core.alu import ALU
+from core.amo import AMOUnit, AmoFunc
 from core.branch import Branch
-from core.decoder import Decoder, IType
+from core.compressed import Expander, is_compressed
+from core.csr import CSRUnit, HpmEvent
+from core.decoder import Decoder, IType, Opcode
+from core.fusion import Fusion, FusionKind, is_fusion_head
 from core.registers import Registers
-from core.memory import MemoryUnit
+from core.memory import AddressDecoder, MemoryUnit, SparseMemory
+from core.muldiv import MulDiv
 
 
 class CPU(Elaboratable):
-    def __init__(self, reset_address=0x0000_0000, data=[]):
+    def __init__(self, reset_address=0x0000_0000, data=[], dcache=None, ifetch=None,
+                 ram_words=256, ram=None, ram_base=0x0000_0000, mmio=(), rom_wait_states=0,
+                 muldiv=None, compressed=False, rom=None, hartid=0, fusion=False):
+        if compressed and fusion:
+            raise ValueError('fusion is not supported with compressed instructions')
         self.reset_address = reset_address
+        self.compressed = compressed
 
-        self.ram = MemoryUnit(256)
-        self.rom = MemoryUnit(len(data), data=data)
-        self.ibus = self.rom.new_bus()
-        self.dbus = self.ram.new_bus()
+        # a ram or rom passed in is elaborated by its owner, e.g. an SoC sharing it between
+        # harts; a SparseMemory that is not shared has this core as its only master
+        self.ram = ram if ram is not None else MemoryUnit(ram_words, pipelined=True)
+        self.ram_base = ram_base
+        self.rom = rom if rom is not None else \
+            MemoryUnit(len(data), data=data, pipelined=True, wait_states=rom_wait_states)
+        self.own_ram = ram is None or isinstance(ram, SparseMemory) and not ram.shared
+        self.own_rom = rom is None
+        self.ifetch = ifetch
+        if ifetch is not None:
+            ifetch.mem_bus = self.rom.new_bus()
+            self.ibus = ifetch.bus
+        else:
+            self.ibus = self.rom.new_bus()
+        # data side: the RAM (behind the cache if there is one) and (name, base, size, bus)
+        # MMIO regions
+        self.addr_decoder = AddressDecoder()
+        self.dcache = dcache
+        self.ram_bus = self.ram.new_bus()
+        if dcache is not None:
+            dcache.mem_bus = self.ram_bus
+            self.addr_decoder.add('ram', ram_base, self.ram.size, dcache.bus)
+        else:
+            self.addr_decoder.add('ram', ram_base, self.ram.size, self.ram_bus)
+        for name, base, size, bus in mmio:
+            self.addr_decoder.add(name, base, size, bus)
+        self.dbus = self.addr_decoder.bus
         self.pc = Signal(32, reset=reset_address)
+        # the pc of the next fetch, a simulation can write it after a reset to start elsewhere
+        self.fetch_pc = self.pc
         self.instruction = Signal(32)
         self.decoder = Decoder()
+        self.expander = Expander() if compressed else None
+        self.fusion = Fusion() if fusion else None
         self.regs = Registers()
         self.alu = ALU()
+        self.muldiv = muldiv if muldiv is not None else MulDiv()
+        self.amo = AMOUnit()
         self.branch = Branch()
+        self.csr = CSRUnit(hartid)
         self.valid = Signal(1, reset=0)
+        # strobed with valid when the commit retires a fused pair
+        self.fused = Signal()
+
+        # LR/SC: the word address reserved by lr.w. Stores of other harts are shown on
+        # snoop, the core's own acked writes on store
+        self.reservation = Signal(30)
+        self.reservation_valid = Signal()
+        self.store = Signal()
+        self.store_adr = Signal(32)
+        self.snoop = Signal()
+        self.snoop_adr = Signal(32)
+
+        # end of test: mtohost writes and ecall, strobed with valid
+        self.tohost = Signal(32)
+        self.tohost_we = Signal()
+        self.ecall = Signal()
 
     def elaborate(self, platform):
         m = Module()
@@ -30,25 +86,65 @@ class CPU(Elaboratable):
         m.submodules.decoder = decoder = self.decoder
         m.submodules.regs    = regs    = self.regs
         m.submodules.alu     = alu     = self.alu
+        m.submodules.muldiv  = muldiv  = self.muldiv
+        m.submodules.amo     = amo     = self.amo
         m.submodules.branch  = branch  = self.branch
-        m.submodules.ram = self.ram
-        m.submodules.rom = self.rom
+        m.submodules.csr     = csr     = self.csr
+        if self.own_ram:
+            m.submodules.ram = self.ram
+        if self.own_rom:
+            m.submodules.rom = self.rom
+        m.submodules.addr_decoder = self.addr_decoder
+        if self.dcache is not None:
+            m.submodules.dcache = self.dcache
+        if self.ifetch is not None:
+            m.submodules.ifetch = self.ifetch
+        if self.compressed:
+            m.submodules.expander = expander = self.expander
+        if self.fusion is not None:
+            m.submodules.fusion = fusion = self.fusion
 
         pc_next = Signal(32)
         pc_next_temp = Signal(32)
-        pc_4 = Signal(32)
+        pc_seq = Signal(32)
         inst = self.instruction
-        m.d.comb += pc_4.eq(self.pc + 4)
+        # the executing instruction was a 16-bit one
+        inst_c = Signal()
+        m.d.comb += pc_seq.eq(self.pc + Mux(inst_c, 2, 4))
         rs1_en = Signal()
         rs2_en = Signal()
 
         valid = self.valid
 
         m.d.comb += [
-            self.ibus.adr.eq(self.pc),
-            self.ibus.cyc.eq(1)
+            self.ibus.adr.eq(self.pc if not self.compressed else Cat(C(0, 2), self.pc[2:])),
         ]
 
+        # with compressed instructions the last word fetched is kept: the halfword at pc
+        # is taken from it, and a 32-bit instruction crossing into the next word takes a
+        # second fetch for its upper half. With fusion the word after a lui/auipc is
+        # fetched with it, and kept for the next fetch if the two do not fuse
+        word = Signal(32)
+        word_adr = Signal(30)
+        word_valid = Signal()
+        word_hit = Signal()
+        fetched = Signal(32)
+        lo_half = Signal(16)
+        if self.compressed:
+            m.d.comb += [
+                word_hit.eq(word_valid & (word_adr == self.pc[2:])),
+                fetched.eq(Mux(word_hit, word, self.ibus.dat_r)),
+                expander.half.eq(Mux(self.pc[1], fetched[16:], fetched[:16])),
+            ]
+        tail = Signal(32)
+        if self.fusion is not None:
+            m.d.comb += [
+                word_hit.eq(word_valid & (word_adr == self.pc[2:])),
+                fetched.eq(Mux(word_hit, word, self.ibus.dat_r)),
+                fusion.head.eq(inst),
+                fusion.tail.eq(tail),
+            ]
+
         m.d.comb += decoder.inst.eq(self.ibus.dat_r),
 
         m.d.comb += [
@@ -62,16 +158,41 @@ class CPU(Elaboratable):
             alu.rs2_val.eq(Mux(rs2_en, regs.rs2_data, decoder.imm)),
         ]
 
+        m.d.comb += [
+            muldiv.funct.eq(decoder.funct3),
+            muldiv.rs1_val.eq(regs.rs1_data),
+            muldiv.rs2_val.eq(regs.rs2_data),
+        ]
+
         m.d.comb += [
             branch.funct.eq(decoder.funct3),
             branch.src1.eq(regs.rs1_data),
             branch.src2.eq(regs.rs2_data),
         ]
 
+        # RV32A: amo_old holds the word an AMO read until its write is acked
+        lr = Signal()
+        sc = Signal()
+        rmw = Signal()
+        sc_fail = Signal()
+        amo_old = Signal(32)
+        m.d.comb += [
+            lr.eq(decoder.amo & (inst[27:32] == AmoFunc.LR)),
+            sc.eq(decoder.amo & (inst[27:32] == AmoFunc.SC)),
+            rmw.eq(decoder.amo & ~lr & ~sc),
+            sc_fail.eq(sc & ~(self.reservation_valid & (self.reservation == alu.rd_val[2:]))),
+            amo.funct.eq(inst[27:32]),
+            amo.mem_val.eq(amo_old),
+            amo.rs2_val.eq(regs.rs2_data),
+            self.store.eq(self.dbus.cyc & self.dbus.we & self.dbus.ack),
+            self.store_adr.eq(self.dbus.adr),
+        ]
+        with m.If(self.snoop & (self.snoop_adr[2:] == self.reservation)):
+            m.d.sync += self.reservation_valid.eq(0)
+
         m.d.comb += [
             self.dbus.adr.eq(Mux(decoder.mem_op_en, alu.rd_val, 0)),
-            self.dbus.dat_w.eq(Mux(decoder.mem_op_store, regs.rs2_data, self.dbus.dat_r)),
-            self.dbus.cyc.eq(1),
+            self.dbus.dat_w.eq(Mux(decoder.mem_op_store | sc, regs.rs2_data, self.dbus.dat_r)),
             pc_next.eq(pc_next_temp),
         ]
 
@@ -81,7 +202,7 @@ class CPU(Elaboratable):
                     alu.funct.eq(Cat(decoder.funct1, decoder.funct3)),
                     rs1_en.eq(decoder.rs1_en),
                     rs2_en.eq(decoder.rs2_en),
-                    pc_next_temp.eq(pc_4),
+                    pc_next_temp.eq(pc_seq),
                     regs.rd_data.eq(alu.rd_val),
                 ]
                 with m.If(decoder.mem_op_en):
@@ -94,48 +215,197 @@ class CPU(Elaboratable):
                     rs1_en.eq(0),
                     rs2_en.eq(0),
                     pc_next_temp.eq(alu.rd_val),
-                    regs.rd_data.eq(pc_4),
+                    regs.rd_data.eq(pc_seq),
                 ]
             with m.Case(IType.JR):
                 m.d.comb += [
                     rs1_en.eq(1),
                     rs2_en.eq(0),
-                    pc_next_temp.eq(alu.rd_val),
-                    regs.rd_data.eq(pc_4),
+                    # bit 0 of the target is cleared
+                    pc_next_temp.eq(Cat(C(0, 1), alu.rd_val[1:])),
+                    regs.rd_data.eq(pc_seq),
                 ]
             with m.Case(IType.BR):
                 m.d.comb += [
                     alu.funct.eq(0),
                     rs1_en.eq(0),
                     rs2_en.eq(0),
-                    pc_next_temp.eq(Mux(branch.res, alu.rd_val, pc_4)),
+                    pc_next_temp.eq(Mux(branch.res, alu.rd_val, pc_seq)),
                 ]
             with m.Case(IType.ST):
                 m.d.comb += [
                     alu.funct.eq(0),
                     rs1_en.eq(1),
                     rs2_en.eq(0),
-                    pc_next_temp.eq(pc_4)
+                    pc_next_temp.eq(pc_seq)
                 ]
             with m.Case(IType.LD):
                 m.d.comb += [
                     alu.funct.eq(0),
                     rs1_en.eq(1),
                     rs2_en.eq(0),
-                    pc_next_temp.eq(pc_4),
+                    pc_next_temp.eq(pc_seq),
+                ]
+            with m.Case(IType.CSR):
+                m.d.comb += [
+                    pc_next_temp.eq(pc_seq),
+                    regs.rd_data.eq(csr.rdata),
+                ]
+            with m.Case(IType.MULDIV):
+                m.d.comb += [
+                    pc_next_temp.eq(pc_seq),
+                    regs.rd_data.eq(muldiv.rd_val),
                 ]
 
+        fetch_stall = Signal()
+        mem_wait = Signal()
+        muldiv_wait = Signal()
+        m.d.comb += [
+            csr.commit.eq(valid & (decoder.itype == IType.CSR)),
+            csr.addr.eq(inst[20:32]),
+            csr.funct3.eq(decoder.funct3),
+            csr.rs1.eq(inst[15:20]),
+            csr.rs1_val.eq(regs.rs1_data),
+            csr.retire.eq(valid + (valid & self.fused)),
+            csr.events[HpmEvent.FETCH_STALL].eq(fetch_stall),
+            csr.events[HpmEvent.MEM_WAIT].eq(mem_wait),
+            csr.events[HpmEvent.MULDIV_WAIT].eq(muldiv_wait),
+            csr.events[HpmEvent.FUSED].eq(valid & self.fused),
+            csr.events[HpmEvent.BRANCH_TAKEN].eq(valid & (decoder.itype == IType.BR) &
+                                                 branch.res),
+            self.tohost.eq(csr.tohost),
+            self.tohost_we.eq(csr.tohost_we),
+            self.ecall.eq(valid & (inst[:7] == Opcode.SYSTEM) & (inst[7:32] == 0)),
+        ]
+
+        # the ROM would take a request still up in its ack cycle as the next one, the
+        # fetch buffer acks combinationally
+        fetch_stb = 1 if self.ifetch is not None else ~self.ibus.ack
+
         with m.FSM():
             with m.State('FETCH'):
-                m.d.comb += self.ibus.stb.eq(1)
-                with m.If(self.ibus.ack):
-                    m.next = 'EXECUTE'
-                    m.d.sync += inst.eq(self.ibus.dat_r)
-                    m.d.comb += decoder.inst.eq(self.ibus.dat_r)
+                m.d.comb += self.ibus.cyc.eq(1)
+                if self.fusion is not None:
+                    # a lui/auipc requests the next word in the cycle it arrives, the ROM
+                    # takes a request in its ack cycle (the fetch buffer acks combinationally
+                    # and is not asked early)
+                    early = Signal()
+                    if self.ifetch is None:
+                        m.d.comb += early.eq((word_hit | self.ibus.ack) &
+                                             is_fusion_head(fetched))
+                    m.d.comb += [
+                        self.ibus.adr.eq(Mux(early, self.pc + 4, self.pc)),
+                        self.ibus.stb.eq(early | (~word_hit & fetch_stb)),
+                        fetch_stall.eq(~word_hit & ~self.ibus.ack),
+                    ]
+                    with m.If(word_hit | self.ibus.ack):
+                        m.d.sync += inst.eq(fetched)
+                        m.d.comb += decoder.inst.eq(fetched)
+                        with m.If(is_fusion_head(fetched)):
+                            m.next = 'FETCH_NEXT'
+                        with m.Else():
+                            m.next = 'EXECUTE'
+                elif not self.compressed:
+                    m.d.comb += [
+                        self.ibus.stb.eq(fetch_stb),
+                        fetch_stall.eq(~self.ibus.ack),
+                    ]
+                    with m.If(self.ibus.ack):
+                        m.next = 'EXECUTE'
+                        m.d.sync += inst.eq(self.ibus.dat_r)
+                        m.d.comb += decoder.inst.eq(self.ibus.dat_r)
+                else:
+                    m.d.comb += [
+                        self.ibus.stb.eq(~word_hit & fetch_stb),
+                        fetch_stall.eq(~word_hit & ~self.ibus.ack),
+                    ]
+                    with m.If(~word_hit & self.ibus.ack):
+                        m.d.sync += [
+                            word.eq(self.ibus.dat_r),
+                            word_adr.eq(self.pc[2:]),
+                            word_valid.eq(1),
+                        ]
+                    with m.If(word_hit | self.ibus.ack):
+                        with m.If(is_compressed(expander.half)):
+                            m.next = 'EXECUTE'
+                            m.d.sync += [
+                                inst.eq(expander.inst),
+                                inst_c.eq(1),
+                            ]
+                            m.d.comb += decoder.inst.eq(expander.inst)
+                        with m.Elif(~self.pc[1]):
+                            m.next = 'EXECUTE'
+                            m.d.sync += [
+                                inst.eq(fetched),
+                                inst_c.eq(0),
+                            ]
+                            m.d.comb += decoder.inst.eq(fetched)
+                        with m.Else():
+                            m.next = 'FETCH_HI'
+                            m.d.sync += lo_half.eq(expander.half)
+            if self.compressed:
+                with m.State('FETCH_HI'):
+                    m.d.comb += [
+                        self.ibus.cyc.eq(1),
+                        self.ibus.adr.eq(Cat(C(0, 2), self.pc[2:] + 1)),
+                        self.ibus.stb.eq(fetch_stb),
+                        fetch_stall.eq(~self.ibus.ack),
+                    ]
+                    with m.If(self.ibus.ack):
+                        m.next = 'EXECUTE'
+                        m.d.sync += [
+                            word.eq(self.ibus.dat_r),
+                            word_adr.eq(self.pc[2:] + 1),
+                            inst.eq(Cat(lo_half, self.ibus.dat_r[:16])),
+                            inst_c.eq(0),
+                        ]
+                        m.d.comb += decoder.inst.eq(Cat(lo_half, self.ibus.dat_r[:16]))
+            if self.fusion is not None:
+                with m.State('FETCH_NEXT'):
+                    # the lui/auipc keeps its register reads up in case it runs alone
+                    m.d.comb += [
+                        decoder.inst.eq(inst),
+                        self.ibus.cyc.eq(1),
+                        self.ibus.adr.eq(self.pc + 4),
+                        self.ibus.stb.eq(fetch_stb),
+                        fetch_stall.eq(~self.ibus.ack),
+                        fusion.tail.eq(self.ibus.dat_r),
+                    ]
+                    with m.If(self.ibus.ack & fusion.fuse):
+                        m.next = 'FUSED'
+                        m.d.sync += tail.eq(self.ibus.dat_r)
+                    with m.Elif(self.ibus.ack):
+                        m.next = 'EXECUTE'
+                        m.d.sync += [
+                            word.eq(self.ibus.dat_r),
+                            word_adr.eq(self.pc[2:] + 1),
+                            word_valid.eq(1),
+                        ]
+                with m.State('FUSED'):
+                    # decoded as the lui/auipc, which adds zero or the pc to the immediate
+                    m.next = 'FETCH'
+                    m.d.comb += [
+                        decoder.inst.eq(inst),
+                        alu.rs2_val.eq(fusion.imm),
+                        regs.rd_we.eq(1),
+                        valid.eq(1),
+                        self.fused.eq(1),
+                    ]
+                    with m.If(fusion.kind == FusionKind.AUIPC_JALR):
+                        m.d.comb += regs.rd_data.eq(self.pc + 8)
+                        # jalr clears bit 0 of its target
+                        m.d.sync += self.pc.eq(Cat(C(0, 1), alu.rd_val[1:]))
+                    with m.Else():
+                        m.d.sync += self.pc.eq(self.pc + 8)
             with m.State('EXECUTE'):
-                m.d.comb += decoder.inst.eq(inst)
+                m.d.comb += [
+                    decoder.inst.eq(inst),
+                    muldiv.start.eq(decoder.itype == IType.MULDIV),
+                ]
                 with m.If(decoder.mem_op_en):
                     m.next = 'WRITE'
+                with m.Elif(muldiv.start & ~muldiv.ready):
+                    m.d.comb += muldiv_wait.eq(1)
                 with m.Else():
                     m.next = 'FETCH'
                     m.d.comb += [
@@ -144,17 +414,60 @@ class CPU(Elaboratable):
                     ]
                     m.d.sync += self.pc.eq(pc_next)
             with m.State('WRITE'):
+                # cyc is held from an AMO's read to its write, so the arbiter of a shared
+                # RAM does not let another hart in between
                 m.d.comb += [
                     decoder.inst.eq(inst),
-                    self.dbus.we.eq(decoder.mem_op_store),
-                    self.dbus.stb.eq(1),
+                    self.dbus.cyc.eq(1),
+                    self.dbus.we.eq(decoder.mem_op_store | sc),
+                    self.dbus.stb.eq(~self.dbus.ack & ~sc_fail),
+                    mem_wait.eq(~self.dbus.ack & ~sc_fail),
                 ]
-                with m.If(self.dbus.ack):
+                with m.If(sc_fail):
+                    # without the reservation sc.w writes nothing and returns 1
+                    m.next = 'FETCH'
+                    m.d.comb += [
+                        valid.eq(1),
+                        regs.rd_we.eq(1),
+                        regs.rd_data.eq(1),
+                    ]
+                    m.d.sync += [
+                        self.pc.eq(pc_next),
+                        self.reservation_valid.eq(0),
+                    ]
+                with m.Elif(self.dbus.ack & rmw):
+                    m.next = 'AMO_WRITE'
+                    m.d.sync += amo_old.eq(self.dbus.dat_r)
+                with m.Elif(self.dbus.ack):
                     m.next = 'FETCH'
                     m.d.comb += [
                         valid.eq(1),
                         regs.rd_we.eq(~decoder.mem_op_store),
-                        regs.rd_data.eq(self.dbus.dat_r),
+                        regs.rd_data.eq(Mux(sc, 0, self.dbus.dat_r)),
+                    ]
+                    m.d.sync += self.pc.eq(pc_next)
+                    with m.If(lr):
+                        m.d.sync += [
+                            self.reservation.eq(alu.rd_val[2:]),
+                            self.reservation_valid.eq(1),
+                        ]
+                    with m.If(sc):
+                        m.d.sync += self.reservation_valid.eq(0)
+            with m.State('AMO_WRITE'):
+                m.d.comb += [
+                    decoder.inst.eq(inst),
+                    self.dbus.cyc.eq(1),
+                    self.dbus.we.eq(1),
+                    self.dbus.dat_w.eq(amo.rd_val),
+                    self.dbus.stb.eq(~self.dbus.ack),
+                    mem_wait.eq(~self.dbus.ack),
+                ]
+                with m.If(self.dbus.ack):
+                    m.next = 'FETCH'
+                    m.d.comb += [
+                        valid.eq(1),
+                        regs.rd_we.eq(1),
+                        regs.rd_data.eq(amo_old),
                     ]
                     m.d.sync += self.pc.eq(pc_next)
 
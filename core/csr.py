@@ -0,0 +1,102 @@
+from nmigen import *
+from nmigen.sim import *
+from core.decoder import Csr
+
+
+class CsrOp:
+    RW = 0b01
+    RS = 0b10
+    RC = 0b11
+
+
+class HpmEvent:
+    FETCH_STALL  = 0
+    MEM_WAIT     = 1
+    BRANCH_TAKEN = 2
+    LOAD_USE     = 3
+    MULDIV_WAIT  = 4
+    FUSED        = 5
+
+    COUNT = 6
+
+
+class CSRUnit(Elaboratable):
+    def __init__(self, hartid=0):
+        self.hartid = hartid
+
+        # instruction at commit
+        self.commit = Signal()
+        self.addr = Signal(12)
+        self.funct3 = Signal(3)
+        self.rs1 = Signal(5)
+        self.rs1_val = Signal(32)
+        self.rdata = Signal(32)
+
+        # events, counted by minstret (instructions retired this cycle) and
+        # mhpmcounter3 + HpmEvent.*
+        self.retire = Signal(2)
+        self.events = Signal(HpmEvent.COUNT)
+
+        self.tohost = Signal(32)
+        self.tohost_we = Signal()
+
+        self.cycle = Signal(64)
+        self.instret = Signal(64)
+        self.hpmcounters = [Signal(64, name=f"mhpmcounter{3 + i}")
+                            for i in range(HpmEvent.COUNT)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        op = self.funct3[:2]
+        src = Signal(32)
+        wdata = Signal(32)
+        we = Signal()
+        m.d.comb += [
+            src.eq(Mux(self.funct3[2], self.rs1, self.rs1_val)),
+            # csrrs/csrrc with x0 (or a zero immediate) only read
+            we.eq(self.commit & (op != 0) & ((op == CsrOp.RW) | (self.rs1 != 0))),
+        ]
+        with m.Switch(op):
+            with m.Case(CsrOp.RW):
+                m.d.comb += wdata.eq(src)
+            with m.Case(CsrOp.RS):
+                m.d.comb += wdata.eq(self.rdata | src)
+            with m.Case(CsrOp.RC):
+                m.d.comb += wdata.eq(self.rdata & ~src)
+
+        counters = [
+            (self.cycle, Csr.CYCLE, Csr.CYCLEH, Csr.MCYCLE, Csr.MCYCLEH, 1),
+            (self.instret, Csr.INSTRET, Csr.INSTRETH, Csr.MINSTRET, Csr.MINSTRETH,
+             self.retire),
+        ]
+        for i, counter in enumerate(self.hpmcounters):
+            counters.append((counter, Csr.HPMCOUNTER3 + i, Csr.HPMCOUNTER3H + i,
+                             Csr.MHPMCOUNTER3 + i, Csr.MHPMCOUNTER3H + i, self.events[i]))
+
+        with m.Switch(self.addr):
+            for counter, lo, hi, mlo, mhi, _ in counters:
+                with m.Case(lo, mlo):
+                    m.d.comb += self.rdata.eq(counter[:32])
+                with m.Case(hi, mhi):
+                    m.d.comb += self.rdata.eq(counter[32:])
+            with m.Case(Csr.MHARTID):
+                m.d.comb += self.rdata.eq(self.hartid)
+            with m.Default():
+                m.d.comb += self.rdata.eq(0)
+
+        # only the machine-mode aliases are writable
+        for counter, _, _, mlo, mhi, event in counters:
+            with m.If(we & (self.addr == mlo)):
+                m.d.sync += counter[:32].eq(wdata)
+            with m.Elif(we & (self.addr == mhi)):
+                m.d.sync += counter[32:].eq(wdata)
+            with m.Elif(event):
+                m.d.sync += counter.eq(counter + event)
+
+        m.d.comb += [
+            self.tohost.eq(wdata),
+            self.tohost_we.eq(we & (self.addr == Csr.MTOHOST)),
+        ]
+
+        return m
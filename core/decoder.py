@@ -12,14 +12,34 @@ class Opcode:
     STORE  = 0b0100011
     IMM    = 0b0010011
     REG    = 0b0110011
+    SYSTEM = 0b1110011
+    AMO    = 0b0101111
+
+class Csr:
+    CYCLE         = 0xC00
+    INSTRET       = 0xC02
+    HPMCOUNTER3   = 0xC03
+    CYCLEH        = 0xC80
+    INSTRETH      = 0xC82
+    HPMCOUNTER3H  = 0xC83
+    MCYCLE        = 0xB00
+    MINSTRET      = 0xB02
+    MHPMCOUNTER3  = 0xB03
+    MCYCLEH       = 0xB80
+    MINSTRETH     = 0xB82
+    MHPMCOUNTER3H = 0xB83
+    MTOHOST       = 0x780
+    MHARTID       = 0xF14
 
 class IType:
-    ALU   = 0b000
-    BR    = 0b001
-    J     = 0b010
-    JR    = 0b011
-    LD    = 0b100
-    ST    = 0b101
+    ALU    = 0b000
+    BR     = 0b001
+    J      = 0b010
+    JR     = 0b011
+    LD     = 0b100
+    ST     = 0b101
+    CSR    = 0b110
+    MULDIV = 0b111
 
 class Decoder(Elaboratable):
     def __init__(self):
@@ -37,6 +57,8 @@ class Decoder(Elaboratable):
         self.itype = Signal(3)
         self.mem_op_en = Signal()
         self.mem_op_store = Signal()
+        # RV32A, decoded as a load from rs1; the core adds the write
+        self.amo = Signal()
         self.funct3 = Signal(3)
         self.funct1 = Signal()
 
@@ -155,6 +177,16 @@ class Decoder(Elaboratable):
                     self.mem_op_store.eq(1),
                     self.itype.eq(IType.ST)
                 ]
+            with m.Case(Opcode.AMO):
+                m.d.comb += [
+                    self.rs1_en.eq(1),
+                    self.rs2_en.eq(1),
+                    self.rd_en.eq(1),
+                    self.imm.eq(0),
+                    self.mem_op_en.eq(1),
+                    self.amo.eq(1),
+                    self.itype.eq(IType.LD)
+                ]
             with m.Case(Opcode.IMM):
                 with m.Switch(Cat(funct1_valid, funct3)):
                     with m.Case('-011'):
@@ -177,5 +209,19 @@ class Decoder(Elaboratable):
                     self.imm.eq(0),
                     self.funct1.eq(funct1),
                 ]
+                with m.If(funct7 == 0b0000001):
+                    m.d.comb += self.itype.eq(IType.MULDIV)
+            with m.Case(Opcode.SYSTEM):
+                m.d.comb += [
+                    self.rs1_en.eq(1),
+                    self.rs2_en.eq(0),
+                    self.imm.eq(imm_i),
+                ]
+                # ecall/ebreak are left as ALU nops
+                with m.If(funct3 != 0):
+                    m.d.comb += [
+                        self.rd_en.eq(1),
+                        self.itype.eq(IType.CSR),
+                    ]
 
         return m
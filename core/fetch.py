@@ -0,0 +1,109 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc.wishbone.bus import Interface, MemoryMap
+
+
+class FetchBuffer(Elaboratable):
+    def __init__(self, depth=4):
+        assert depth > 0
+        self.depth = depth
+
+        # CPU side, acked in the same cycle when the word is buffered
+        self.bus = Interface(addr_width=32, data_width=32)
+        self.bus.memory_map = MemoryMap(addr_width=32, data_width=32, alignment=0)
+        # memory side, connected by the CPU to the ROM
+        self.mem_bus = None
+
+        self.fetch_stalls = Signal(32)
+        self.flushes = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        mem = self.mem_bus
+
+        words = Array(Signal(32, name=f"word{i}") for i in range(self.depth))
+        rd_ptr = Signal(range(self.depth))
+        wr_ptr = Signal(range(self.depth))
+        count = Signal(range(self.depth + 1))
+        head_adr = Signal(32)
+        next_adr = Signal(32)
+        inflight = Signal()
+        stale = Signal()
+        stall = getattr(mem, "stall", Const(0))
+
+        request = Signal()
+        flush = Signal()
+        push = Signal()
+        pop = Signal()
+        issue = Signal()
+        accepted = Signal()
+
+        def incr(ptr):
+            return Mux(ptr == self.depth - 1, 0, ptr + 1)
+
+        # The ROM is driven as a pipelined master: the word requested in one
+        # cycle is acked on the next one, or later if the ROM stalls. An answer
+        # still in flight when the buffer is flushed is dropped.
+        m.d.comb += [
+            request.eq(bus.cyc & bus.stb),
+            flush.eq(request & (bus.adr != head_adr)),
+            push.eq(inflight & mem.ack & ~flush & ~stale),
+            issue.eq(flush | (count + inflight < self.depth)),
+            accepted.eq(issue & ~stall),
+            mem.cyc.eq(1),
+            mem.stb.eq(issue),
+            mem.adr.eq(Mux(flush, bus.adr, next_adr)),
+        ]
+
+        with m.If(request & ~flush):
+            with m.If(count != 0):
+                m.d.comb += [
+                    pop.eq(1),
+                    bus.ack.eq(1),
+                    bus.dat_r.eq(words[rd_ptr]),
+                ]
+            with m.Elif(push):
+                # bypass the word arriving this cycle
+                m.d.comb += [
+                    bus.ack.eq(1),
+                    bus.dat_r.eq(mem.dat_r),
+                ]
+        with m.If(request & ~bus.ack):
+            m.d.sync += self.fetch_stalls.eq(self.fetch_stalls + 1)
+
+        m.d.sync += inflight.eq(accepted | (inflight & ~mem.ack))
+        with m.If(accepted):
+            m.d.sync += next_adr.eq(mem.adr + 4)
+        with m.Elif(flush):
+            m.d.sync += next_adr.eq(bus.adr)
+        with m.If(mem.ack):
+            m.d.sync += stale.eq(0)
+        with m.Elif(flush & inflight):
+            m.d.sync += stale.eq(1)
+
+        with m.If(flush):
+            m.d.sync += [
+                self.flushes.eq(self.flushes + 1),
+                head_adr.eq(bus.adr),
+                rd_ptr.eq(0),
+                wr_ptr.eq(0),
+                count.eq(0),
+            ]
+        with m.Else():
+            with m.If(bus.ack):
+                m.d.sync += head_adr.eq(head_adr + 4)
+            with m.If(push & ~(bus.ack & ~pop)):
+                m.d.sync += [
+                    words[wr_ptr].eq(mem.dat_r),
+                    wr_ptr.eq(incr(wr_ptr)),
+                ]
+            with m.If(pop):
+                m.d.sync += rd_ptr.eq(incr(rd_ptr))
+            with m.If(push & ~bus.ack):
+                m.d.sync += count.eq(count + 1)
+            with m.Elif(pop & ~push):
+                m.d.sync += count.eq(count - 1)
+
+        return m
@@ -0,0 +1,55 @@
+from nmigen import *
+from nmigen.sim import *
+from core.decoder import Opcode
+
+
+class FusionKind:
+    LUI_ADDI   = 0
+    AUIPC_ADDI = 1
+    AUIPC_JALR = 2
+
+
+def is_fusion_head(inst):
+    # lui or auipc with a destination, the first instruction of every fused pair
+    return ((inst[:7] == Opcode.LUI) | (inst[:7] == Opcode.AUIPC)) & (inst[7:12] != 0)
+
+
+class Fusion(Elaboratable):
+    """Pairs a lui/auipc with the instruction after it when that one completes the constant
+    or the jump, so the pair executes as one operation:
+
+        lui rd, hi;   addi rd, rd, lo    rd = hi + lo
+        auipc rd, hi; addi rd, rd, lo    rd = pc + hi + lo
+        auipc rd, hi; jalr rd, lo(rd)    rd = pc + 8, jump to (pc + hi + lo) & ~1
+
+    Every pair writes only rd, so the final register state is that of the two instructions.
+    """
+
+    def __init__(self):
+        self.head = Signal(32)
+        self.tail = Signal(32)
+
+        self.fuse = Signal()
+        self.kind = Signal(2)
+        # hi + lo, added to zero or the pc by the ALU
+        self.imm = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        head = self.head
+        tail = self.tail
+        rd = head[7:12]
+        auipc = head[:7] == Opcode.AUIPC
+        addi = (tail[:7] == Opcode.IMM) & (tail[12:15] == 0)
+        jalr = (tail[:7] == Opcode.JALR) & (tail[12:15] == 0)
+
+        m.d.comb += [
+            self.imm.eq(Cat(C(0, 12), head[12:32]) + tail[20:32].as_signed()),
+            self.fuse.eq(is_fusion_head(head) & (tail[7:12] == rd) & (tail[15:20] == rd) &
+                         (addi | (auipc & jalr))),
+            self.kind.eq(Mux(~auipc, FusionKind.LUI_ADDI,
+                             Mux(addi, FusionKind.AUIPC_ADDI, FusionKind.AUIPC_JALR))),
+        ]
+
+        return m
@@ -0,0 +1,438 @@
+from core.alu import AluFunc
+from core.amo import AmoFunc
+from core.branch import BRANCH
+from core.compressed import expand, is_compressed
+from core.decoder import Csr, IType, Opcode
+from core.muldiv import MulDivFunc
+
+
+MASK = 0xffff_ffff
+SIGN = 0x8000_0000
+
+OPCODE_FENCE  = 0b0001111
+OPCODE_AMO    = 0b0101111
+
+# instructions per compiled block and bytes per invalidation page
+BLOCK_SIZE = 64
+PAGE_BITS = 8
+
+
+class ISSError(Exception):
+    pass
+
+
+def sext(value, bits):
+    sign = 1 << (bits - 1)
+    return (value & (sign - 1)) - (value & sign)
+
+
+# field and immediate layout, mirroring Decoder
+def rd(inst):     return (inst >> 7) & 0x1f
+def rs1(inst):    return (inst >> 15) & 0x1f
+def rs2(inst):    return (inst >> 20) & 0x1f
+def funct3(inst): return (inst >> 12) & 0x7
+def funct7(inst): return inst >> 25
+
+def imm_i(inst): return sext(inst >> 20, 12)
+def imm_s(inst): return sext(((inst >> 25) << 5) | ((inst >> 7) & 0x1f), 12)
+def imm_b(inst): return sext(((inst >> 31) << 12) | (((inst >> 7) & 1) << 11) |
+                             (((inst >> 25) & 0x3f) << 5) | (((inst >> 8) & 0xf) << 1), 13)
+def imm_u(inst): return inst & 0xffff_f000
+def imm_j(inst): return sext(((inst >> 31) << 20) | (((inst >> 12) & 0xff) << 12) |
+                             (((inst >> 20) & 1) << 11) | (((inst >> 21) & 0x3ff) << 1), 21)
+
+
+def itype(inst):
+    opcode = inst & 0x7f
+    if opcode == Opcode.BRANCH:
+        return IType.BR
+    if opcode == Opcode.JAL:
+        return IType.J
+    if opcode == Opcode.JALR:
+        return IType.JR
+    if opcode == Opcode.LOAD:
+        return IType.LD
+    if opcode == Opcode.STORE:
+        return IType.ST
+    if opcode == Opcode.SYSTEM and funct3(inst) != 0:
+        return IType.CSR
+    if opcode == Opcode.REG and funct7(inst) == 0b0000001:
+        return IType.MULDIV
+    return IType.ALU
+
+
+def alu_func(inst):
+    funct1 = (funct7(inst) >> 5) & 1
+    if (inst & 0x7f) == Opcode.IMM and funct3(inst) != 0b101:
+        funct1 = 0
+    return (funct3(inst) << 1) | funct1
+
+
+ALU_EXPR = {
+    AluFunc.ADD:  '({a} + {b}) & 0xffffffff',
+    AluFunc.SUB:  '({a} - {b}) & 0xffffffff',
+    AluFunc.SLL:  '({a} << ({b} & 31)) & 0xffffffff',
+    AluFunc.SLT:  'int(({a} ^ 0x80000000) < ({b} ^ 0x80000000))',
+    AluFunc.SLTU: 'int({a} < {b})',
+    AluFunc.XOR:  '{a} ^ {b}',
+    AluFunc.SRL:  '{a} >> ({b} & 31)',
+    AluFunc.SRA:  '((({a} ^ 0x80000000) - 0x80000000) >> ({b} & 31)) & 0xffffffff',
+    AluFunc.OR:   '{a} | {b}',
+    AluFunc.AND:  '{a} & {b}',
+}
+
+BRANCH_EXPR = {
+    BRANCH.BEQ:  '{a} == {b}',
+    BRANCH.BNE:  '{a} != {b}',
+    BRANCH.BLT:  '({a} ^ 0x80000000) < ({b} ^ 0x80000000)',
+    BRANCH.BGE:  '({a} ^ 0x80000000) >= ({b} ^ 0x80000000)',
+    BRANCH.BLTU: '{a} < {b}',
+    BRANCH.BGEU: '{a} >= {b}',
+}
+
+MULDIV_EXPR = {
+    MulDivFunc.MUL:    '({a} * {b}) & 0xffffffff',
+    MulDivFunc.MULH:   '((sext32({a}) * sext32({b})) >> 32) & 0xffffffff',
+    MulDivFunc.MULHSU: '((sext32({a}) * {b}) >> 32) & 0xffffffff',
+    MulDivFunc.MULHU:  '({a} * {b}) >> 32',
+    MulDivFunc.DIV:    'div({a}, {b})',
+    MulDivFunc.DIVU:   '{a} // {b} if {b} else 0xffffffff',
+    MulDivFunc.REM:    'rem({a}, {b})',
+    MulDivFunc.REMU:   '{a} % {b} if {b} else {a}',
+}
+
+# the value an AMO writes back, t is the word it read
+AMO_EXPR = {
+    AmoFunc.ADD:  '(t + {b}) & 0xffffffff',
+    AmoFunc.SWAP: '{b}',
+    AmoFunc.XOR:  't ^ {b}',
+    AmoFunc.OR:   't | {b}',
+    AmoFunc.AND:  't & {b}',
+    AmoFunc.MIN:  'min(t, {b}, key=sext32)',
+    AmoFunc.MAX:  'max(t, {b}, key=sext32)',
+    AmoFunc.MINU: 'min(t, {b})',
+    AmoFunc.MAXU: 'max(t, {b})',
+}
+
+LOAD_EXPR = {
+    0b000: 'sext8(load_byte(a))',
+    0b001: 'sext16(load_half(a))',
+    0b010: 'load_word(a)',
+    0b100: 'load_byte(a)',
+    0b101: 'load_half(a)',
+}
+
+STORE_FUNC = {
+    0b000: 'store_byte',
+    0b001: 'store_half',
+    0b010: 'store_word',
+}
+
+
+def div(a, b):
+    # rounds towards zero, x / 0 is -1 and the overflow case wraps to -2**31
+    if b == 0:
+        return MASK
+    a, b = sext(a, 32), sext(b, 32)
+    q = abs(a) // abs(b)
+    return (-q if (a < 0) != (b < 0) else q) & MASK
+
+
+def rem(a, b):
+    # takes the sign of the dividend, x % 0 is x
+    if b == 0:
+        return a
+    a, b = sext(a, 32), sext(b, 32)
+    r = abs(a) % abs(b)
+    return (-r if a < 0 else r) & MASK
+
+
+class SimMemory:
+    def __init__(self, size, data=b''):
+        self.size = size
+        self.data = bytearray(size)
+        self.data[:len(data)] = data
+        self.words = memoryview(self.data).cast('I')
+        # addresses wrap like the RTL's truncated bus when the size allows it
+        self.mask = size - 1 if size & (size - 1) == 0 else MASK
+
+    @classmethod
+    def from_words(cls, words, size=None):
+        size = size or 4 * len(words)
+        return cls(size, b''.join(w.to_bytes(4, 'little') for w in words))
+
+
+class ISS:
+    def __init__(self, imem, dmem=None, reset_address=0x0000_0000):
+        self.imem = imem
+        self.dmem = dmem if dmem is not None else imem
+        self.regs = [0] * 32
+        self.pc = reset_address
+        self.instret = 0
+        self.halted = False
+        self.exit_code = None
+        self.tohost = []
+        # the word address reserved by lr.w
+        self.reservation = None
+
+        self.blocks = {}
+        self.singles = {}
+        self.pages = {}
+        self._env = self._make_env()
+
+    # memory access used by the compiled blocks
+
+    def _make_env(self):
+        dmem = self.dmem
+        data = dmem.data
+        words = dmem.words
+        mask = dmem.mask
+        shared = dmem is self.imem
+        pages = self.pages
+
+        def invalidate(a):
+            page = (a & mask) >> PAGE_BITS
+            if shared and page in pages:
+                self._invalidate_page(page)
+                return True
+            return False
+
+        def load_word(a):
+            return words[(a & mask) >> 2]
+
+        def load_half(a):
+            a &= mask
+            return data[a] | (data[a + 1] << 8)
+
+        def load_byte(a):
+            return data[a & mask]
+
+        def store_word(a, v):
+            words[(a & mask) >> 2] = v
+            return invalidate(a)
+
+        def store_half(a, v):
+            a &= mask
+            data[a] = v & 0xff
+            data[a + 1] = (v >> 8) & 0xff
+            return invalidate(a)
+
+        def store_byte(a, v):
+            data[a & mask] = v & 0xff
+            return invalidate(a)
+
+        def reserve(a):
+            self.reservation = (a & mask) >> 2
+
+        def reserved(a):
+            # sc.w succeeds once per lr.w
+            hit = self.reservation == (a & mask) >> 2
+            self.reservation = None
+            return hit
+
+        return {
+            'reserve': reserve, 'reserved': reserved,
+            'load_word': load_word, 'load_half': load_half, 'load_byte': load_byte,
+            'store_word': store_word, 'store_half': store_half, 'store_byte': store_byte,
+            'sext8': lambda v: v | 0xffffff00 if v & 0x80 else v,
+            'sext16': lambda v: v | 0xffff0000 if v & 0x8000 else v,
+            'sext32': lambda v: (v ^ SIGN) - SIGN,
+            'div': div,
+            'rem': rem,
+            'system': self._system,
+        }
+
+    def _invalidate_page(self, page):
+        for start in self.pages.pop(page):
+            self.blocks.pop(start, None)
+            self.singles.pop(start, None)
+
+    def invalidate(self):
+        self.blocks.clear()
+        self.singles.clear()
+        self.pages.clear()
+
+    # decoding
+
+    def fetch(self, pc):
+        # returns (inst, length), a compressed instruction comes back expanded
+        data, mask = self.imem.data, self.imem.mask
+        half = data[pc & mask] | data[(pc + 1) & mask] << 8
+        if not is_compressed(half):
+            return half | (data[(pc + 2) & mask] | data[(pc + 3) & mask] << 8) << 16, 4
+        inst = expand(half)
+        if inst is None:
+            raise ISSError(f'illegal compressed instruction 0x{half:04x} at 0x{pc:08x}')
+        return inst, 2
+
+    def _translate(self, pc, inst, length, n):
+        # returns (lines, terminates); n instructions of the block precede it
+        opcode = inst & 0x7f
+        d, s1, s2 = rd(inst), rs1(inst), rs2(inst)
+        a, b = f'r[{s1}]', f'r[{s2}]'
+        next_pc = (pc + length) & MASK
+
+        def write(expr):
+            return [f'r[{d}] = {expr}'] if d != 0 else []
+
+        if opcode == Opcode.LUI:
+            return write(f'0x{imm_u(inst):x}'), False
+        if opcode == Opcode.AUIPC:
+            return write(f'0x{(pc + imm_u(inst)) & MASK:x}'), False
+        if opcode == Opcode.IMM:
+            func = alu_func(inst)
+            imm = imm_i(inst) & MASK if func not in (AluFunc.SLL, AluFunc.SRL, AluFunc.SRA) \
+                else s2
+            return write(ALU_EXPR[func].format(a=a, b=f'0x{imm:x}')), False
+        if opcode == Opcode.REG:
+            if funct7(inst) == 0b0000001:
+                return write(MULDIV_EXPR[funct3(inst)].format(a=a, b=b)), False
+            if funct7(inst) not in (0b0000000, 0b0100000):
+                raise ISSError(f'illegal instruction 0x{inst:08x} at 0x{pc:08x}')
+            return write(ALU_EXPR[alu_func(inst)].format(a=a, b=b)), False
+        if opcode == Opcode.LOAD:
+            if funct3(inst) not in LOAD_EXPR:
+                raise ISSError(f'illegal instruction 0x{inst:08x} at 0x{pc:08x}')
+            lines = [f'a = ({a} + 0x{imm_i(inst) & MASK:x}) & 0xffffffff']
+            return lines + write(LOAD_EXPR[funct3(inst)]), False
+        if opcode == Opcode.STORE:
+            if funct3(inst) not in STORE_FUNC:
+                raise ISSError(f'illegal instruction 0x{inst:08x} at 0x{pc:08x}')
+            return [f'a = ({a} + 0x{imm_s(inst) & MASK:x}) & 0xffffffff',
+                    f'if {STORE_FUNC[funct3(inst)]}(a, {b}):',
+                    f'    return 0x{next_pc:x}, {n + 1}'], False
+        if opcode == Opcode.BRANCH:
+            cond = BRANCH_EXPR[funct3(inst)].format(a=a, b=b)
+            target = (pc + imm_b(inst)) & MASK
+            return [f'if {cond}:',
+                    f'    return 0x{target:x}, {n + 1}',
+                    f'return 0x{next_pc:x}, {n + 1}'], True
+        if opcode == Opcode.JAL:
+            target = (pc + imm_j(inst)) & MASK
+            return write(f'0x{next_pc:x}') + [f'return 0x{target:x}, {n + 1}'], True
+        if opcode == Opcode.JALR:
+            return [f't = ({a} + 0x{imm_i(inst) & MASK:x}) & 0xfffffffe'] + \
+                write(f'0x{next_pc:x}') + [f'return t, {n + 1}'], True
+        if opcode == OPCODE_AMO:
+            f5 = funct7(inst) >> 2
+            if funct3(inst) != 0b010 or f5 not in AMO_EXPR and f5 not in (AmoFunc.LR, AmoFunc.SC):
+                raise ISSError(f'illegal instruction 0x{inst:08x} at 0x{pc:08x}')
+            lines = [f'a = {a}']
+            if f5 == AmoFunc.LR:
+                return lines + ['reserve(a)'] + write('load_word(a)'), False
+            if f5 == AmoFunc.SC:
+                lines += ['t = int(not reserved(a))', f's = not t and store_word(a, {b})']
+            else:
+                lines += ['t = load_word(a)',
+                          f's = store_word(a, {AMO_EXPR[f5].format(b=b)})']
+            return lines + write('t') + ['if s:',
+                                         f'    return 0x{next_pc:x}, {n + 1}'], False
+        if opcode == OPCODE_FENCE:
+            return [], False
+        if opcode == Opcode.SYSTEM:
+            return [f'return system(r, 0x{pc:x}, 0x{inst:x}, {n}), {n + 1}'], True
+        raise ISSError(f'illegal instruction 0x{inst:08x} at 0x{pc:08x}')
+
+    def _compile(self, pc, limit):
+        body = []
+        n = 0
+        start = pc
+        terminated = False
+        while n < limit and not terminated:
+            inst, length = self.fetch(pc)
+            lines, terminated = self._translate(pc, inst, length, n)
+            body += lines
+            n += 1
+            pc = (pc + length) & MASK
+        if not terminated:
+            body.append(f'return 0x{pc:x}, {n}')
+        src = f'def block_{start:x}(r):\n' + ''.join(f'    {line}\n' for line in body)
+        scope = {}
+        exec(compile(src, f'<block 0x{start:08x}>', 'exec'), self._env, scope)
+        block = scope[f'block_{start:x}']
+        block.length = n
+        block.end = pc
+        for page in range((start & self.imem.mask) >> PAGE_BITS,
+                          (((pc - 1) & self.imem.mask) >> PAGE_BITS) + 1):
+            self.pages.setdefault(page, set()).add(start)
+        return block
+
+    # execution
+
+    def _system(self, r, pc, inst, n):
+        f3 = funct3(inst)
+        if f3 == 0:
+            # ecall / ebreak
+            self.halted = True
+            return pc
+        csr = inst >> 20
+        d = rd(inst)
+        src = rs1(inst) if f3 & 0b100 else r[rs1(inst)]
+        old = 0
+        # one instruction per cycle, the other counters read as zero
+        if csr in (Csr.CYCLE, Csr.INSTRET, Csr.MCYCLE, Csr.MINSTRET):
+            old = (self.instret + n) & MASK
+        op = f3 & 0b11
+        if op == 0b01:
+            new = src
+        elif op == 0b10:
+            new = old | src
+        else:
+            new = old & ~src
+        if op == 0b01 or rs1(inst) != 0:
+            if csr == Csr.MTOHOST:
+                self.write_tohost(new & MASK)
+            elif csr in (Csr.MCYCLE, Csr.MINSTRET):
+                # the block adds its n + 1 instructions when it returns
+                self.instret = (new & MASK) - (n + 1)
+        if d != 0:
+            r[d] = old
+        return (pc + 4) & MASK
+
+    def write_tohost(self, value):
+        self.tohost.append(value)
+        # riscv_test.h: values below 0x10000 are the exit code, the rest is output
+        if value >> 16 == 0:
+            self.halted = True
+            self.exit_code = value
+
+    def run(self, max_instructions=None, until_pc=None):
+        r = self.regs
+        blocks = self.blocks
+        pc = self.pc
+        budget = max_instructions
+        start = self.instret
+        while not self.halted:
+            if pc == until_pc and self.instret != start:
+                break
+            if budget is not None and budget <= 0:
+                break
+            block = blocks.get(pc)
+            if block is None:
+                block = blocks[pc] = self._compile(pc, BLOCK_SIZE)
+            if (budget is not None and block.length > budget) or \
+                    (until_pc is not None and pc < until_pc < block.end):
+                self.pc = pc
+                self.step()
+                pc = self.pc
+                if budget is not None:
+                    budget -= 1
+                continue
+            self.pc = pc
+            pc, n = block(r)
+            self.instret += n
+            if budget is not None:
+                budget -= n
+        self.pc = pc
+        return self.instret
+
+    def step(self):
+        pc = self.pc
+        block = self.singles.get(pc)
+        if block is None:
+            block = self.singles[pc] = self._compile(pc, 1)
+            inst, _ = self.fetch(pc)
+            block.rd = rd(inst) if itype(inst) not in (IType.BR, IType.ST) else 0
+        self.pc, n = block(self.regs)
+        self.instret += n
+        return pc, block.rd, self.regs[block.rd]
@@ -1,12 +1,22 @@
 from math import ceil, log2
 from nmigen import *
 from nmigen.sim import *
-from nmigen_soc.wishbone.bus import Arbiter, Interface, MemoryMap
+from nmigen_soc.wishbone.bus import Arbiter, CycleType, Interface, MemoryMap
 
 
 class MemoryUnit(Elaboratable):
-    def __init__(self, size_words, data=[]):
+    """Word-wide Wishbone memory, a request is acked 1 + wait_states cycles after it is taken.
+
+    Beats after the first of an incrementing burst (cti) are acked on the next cycle. While a
+    request waits out its wait states no other is taken: pipelined buses (Wishbone B4) see
+    this on stall, classic masters have to hold their request until the ack.
+    """
+
+    def __init__(self, size_words, data=[], pipelined=False, wait_states=0):
         self.size = size_words * 4
+        self.pipelined = pipelined
+        self.wait_states = wait_states
+        self.features = {"cti", "bte"} | ({"stall"} if pipelined else set())
         self.mem = Memory(
             width=32,
             depth=size_words,
@@ -15,7 +25,7 @@ class MemoryUnit(Elaboratable):
         self.read_port = self.mem.read_port()
         self.write_port = self.mem.write_port()
         self.arb = Arbiter(addr_width=ceil(log2(self.size + 1)),
-                           data_width=32)
+                           data_width=32, features=self.features)
         self.arb.bus.memory_map = MemoryMap(
             addr_width = self.arb.bus.addr_width,
             data_width = self.arb.bus.data_width,
@@ -23,7 +33,8 @@ class MemoryUnit(Elaboratable):
 
     def new_bus( self ):
         bus = Interface( addr_width = self.arb.bus.addr_width,
-                     data_width = self.arb.bus.data_width )
+                     data_width = self.arb.bus.data_width,
+                     features = self.features )
         bus.memory_map = MemoryMap( addr_width = bus.addr_width,
                                 data_width = bus.data_width,
                                 alignment = 0 )
@@ -37,15 +48,211 @@ class MemoryUnit(Elaboratable):
         m.submodules.write_port = self.write_port
         m.submodules.arb = self.arb
 
-        m.d.sync += self.arb.bus.ack.eq(0)
-        with m.If(self.arb.bus.cyc):
-            m.d.sync += self.arb.bus.ack.eq(self.arb.bus.stb)
+        bus = self.arb.bus
+        accept = Signal()
+        busy = Signal()
+        burst = Signal()
+        wait = Signal(range(self.wait_states + 1))
+        addr = Signal.like(bus.adr)
         m.d.comb += [
-            self.read_port.addr.eq(self.arb.bus.adr >> 2),
-            self.write_port.addr.eq(self.arb.bus.adr >> 2),
-            self.arb.bus.dat_r.eq(self.read_port.data),
-            self.write_port.data.eq(self.arb.bus.dat_w),
-            self.write_port.en.eq(self.arb.bus.we),
+            busy.eq(wait != 0),
+            accept.eq(bus.cyc & bus.stb & ~busy),
+        ]
+        if self.pipelined:
+            m.d.comb += bus.stall.eq(busy)
+
+        m.d.sync += bus.ack.eq(0)
+        with m.If(accept):
+            m.d.sync += [
+                addr.eq(bus.adr),
+                burst.eq(bus.cti == CycleType.INCR_BURST),
+            ]
+            if self.wait_states:
+                with m.If(burst):
+                    m.d.sync += bus.ack.eq(1)
+                with m.Else():
+                    m.d.sync += wait.eq(self.wait_states)
+            else:
+                m.d.sync += bus.ack.eq(1)
+        with m.Elif(busy):
+            m.d.sync += wait.eq(wait - 1)
+            with m.If(wait == 1):
+                m.d.sync += bus.ack.eq(1)
+
+        m.d.comb += [
+            self.read_port.addr.eq(Mux(busy, addr, bus.adr) >> 2),
+            self.write_port.addr.eq(bus.adr >> 2),
+            bus.dat_r.eq(self.read_port.data),
+            self.write_port.data.eq(bus.dat_w),
+            self.write_port.en.eq(accept & bus.we),
         ]
 
         return m
+
+
+class AddressDecoder(Elaboratable):
+    def __init__(self):
+        self.bus = Interface(addr_width=32, data_width=32)
+        self.bus.memory_map = MemoryMap(addr_width=32, data_width=32, alignment=0)
+        # (name, base, size, bus), each bus sees the offset into its region
+        self.regions = []
+
+    def add(self, name, base, size, bus):
+        for other, other_base, other_size, _ in self.regions:
+            if base < other_base + other_size and other_base < base + size:
+                raise ValueError(f"region {name} at {base:#x} overlaps {other} at "
+                                 f"{other_base:#x}")
+        self.regions.append((name, base, size, bus))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        hits = Signal(len(self.regions))
+        for i, (name, base, size, slave) in enumerate(self.regions):
+            m.d.comb += [
+                hits[i].eq((bus.adr >= base) & (bus.adr < base + size)),
+                slave.adr.eq(bus.adr - base),
+                slave.dat_w.eq(bus.dat_w),
+                slave.sel.eq(bus.sel),
+                slave.cyc.eq(bus.cyc & hits[i]),
+                slave.stb.eq(bus.stb & hits[i]),
+                slave.we.eq(bus.we & hits[i]),
+            ]
+
+        # acks answer the previous request, route them from the region it went to;
+        # unmapped accesses are acked with zero
+        last = Signal(range(len(self.regions) + 1))
+        unmapped_ack = Signal()
+        m.d.sync += unmapped_ack.eq(bus.cyc & bus.stb & ~hits.any())
+        with m.If(bus.stb):
+            m.d.sync += last.eq(len(self.regions))
+            for i in range(len(self.regions)):
+                with m.If(hits[i]):
+                    m.d.sync += last.eq(i)
+        with m.Switch(last):
+            for i, (_, _, _, slave) in enumerate(self.regions):
+                with m.Case(i):
+                    m.d.comb += [
+                        bus.ack.eq(slave.ack),
+                        bus.dat_r.eq(slave.dat_r),
+                    ]
+            with m.Default():
+                m.d.comb += bus.ack.eq(unmapped_ack)
+
+        return m
+
+
+class SparseMemory(Elaboratable):
+    """RAM model for simulation, only the pages that are written are allocated.
+
+    It has no logic of its own: process() answers its bus with the timing of a pipelined
+    MemoryUnit and has to be added to the simulator as a sync process. A shared one puts an
+    Arbiter in front of the bus for several masters. Either is elaborated by its owner: the
+    SoC for a shared one, the one core using it otherwise.
+    """
+
+    PAGE_BITS = 12
+    PAGE_SIZE = 1 << PAGE_BITS
+    PAGE_MASK = PAGE_SIZE - 1
+
+    def __init__(self, size, wait_states=0, shared=False):
+        assert size & (size - 1) == 0
+        self.size = size
+        self.wait_states = wait_states
+        self.features = {"cti", "bte", "stall"}
+        self.arb = None
+        if shared:
+            self.arb = Arbiter(addr_width=ceil(log2(size)), data_width=32,
+                               features=self.features)
+            self.bus = self.arb.bus
+        else:
+            self.bus = Interface(addr_width=ceil(log2(size)), data_width=32,
+                                 features=self.features)
+        self.bus.memory_map = MemoryMap(addr_width=self.bus.addr_width, data_width=32,
+                                        alignment=0)
+        self.pages = {}
+        self.used = False
+
+    @property
+    def shared(self):
+        return self.arb is not None
+
+    def new_bus(self):
+        if self.arb is not None:
+            bus = Interface(addr_width=self.bus.addr_width, data_width=32,
+                            features=self.features)
+            bus.memory_map = MemoryMap(addr_width=bus.addr_width, data_width=32,
+                                       alignment=0)
+            self.arb.add(bus)
+            return bus
+        # one master unless shared
+        assert not self.used
+        self.used = True
+        return self.bus
+
+    def clear(self):
+        self.pages.clear()
+
+    def page(self, addr):
+        number = addr >> self.PAGE_BITS
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = memoryview(bytearray(self.PAGE_SIZE)).cast('I')
+        return page
+
+    def read(self, addr):
+        page = self.pages.get(addr >> self.PAGE_BITS)
+        return page[(addr & self.PAGE_MASK) >> 2] if page is not None else 0
+
+    def write(self, addr, value):
+        self.page(addr)[(addr & self.PAGE_MASK) >> 2] = value
+
+    def load(self, addr, data):
+        # copies bytes in, a page at a time
+        data = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(data):
+            offset = (addr + pos) & self.PAGE_MASK
+            count = min(len(data) - pos, self.PAGE_SIZE - offset)
+            self.page(addr + pos).cast('B')[offset:offset + count] = data[pos:pos + count]
+            pos += count
+
+    def elaborate(self, platform):
+        m = Module()
+        if self.arb is not None:
+            m.submodules.arb = self.arb
+        return m
+
+    def process(self):
+        yield Passive()
+        bus = self.bus
+        mask = self.size - 1
+        wait = 0
+        burst = False
+        addr = 0
+        acked = stalled = False
+        while True:
+            # the request as sampled by this clock edge
+            yield Tick()
+            ack = False
+            if wait:
+                wait -= 1
+                ack = wait == 0
+            elif (yield bus.cyc) and (yield bus.stb):
+                addr = (yield bus.adr) & mask
+                if (yield bus.we):
+                    self.write(addr, (yield bus.dat_w))
+                if burst or not self.wait_states:
+                    ack = True
+                else:
+                    wait = self.wait_states
+                burst = (yield bus.cti) == CycleType.INCR_BURST.value
+            if ack:
+                yield bus.dat_r.eq(self.read(addr))
+            if ack or acked:
+                yield bus.ack.eq(ack)
+                acked = ack
+            if bool(wait) != stalled:
+                stalled = bool(wait)
+                yield bus.stall.eq(stalled)
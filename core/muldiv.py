@@ -0,0 +1,147 @@
+from nmigen import *
+from nmigen.sim import *
+
+
+class MulDivFunc:
+    MUL    = 0b000
+    MULH   = 0b001
+    MULHSU = 0b010
+    MULHU  = 0b011
+    DIV    = 0b100
+    DIVU   = 0b101
+    REM    = 0b110
+    REMU   = 0b111
+
+
+class MulDiv(Elaboratable):
+    """RV32M unit, funct is the instruction's funct3.
+
+    The operation is requested by holding start until ready. The single-cycle unit answers
+    in the same cycle with a combinational multiplier and divider; the iterative one does
+    one bit per cycle and answers 33 cycles later, then waits for the next start.
+    """
+
+    def __init__(self, iterative=False):
+        self.iterative = iterative
+
+        self.start = Signal()
+        self.funct = Signal(3)
+        self.rs1_val = Signal(32)
+        self.rs2_val = Signal(32)
+        self.ready = Signal()
+        self.rd_val = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # both implementations work on magnitudes and fix the signs up at the end
+        div = self.funct[2]
+        signed1 = Mux(div, ~self.funct[0], self.funct[:2] != MulDivFunc.MULHU)
+        signed2 = Mux(div, ~self.funct[0], self.funct[:2] == MulDivFunc.MULH)
+
+        neg1 = Signal()
+        neg2 = Signal()
+        mag1 = Signal(32)
+        mag2 = Signal(32)
+        m.d.comb += [
+            neg1.eq(signed1 & self.rs1_val[31]),
+            neg2.eq(signed2 & self.rs2_val[31]),
+            mag1.eq(Mux(neg1, -self.rs1_val, self.rs1_val)),
+            mag2.eq(Mux(neg2, -self.rs2_val, self.rs2_val)),
+        ]
+
+        funct = Signal(3)
+        product = Signal(64)
+        quotient = Signal(32)
+        remainder = Signal(32)
+        neg_product = Signal()
+        neg_quotient = Signal()
+        neg_remainder = Signal()
+
+        if not self.iterative:
+            m.d.comb += [
+                self.ready.eq(self.start),
+                funct.eq(self.funct),
+                product.eq(mag1 * mag2),
+                quotient.eq(Mux(mag2 == 0, 0xffff_ffff, mag1 // mag2)),
+                remainder.eq(Mux(mag2 == 0, mag1, mag1 % mag2)),
+                neg_product.eq(neg1 ^ neg2),
+                # x / 0 is -1 and x % 0 is x whatever the signs
+                neg_quotient.eq((neg1 ^ neg2) & (self.rs2_val != 0)),
+                neg_remainder.eq(neg1),
+            ]
+        else:
+            # multiply: shift-and-add into hi, the multiplier is shifted out of lo
+            # divide: restoring division, lo shifts the dividend out and the quotient in
+            hi = Signal(33)
+            lo = Signal(32)
+            divisor = Signal(32)
+            count = Signal(range(33))
+            neg = Signal(2)
+            zero = Signal()
+
+            shifted = Signal(33)
+            diff = Signal(34)
+            added = Signal(33)
+            m.d.comb += [
+                shifted.eq(Cat(lo[31], hi[:32])),
+                diff.eq(shifted - divisor),
+                added.eq(hi[:32] + Mux(lo[0], divisor, 0)),
+            ]
+
+            with m.FSM():
+                with m.State('IDLE'):
+                    with m.If(self.start):
+                        m.next = 'BUSY'
+                        m.d.sync += [
+                            funct.eq(self.funct),
+                            hi.eq(0),
+                            lo.eq(Mux(div, mag1, mag2)),
+                            divisor.eq(Mux(div, mag2, mag1)),
+                            count.eq(32),
+                            neg.eq(Cat(neg1, neg2)),
+                            zero.eq(self.rs2_val == 0),
+                        ]
+                with m.State('BUSY'):
+                    m.d.sync += count.eq(count - 1)
+                    with m.If(funct[2]):
+                        with m.If(diff[33]):
+                            m.d.sync += [
+                                hi.eq(shifted),
+                                lo.eq(Cat(0, lo[:31])),
+                            ]
+                        with m.Else():
+                            m.d.sync += [
+                                hi.eq(diff),
+                                lo.eq(Cat(1, lo[:31])),
+                            ]
+                    with m.Else():
+                        m.d.sync += Cat(lo, hi).eq(Cat(lo[1:], added))
+                    with m.If(count == 1):
+                        m.next = 'DONE'
+                with m.State('DONE'):
+                    m.d.comb += self.ready.eq(1)
+                    m.next = 'IDLE'
+
+            m.d.comb += [
+                product.eq(Cat(lo, hi[:32])),
+                quotient.eq(lo),
+                remainder.eq(hi),
+                neg_product.eq(neg[0] ^ neg[1]),
+                neg_quotient.eq((neg[0] ^ neg[1]) & ~zero),
+                neg_remainder.eq(neg[0]),
+            ]
+
+        result = Signal(64)
+        with m.Switch(funct):
+            with m.Case(MulDivFunc.MUL):
+                m.d.comb += result.eq(Mux(neg_product, -product, product))
+            with m.Case(MulDivFunc.MULH, MulDivFunc.MULHSU, MulDivFunc.MULHU):
+                m.d.comb += result.eq(Mux(neg_product, -product, product)[32:])
+            with m.Case(MulDivFunc.DIV, MulDivFunc.DIVU):
+                m.d.comb += result.eq(Mux(neg_quotient, -quotient, quotient))
+            with m.Case(MulDivFunc.REM, MulDivFunc.REMU):
+                m.d.comb += result.eq(Mux(neg_remainder, -remainder, remainder))
+        m.d.comb += self.rd_val.eq(result[:32])
+
+        return m
@@ -0,0 +1,451 @@
+from nmigen import *
+from nmigen.sim import *
+from core.alu import ALU
+from core.amo import AMOUnit, AmoFunc
+from core.branch import Branch
+from core.csr import CSRUnit, HpmEvent
+from core.decoder import Decoder, IType, Opcode
+from core.registers import Registers
+from core.memory import AddressDecoder, MemoryUnit
+from core.muldiv import MulDiv
+from core.predictor import BranchPredictor
+
+
+class PipelinedCPU(Elaboratable):
+    def __init__(self, reset_address=0x0000_0000, data=[], predictor=None, dcache=None,
+                 ram_words=256, ram=None, ram_base=0x0000_0000, mmio=(), rom_wait_states=0,
+                 muldiv=None):
+        self.reset_address = reset_address
+
+        self.ram = ram if ram is not None else MemoryUnit(ram_words, pipelined=True)
+        self.ram_base = ram_base
+        self.rom = MemoryUnit(len(data), data=data, pipelined=True, wait_states=rom_wait_states)
+        self.ibus = self.rom.new_bus()
+        # data side: the RAM (behind the cache if there is one) and (name, base, size, bus)
+        # MMIO regions
+        self.addr_decoder = AddressDecoder()
+        self.dcache = dcache
+        if dcache is not None:
+            dcache.mem_bus = self.ram.new_bus()
+            self.addr_decoder.add('ram', ram_base, self.ram.size, dcache.bus)
+        else:
+            self.addr_decoder.add('ram', ram_base, self.ram.size, self.ram.new_bus())
+        for name, base, size, bus in mmio:
+            self.addr_decoder.add(name, base, size, bus)
+        self.dbus = self.addr_decoder.bus
+        self.pc = Signal(32, reset=reset_address)
+        # the pc of the next fetch, a simulation can write it after a reset to start elsewhere
+        self.fetch_pc = Signal(32, reset=reset_address)
+        self.instruction = Signal(32)
+        self.decoder = Decoder()
+        self.regs = Registers()
+        self.alu = ALU()
+        self.muldiv = muldiv if muldiv is not None else MulDiv()
+        self.amo = AMOUnit()
+        self.branch = Branch()
+        self.csr = CSRUnit()
+        self.valid = Signal(1, reset=0)
+        self.predictor = predictor
+
+        self.stall = Signal()
+        self.flush = Signal()
+
+        # LR/SC: the word address reserved by lr.w
+        self.reservation = Signal(30)
+        self.reservation_valid = Signal()
+
+        # end of test: mtohost writes and ecall, strobed with valid
+        self.tohost = Signal(32)
+        self.tohost_we = Signal()
+        self.ecall = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.decoder = decoder = self.decoder
+        m.submodules.regs    = regs    = self.regs
+        m.submodules.alu     = alu     = self.alu
+        m.submodules.muldiv  = muldiv  = self.muldiv
+        m.submodules.amo     = amo     = self.amo
+        m.submodules.branch  = branch  = self.branch
+        m.submodules.csr     = csr     = self.csr
+        m.submodules.ram = self.ram
+        m.submodules.rom = self.rom
+        m.submodules.addr_decoder = self.addr_decoder
+        if self.dcache is not None:
+            m.submodules.dcache = self.dcache
+        if self.predictor is not None:
+            m.submodules.predictor = predictor = self.predictor
+
+        # Both buses are driven as pipelined masters: a request issued with
+        # stb is answered by ack on the following cycle, or later with wait
+        # states, and is resent until then.
+
+        # IF
+        f_pc = self.fetch_pc
+        f_adr = Signal(32)
+        f_next = Signal(32)
+        f_pred_taken = Signal()
+        f_pred_target = Signal(32)
+
+        # ID
+        d_pc = Signal(32)
+        d_pred_taken = Signal()
+        d_pred_target = Signal(32)
+        d_live = Signal()
+        d_hold = Signal()
+        d_hold_pc = Signal(32)
+        d_hold_inst = Signal(32)
+        d_hold_pred_taken = Signal()
+        d_hold_pred_target = Signal(32)
+        d_valid = Signal()
+        d_inst = Signal(32)
+        d_cur_pc = Signal(32)
+        d_cur_pred_taken = Signal()
+        d_cur_pred_target = Signal(32)
+        d_missing = Signal()
+        f_accept = Signal()
+
+        # EX
+        x_valid = Signal()
+        x_pc = Signal(32)
+        x_pred_taken = Signal()
+        x_pred_target = Signal(32)
+        x_inst = Signal(32)
+        x_itype = Signal(3)
+        x_funct3 = Signal(3)
+        x_funct1 = Signal()
+        x_imm = Signal(32)
+        x_rs1 = Signal(5)
+        x_rs2 = Signal(5)
+        x_rs1_en = Signal()
+        x_rs2_en = Signal()
+        x_rd = Signal(5)
+        x_rs1_val = Signal(32)
+        x_rs2_val = Signal(32)
+        x_result = Signal(32)
+        x_target = Signal(32)
+        x_taken = Signal()
+        x_next = Signal(32)
+        x_mispredict = Signal()
+        x_load = Signal()
+        x_store = Signal()
+        x_csr = Signal()
+        x_busy = Signal()
+
+        # MEM
+        m_valid = Signal()
+        m_pc = Signal(32)
+        m_inst = Signal(32)
+        m_rd = Signal(5)
+        m_result = Signal(32)
+        m_store_data = Signal(32)
+        m_load = Signal()
+        m_store = Signal()
+        m_csr = Signal()
+        m_sc = Signal()
+        m_sc_ok = Signal()
+
+        # WB
+        w_valid = Signal()
+        w_pc = Signal(32, reset=self.reset_address)
+        w_inst = Signal(32)
+        w_rd = Signal(5)
+        w_result = Signal(32)
+        w_store_data = Signal(32)
+        w_load = Signal()
+        w_store = Signal()
+        w_csr = Signal()
+        w_rd_data = Signal(32)
+        w_lr = Signal()
+        w_sc = Signal()
+        w_sc_ok = Signal()
+        w_rmw = Signal()
+        # an AMO's write, after its read was acked with amo_old
+        w_amo_write = Signal()
+        amo_old = Signal(32)
+
+        freeze = Signal()
+        load_use = Signal()
+        redirect = Signal()
+        rs1_en = Signal()
+        rs2_en = Signal()
+        pc_4 = Signal(32)
+
+        def amo_func(inst, funct):
+            return (inst[:7] == Opcode.AMO) & (inst[27:32] == funct)
+
+        m.d.comb += [
+            m_sc.eq(amo_func(m_inst, AmoFunc.SC)),
+            w_lr.eq(amo_func(w_inst, AmoFunc.LR)),
+            w_sc.eq(amo_func(w_inst, AmoFunc.SC)),
+            w_rmw.eq((w_inst[:7] == Opcode.AMO) & ~w_lr & ~w_sc),
+        ]
+
+        m.d.comb += [
+            # an AMO stays in WB from its read until its write is acked
+            freeze.eq(w_valid & (((w_load | w_store) & ~self.dbus.ack) |
+                                 (w_rmw & ~w_amo_write))),
+            self.stall.eq(freeze | load_use | x_busy),
+            self.flush.eq(redirect),
+        ]
+
+        # IF: resend the last request if it was not answered. A stalled request
+        # is not taken, unless it is the resent one the ROM is working on.
+        m.d.comb += [
+            d_missing.eq(d_live & ~d_hold & ~self.ibus.ack),
+            f_accept.eq(~self.ibus.stall | d_missing),
+            f_adr.eq(Mux(d_missing, d_pc, f_pc)),
+            f_next.eq(Mux(f_pred_taken, f_pred_target, f_adr + 4)),
+            self.ibus.adr.eq(f_adr),
+            self.ibus.cyc.eq(1),
+            self.ibus.stb.eq(1),
+        ]
+        if self.predictor is not None:
+            m.d.comb += [
+                predictor.pc.eq(f_adr),
+                f_pred_taken.eq(predictor.taken),
+                f_pred_target.eq(predictor.target),
+            ]
+        m.d.sync += [
+            d_pc.eq(f_adr),
+            d_pred_taken.eq(f_pred_taken),
+            d_pred_target.eq(f_pred_target),
+            d_live.eq(~redirect & f_accept),
+        ]
+        with m.If(redirect):
+            m.d.sync += f_pc.eq(x_next)
+        with m.Elif((d_missing | ~(d_valid & self.stall)) & f_accept):
+            m.d.sync += f_pc.eq(f_next)
+
+        # ID
+        m.d.comb += [
+            d_valid.eq(d_hold | (d_live & self.ibus.ack)),
+            d_inst.eq(Mux(d_hold, d_hold_inst, self.ibus.dat_r)),
+            d_cur_pc.eq(Mux(d_hold, d_hold_pc, d_pc)),
+            d_cur_pred_taken.eq(Mux(d_hold, d_hold_pred_taken, d_pred_taken)),
+            d_cur_pred_target.eq(Mux(d_hold, d_hold_pred_target, d_pred_target)),
+            decoder.inst.eq(d_inst),
+            load_use.eq(x_valid & (x_load | x_csr) & (x_rd != 0) &
+                        ((decoder.rs1 == x_rd) | (decoder.rs2 == x_rd))),
+            regs.rs1_addr.eq(Mux(freeze | x_busy, x_rs1, decoder.rs1)),
+            regs.rs2_addr.eq(Mux(freeze | x_busy, x_rs2, decoder.rs2)),
+        ]
+        m.d.sync += [
+            d_hold.eq(d_valid & self.stall & ~redirect),
+            d_hold_inst.eq(d_inst),
+            d_hold_pc.eq(d_cur_pc),
+            d_hold_pred_taken.eq(d_cur_pred_taken),
+            d_hold_pred_target.eq(d_cur_pred_target),
+        ]
+        with m.If(~freeze & ~x_busy):
+            m.d.sync += [
+                x_valid.eq(d_valid & ~load_use & ~redirect),
+                x_pc.eq(d_cur_pc),
+                x_pred_taken.eq(d_cur_pred_taken),
+                x_pred_target.eq(d_cur_pred_target),
+                x_inst.eq(d_inst),
+                x_itype.eq(decoder.itype),
+                x_funct3.eq(decoder.funct3),
+                x_funct1.eq(decoder.funct1),
+                x_imm.eq(decoder.imm),
+                x_rs1.eq(decoder.rs1),
+                x_rs2.eq(decoder.rs2),
+                x_rs1_en.eq(decoder.rs1_en),
+                x_rs2_en.eq(decoder.rs2_en),
+                x_rd.eq(decoder.rd),
+            ]
+
+        # EX: forward from MEM, then WB, then the register file
+        def forward(addr, data):
+            return Mux((addr != 0) & m_valid & ~m_load & ~m_csr & (m_rd == addr), m_result,
+                   Mux((addr != 0) & w_valid & (w_rd == addr), w_rd_data,
+                       data))
+
+        m.d.comb += [
+            pc_4.eq(x_pc + 4),
+            x_rs1_val.eq(forward(x_rs1, regs.rs1_data)),
+            x_rs2_val.eq(forward(x_rs2, regs.rs2_data)),
+            x_load.eq(x_itype == IType.LD),
+            x_store.eq(x_itype == IType.ST),
+            x_csr.eq(x_itype == IType.CSR),
+            alu.rs1_val.eq(Mux(rs1_en, x_rs1_val, x_pc)),
+            alu.rs2_val.eq(Mux(rs2_en, x_rs2_val, x_imm)),
+            branch.funct.eq(x_funct3),
+            branch.src1.eq(x_rs1_val),
+            branch.src2.eq(x_rs2_val),
+            # multi-cycle operations hold EX and send bubbles to MEM until they are ready
+            muldiv.start.eq(x_valid & (x_itype == IType.MULDIV)),
+            muldiv.funct.eq(x_funct3),
+            muldiv.rs1_val.eq(x_rs1_val),
+            muldiv.rs2_val.eq(x_rs2_val),
+            x_busy.eq(muldiv.start & ~muldiv.ready),
+            # jalr clears bit 0, branch and jal targets have it clear already
+            x_target.eq(Cat(C(0, 1), alu.rd_val[1:])),
+            x_next.eq(Mux(x_taken, x_target, pc_4)),
+            x_mispredict.eq((x_taken != x_pred_taken) |
+                            (x_taken & (x_target != x_pred_target))),
+            redirect.eq(x_valid & ~freeze & x_mispredict),
+        ]
+
+        if self.predictor is not None:
+            m.d.comb += [
+                predictor.update.eq(x_valid & ~freeze &
+                                    ((x_itype == IType.BR) | (x_itype == IType.J) |
+                                     (x_itype == IType.JR))),
+                predictor.update_pc.eq(x_pc),
+                predictor.update_itype.eq(x_itype),
+                predictor.update_rd.eq(x_rd),
+                predictor.update_rs1.eq(x_rs1),
+                predictor.update_taken.eq(x_taken),
+                predictor.update_target.eq(x_target),
+                predictor.update_mispredict.eq(x_mispredict),
+            ]
+
+        with m.Switch(x_itype):
+            with m.Case(IType.ALU):
+                m.d.comb += [
+                    alu.funct.eq(Cat(x_funct1, x_funct3)),
+                    rs1_en.eq(x_rs1_en),
+                    rs2_en.eq(x_rs2_en),
+                    x_result.eq(alu.rd_val),
+                ]
+            with m.Case(IType.J):
+                m.d.comb += [
+                    rs1_en.eq(0),
+                    rs2_en.eq(0),
+                    x_taken.eq(1),
+                    x_result.eq(pc_4),
+                ]
+            with m.Case(IType.JR):
+                m.d.comb += [
+                    rs1_en.eq(1),
+                    rs2_en.eq(0),
+                    x_taken.eq(1),
+                    x_result.eq(pc_4),
+                ]
+            with m.Case(IType.BR):
+                m.d.comb += [
+                    alu.funct.eq(0),
+                    rs1_en.eq(0),
+                    rs2_en.eq(0),
+                    x_taken.eq(branch.res),
+                ]
+            with m.Case(IType.ST, IType.LD):
+                m.d.comb += [
+                    alu.funct.eq(0),
+                    rs1_en.eq(1),
+                    rs2_en.eq(0),
+                    x_result.eq(alu.rd_val),
+                ]
+            with m.Case(IType.MULDIV):
+                m.d.comb += x_result.eq(muldiv.rd_val)
+
+        # CSRs are accessed in WB, the result carries the source operand there
+        with m.If(x_inst[:7] == Opcode.SYSTEM):
+            m.d.comb += x_result.eq(Mux(x_inst[14], x_rs1, x_rs1_val))
+
+        with m.If(~freeze):
+            m.d.sync += [
+                m_valid.eq(x_valid & ~x_busy),
+                m_pc.eq(x_pc),
+                m_inst.eq(x_inst),
+                m_rd.eq(x_rd),
+                m_result.eq(x_result),
+                m_store_data.eq(x_rs2_val),
+                m_load.eq(x_load),
+                m_store.eq(x_store),
+                m_csr.eq(x_csr),
+            ]
+
+        # MEM: sc.w only writes while the word is reserved, also by an lr.w committing
+        # in WB; a sc.w in WB has used up the reservation
+        m.d.comb += m_sc_ok.eq(m_sc & ~(w_valid & w_sc) &
+                               ((self.reservation_valid &
+                                 (self.reservation == m_result[2:])) |
+                                (w_valid & w_lr & (w_result[2:] == m_result[2:]))))
+
+        # while WB waits for its ack, its request is sent again; an AMO sends its write
+        # once the read is acked
+        m.d.comb += [
+            amo.funct.eq(w_inst[27:32]),
+            amo.mem_val.eq(amo_old),
+            amo.rs2_val.eq(w_store_data),
+        ]
+        with m.If(freeze):
+            m.d.comb += [
+                self.dbus.adr.eq(w_result),
+                self.dbus.dat_w.eq(Mux(w_amo_write, amo.rd_val, w_store_data)),
+                self.dbus.we.eq(w_store | w_amo_write),
+                self.dbus.stb.eq(~(w_rmw & ~w_amo_write & self.dbus.ack)),
+            ]
+        with m.Else():
+            m.d.comb += [
+                self.dbus.adr.eq(m_result),
+                self.dbus.dat_w.eq(m_store_data),
+                self.dbus.we.eq(m_valid & (m_store | m_sc_ok)),
+                self.dbus.stb.eq(m_valid & ((m_load & ~m_sc) | m_store | m_sc_ok)),
+            ]
+        m.d.comb += self.dbus.cyc.eq(1)
+
+        with m.If(w_valid & w_rmw & ~w_amo_write & self.dbus.ack):
+            m.d.sync += [
+                amo_old.eq(self.dbus.dat_r),
+                w_amo_write.eq(1),
+            ]
+        with m.If(self.valid):
+            m.d.sync += w_amo_write.eq(0)
+            with m.If(w_lr):
+                m.d.sync += [
+                    self.reservation.eq(w_result[2:]),
+                    self.reservation_valid.eq(1),
+                ]
+            with m.If(w_sc):
+                m.d.sync += self.reservation_valid.eq(0)
+
+        with m.If(~freeze):
+            m.d.sync += [
+                w_valid.eq(m_valid),
+                w_pc.eq(m_pc),
+                w_inst.eq(m_inst),
+                w_rd.eq(m_rd),
+                w_result.eq(m_result),
+                w_store_data.eq(m_store_data),
+                w_load.eq(m_load & ~m_sc),
+                w_store.eq(m_store | m_sc_ok),
+                w_csr.eq(m_csr),
+                w_sc_ok.eq(m_sc_ok),
+            ]
+
+        # WB
+        m.d.comb += [
+            w_rd_data.eq(Mux(w_rmw, amo_old,
+                         Mux(w_sc, w_sc_ok == 0,
+                         Mux(w_load, self.dbus.dat_r, Mux(w_csr, csr.rdata, w_result))))),
+            self.valid.eq(w_valid & ~freeze),
+            regs.rd_addr.eq(w_rd),
+            regs.rd_data.eq(w_rd_data),
+            regs.rd_we.eq(self.valid),
+            self.pc.eq(w_pc),
+            self.instruction.eq(w_inst),
+        ]
+
+        m.d.comb += [
+            csr.commit.eq(self.valid & w_csr),
+            csr.addr.eq(w_inst[20:32]),
+            csr.funct3.eq(w_inst[12:15]),
+            csr.rs1.eq(w_inst[15:20]),
+            csr.rs1_val.eq(w_result),
+            csr.retire.eq(self.valid),
+            csr.events[HpmEvent.FETCH_STALL].eq(d_missing),
+            csr.events[HpmEvent.MEM_WAIT].eq(freeze),
+            csr.events[HpmEvent.BRANCH_TAKEN].eq(x_valid & ~freeze & (x_itype == IType.BR) &
+                                                 x_taken),
+            csr.events[HpmEvent.LOAD_USE].eq(load_use & ~freeze),
+            csr.events[HpmEvent.MULDIV_WAIT].eq(x_busy & ~freeze),
+            self.tohost.eq(csr.tohost),
+            self.tohost_we.eq(csr.tohost_we),
+            self.ecall.eq(self.valid & (w_inst[:7] == Opcode.SYSTEM) & (w_inst[7:32] == 0)),
+        ]
+
+        return m
@@ -0,0 +1,134 @@
+from math import log2
+from nmigen import *
+from nmigen.sim import *
+from core.decoder import IType
+
+
+class BranchKind:
+    BRANCH = 0b00
+    JUMP   = 0b01
+    CALL   = 0b10
+    RET    = 0b11
+
+
+def is_link(reg):
+    return (reg == 1) | (reg == 5)
+
+
+class BranchPredictor(Elaboratable):
+    def __init__(self, bht_entries=256, btb_entries=64, ras_depth=8):
+        assert bht_entries & (bht_entries - 1) == 0
+        assert btb_entries & (btb_entries - 1) == 0
+        assert ras_depth > 0
+        self.bht_entries = bht_entries
+        self.btb_entries = btb_entries
+        self.ras_depth = ras_depth
+
+        self.bht_bits = int(log2(bht_entries))
+        self.btb_bits = int(log2(btb_entries))
+        self.tag_bits = 30 - self.btb_bits
+
+        # 2-bit saturating counters, strongly not taken on reset
+        self.bht = Memory(width=2, depth=bht_entries, init=[0b00] * bht_entries)
+        # valid | kind | tag | target
+        self.btb = Memory(width=1 + 2 + self.tag_bits + 32, depth=btb_entries)
+
+        # lookup, driven by fetch
+        self.pc = Signal(32)
+        self.taken = Signal()
+        self.target = Signal(32)
+
+        # update, driven by execute
+        self.update = Signal()
+        self.update_pc = Signal(32)
+        self.update_itype = Signal(3)
+        self.update_rd = Signal(5)
+        self.update_rs1 = Signal(5)
+        self.update_taken = Signal()
+        self.update_target = Signal(32)
+        self.update_mispredict = Signal()
+
+        self.predictions = Signal(32)
+        self.mispredictions = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.bht_rd = bht_rd = self.bht.read_port(domain="comb")
+        m.submodules.bht_up = bht_up = self.bht.read_port(domain="comb")
+        m.submodules.bht_wr = bht_wr = self.bht.write_port()
+        m.submodules.btb_rd = btb_rd = self.btb.read_port(domain="comb")
+        m.submodules.btb_wr = btb_wr = self.btb.write_port()
+
+        ras = Array(Signal(32, name=f"ras{i}") for i in range(self.ras_depth))
+        ras_ptr = Signal(range(self.ras_depth))
+        ras_count = Signal(range(self.ras_depth + 1))
+
+        # lookup
+        entry_target = Signal(32)
+        entry_tag = Signal(self.tag_bits)
+        entry_kind = Signal(2)
+        entry_valid = Signal()
+        hit = Signal()
+        m.d.comb += [
+            bht_rd.addr.eq(self.pc[2:2 + self.bht_bits]),
+            btb_rd.addr.eq(self.pc[2:2 + self.btb_bits]),
+            Cat(entry_target, entry_tag, entry_kind, entry_valid).eq(btb_rd.data),
+            hit.eq(entry_valid & (entry_tag == self.pc[2 + self.btb_bits:])),
+            self.taken.eq(hit & ((entry_kind != BranchKind.BRANCH) | bht_rd.data[1])),
+            self.target.eq(Mux((entry_kind == BranchKind.RET) & (ras_count != 0),
+                               ras[ras_ptr], entry_target)),
+        ]
+
+        # update
+        kind = Signal(2)
+        with m.Switch(self.update_itype):
+            with m.Case(IType.BR):
+                m.d.comb += kind.eq(BranchKind.BRANCH)
+            with m.Case(IType.J):
+                m.d.comb += kind.eq(Mux(is_link(self.update_rd),
+                                        BranchKind.CALL, BranchKind.JUMP))
+            with m.Case(IType.JR):
+                with m.If(is_link(self.update_rd)):
+                    m.d.comb += kind.eq(BranchKind.CALL)
+                with m.Elif(is_link(self.update_rs1)):
+                    m.d.comb += kind.eq(BranchKind.RET)
+                with m.Else():
+                    m.d.comb += kind.eq(BranchKind.JUMP)
+
+        counter = bht_up.data
+        m.d.comb += [
+            bht_up.addr.eq(self.update_pc[2:2 + self.bht_bits]),
+            bht_wr.addr.eq(self.update_pc[2:2 + self.bht_bits]),
+            bht_wr.data.eq(Mux(self.update_taken,
+                               Mux(counter == 0b11, counter, counter + 1),
+                               Mux(counter == 0b00, counter, counter - 1))),
+            btb_wr.addr.eq(self.update_pc[2:2 + self.btb_bits]),
+            btb_wr.data.eq(Cat(self.update_target,
+                               self.update_pc[2 + self.btb_bits:], kind, 1)),
+        ]
+
+        with m.If(self.update):
+            m.d.sync += self.predictions.eq(self.predictions + 1)
+            with m.If(self.update_mispredict):
+                m.d.sync += self.mispredictions.eq(self.mispredictions + 1)
+            with m.If(kind == BranchKind.BRANCH):
+                m.d.comb += bht_wr.en.eq(1)
+            # a conditional branch gets its BTB entry when its counter turns to taken, so a
+            # loop that is left after one taken pass is not predicted taken on the way out
+            with m.If(self.update_taken & ((kind != BranchKind.BRANCH) | bht_wr.data[1])):
+                m.d.comb += btb_wr.en.eq(1)
+            with m.If(kind == BranchKind.CALL):
+                m.d.sync += [
+                    ras_ptr.eq(Mux(ras_ptr == self.ras_depth - 1, 0, ras_ptr + 1)),
+                    ras[Mux(ras_ptr == self.ras_depth - 1, 0, ras_ptr + 1)]
+                        .eq(self.update_pc + 4),
+                    ras_count.eq(Mux(ras_count == self.ras_depth, ras_count, ras_count + 1)),
+                ]
+            with m.Elif((kind == BranchKind.RET) & (ras_count != 0)):
+                m.d.sync += [
+                    ras_ptr.eq(Mux(ras_ptr == 0, self.ras_depth - 1, ras_ptr - 1)),
+                    ras_count.eq(ras_count - 1),
+                ]
+
+        return m
@@ -0,0 +1,83 @@
+from nmigen import *
+from nmigen.sim import *
+from core.cpu import CPU
+from core.memory import MemoryUnit
+from core.muldiv import MulDiv
+
+
+class SoC(Elaboratable):
+    """harts FSM cores with mhartid 0 .. harts - 1 sharing one RAM.
+
+    ram is a MemoryUnit of ram_words unless given, e.g. a shared SparseMemory. The harts
+    reach the RAM through its Arbiter, and the ROM too when shared_rom is set; otherwise
+    each hart has its own copy of the ROM. Stores of one hart clear the LR/SC reservations
+    of the others on the same word.
+
+    arb_stalls counts, per hart, the cycles a request waited for another hart's access.
+    The end-of-test signals and registers are hart 0's, so the SoC runs the same harness
+    as a single CPU.
+    """
+
+    def __init__(self, harts=2, reset_address=0x0000_0000, data=[], shared_rom=True,
+                 ram_words=256, ram=None, ram_base=0x0000_0000, rom_wait_states=0,
+                 iterative_muldiv=False):
+        self.shared_rom = shared_rom
+        self.ram = ram if ram is not None else MemoryUnit(ram_words, pipelined=True)
+        self.ram_base = ram_base
+        rom = MemoryUnit(len(data), data=data, pipelined=True,
+                         wait_states=rom_wait_states) if shared_rom else None
+        self.harts = [CPU(reset_address=reset_address, data=data, ram=self.ram,
+                          ram_base=ram_base, rom=rom, rom_wait_states=rom_wait_states,
+                          muldiv=MulDiv(iterative=iterative_muldiv), hartid=i)
+                      for i in range(harts)]
+        self.roms = [rom] if shared_rom else [hart.rom for hart in self.harts]
+        self.rom = self.roms[0]
+
+        self.arb_stalls = [Signal(32, name=f"arb_stalls{i}") for i in range(harts)]
+
+        hart = self.harts[0]
+        self.pc = hart.pc
+        self.instruction = hart.instruction
+        self.regs = hart.regs
+        self.csr = hart.csr
+        self.valid = hart.valid
+        self.tohost = hart.tohost
+        self.tohost_we = hart.tohost_we
+        self.ecall = hart.ecall
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.ram = self.ram
+        if self.shared_rom:
+            m.submodules.rom = self.rom
+        for i, hart in enumerate(self.harts):
+            m.submodules[f"hart{i}"] = hart
+
+        # the shared RAM acks one hart at a time, so at most one store is shown
+        for hart in self.harts:
+            others = [other for other in self.harts if other is not hart]
+            m.d.comb += [
+                hart.snoop.eq(Cat(other.store for other in others).any()),
+                hart.snoop_adr.eq(0),
+            ]
+            for other in others:
+                with m.If(other.store):
+                    m.d.comb += hart.snoop_adr.eq(other.store_adr)
+
+        # A request is stalled by the arbiter of another hart's access until it is granted,
+        # and by the memory's wait states after it is taken
+        for hart, counter in zip(self.harts, self.arb_stalls):
+            buses = [hart.ram_bus] + ([hart.ibus] if self.shared_rom else [])
+            waiting = []
+            for bus in buses:
+                taken = Signal()
+                with m.If(bus.ack):
+                    m.d.sync += taken.eq(0)
+                with m.Elif(bus.cyc & bus.stb & ~bus.stall):
+                    m.d.sync += taken.eq(1)
+                waiting.append(bus.cyc & bus.stb & bus.stall & ~taken)
+            with m.If(Cat(*waiting).any()):
+                m.d.sync += counter.eq(counter + 1)
+
+        return m
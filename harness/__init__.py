@@ -0,0 +1,18 @@
+import importlib
+from .asm import AsmError, assemble, assemble_file, load_program
+from .cosim import Cosim, Divergence
+from .elf import ElfError, Image, load_image
+from .profile import Profiler
+from .session import Exit, Session, run_to_exit
+from .trace import Trace
+
+# names from the modules that also run with python -m are imported on first use, so the
+# package does not import those modules before runpy executes them
+_LAZY = {'Area': 'area', 'estimate': 'area', 'Checkpoint': 'checkpoint',
+         'fast_forward': 'checkpoint'}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
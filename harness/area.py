@@ -0,0 +1,474 @@
+import argparse
+import json
+import sys
+from collections import Counter
+import core
+from nmigen.back import rtlil
+from nmigen.hdl.ir import Fragment
+
+
+DESIGNS = [
+    'ALU()',
+    'Branch()',
+    'Decoder()',
+    'Expander()',
+    'Registers()',
+    'CSRUnit()',
+    'AMOUnit()',
+    'MulDiv()',
+    'MulDiv(iterative=True)',
+    'BranchPredictor()',
+    'CPU(data=[0] * 256)',
+    'PipelinedCPU(data=[0] * 256)',
+]
+
+# cells whose output is a register, i.e. the start of a path
+FLOPS = {'$dff', '$dffe', '$adff', '$adffe', '$sdff', '$sdffe', '$sdffce', '$dffsr', '$dffsre',
+         '$dlatch', '$adlatch'}
+# cells that only describe memory contents or checks, not logic
+IGNORED = {'$meminit', '$meminit_v2', '$assert', '$assume', '$cover', '$print'}
+
+
+def _clog2(n):
+    return max(0, n - 1).bit_length()
+
+
+def cell_delay(kind, params):
+    """Logic levels (about one 2-input gate each) from a cell's inputs to its output."""
+    a = params.get('A_WIDTH', 1)
+    b = params.get('B_WIDTH', 0)
+    w = max(a, b, params.get('Y_WIDTH', 1))
+    if kind == '$pos':
+        return 0
+    if kind in ('$not', '$and', '$or', '$xor', '$xnor', '$mux'):
+        return 1
+    if kind in ('$reduce_and', '$reduce_or', '$reduce_xor', '$reduce_xnor', '$reduce_bool',
+                '$logic_not'):
+        return max(1, _clog2(a))
+    if kind in ('$logic_and', '$logic_or', '$eq', '$ne', '$eqx', '$nex'):
+        return _clog2(max(a, b)) + 1
+    if kind in ('$add', '$sub', '$neg', '$lt', '$le', '$gt', '$ge', '$alu'):
+        # parallel-prefix carry
+        return _clog2(max(a, b)) + 2
+    if kind in ('$shl', '$shr', '$sshl', '$sshr', '$shift', '$shiftx'):
+        # one mux level per shift amount bit that matters
+        return max(1, min(b, _clog2(w) + 1))
+    if kind == '$mul':
+        # partial products, carry-save tree, final adder
+        return 3 * _clog2(max(a, b)) + 3
+    if kind in ('$div', '$mod', '$divfloor', '$modfloor'):
+        # one subtract and select per quotient bit
+        return a * (_clog2(a) + 3)
+    if kind == '$pmux':
+        return _clog2(params.get('S_WIDTH', 1)) + 1
+    if kind == '$bmux':
+        return params.get('S_WIDTH', 1)
+    if kind.startswith('$memrd'):
+        return params.get('ABITS', 1)
+    return 1
+
+
+class Area:
+    def __init__(self):
+        self.cells = Counter()
+        # output bits of the logic cells, a width-weighted size
+        self.bits = 0
+        self.ffs = 0
+        self.mem_bits = 0
+        self.depth = 0
+        self.path = []
+
+    def add(self, other):
+        self.cells.update(other.cells)
+        self.bits += other.bits
+        self.ffs += other.ffs
+        self.mem_bits += other.mem_bits
+
+    def to_dict(self):
+        return {
+            'cells': sum(self.cells.values()),
+            'bits': self.bits,
+            'ffs': self.ffs,
+            'mem_bits': self.mem_bits,
+            'depth': self.depth,
+            'types': dict(sorted(self.cells.items())),
+        }
+
+
+class _Module:
+    def __init__(self, name):
+        self.name = name
+        self.wires = {}
+        self.ports = {}
+        self.memories = {}
+        self.cells = []
+        self.connects = []
+        self.processes = []
+
+
+def _sigspec(tokens, i):
+    """Parse the sigspec at tokens[i] into [(wire, width)], constants have wire None."""
+    if tokens[i] == '{':
+        chunks = []
+        i += 1
+        while tokens[i] != '}':
+            chunk, i = _sigspec(tokens, i)
+            chunks += chunk
+        return chunks, i + 1
+    token = tokens[i]
+    i += 1
+    if token[0] not in '\\$':
+        return [(None, int(token.split("'")[0]) if "'" in token else 32)], i
+    if i < len(tokens) and tokens[i].startswith('['):
+        bits = tokens[i][1:-1].split(':')
+        return [(token, int(bits[0]) - int(bits[-1]) + 1)], i + 1
+    return [(token, None)], i
+
+
+def _parse_switch(lines, i):
+    stmts = []
+    while True:
+        tokens = lines[i].split()
+        i += 1
+        if tokens[0] in ('end', 'case', 'sync'):
+            return stmts, i - 1
+        if tokens[0] == 'assign':
+            lhs, j = _sigspec(tokens, 1)
+            rhs, _ = _sigspec(tokens, j)
+            stmts.append(('assign', lhs, rhs))
+        elif tokens[0] == 'switch':
+            test, _ = _sigspec(tokens, 1)
+            cases = []
+            while lines[i].split()[0] != 'end':
+                if lines[i].split()[0] == 'case':
+                    case, i = _parse_switch(lines, i + 1)
+                    cases.append(case)
+                else:
+                    i += 1
+            stmts.append(('switch', test, cases))
+            i += 1
+
+
+def parse(il_text):
+    """Parse the RTLIL text of a design into {module name: _Module}."""
+    lines = [line for line in il_text.splitlines()
+             if line.strip() and not line.strip().startswith('attribute')]
+    modules = {}
+    module = None
+    i = 0
+    while i < len(lines):
+        tokens = lines[i].split()
+        i += 1
+        kind = tokens[0]
+        if kind == 'module':
+            module = modules[tokens[1]] = _Module(tokens[1])
+        elif kind == 'wire':
+            width = 1
+            direction = None
+            for j, token in enumerate(tokens[1:-1], 1):
+                if token == 'width':
+                    width = int(tokens[j + 1])
+                elif token in ('input', 'output', 'inout'):
+                    direction = token
+            module.wires[tokens[-1]] = width
+            if direction:
+                module.ports[tokens[-1]] = direction
+        elif kind == 'memory':
+            width = int(tokens[tokens.index('width') + 1])
+            size = int(tokens[tokens.index('size') + 1])
+            module.memories[tokens[-1]] = (width, size)
+        elif kind == 'cell':
+            params = {}
+            conns = {}
+            while lines[i].split()[0] != 'end':
+                fields = lines[i].split()
+                if fields[0] == 'parameter':
+                    value = fields[-1]
+                    params[fields[-2][1:]] = int(value) if value.lstrip('-').isdigit() else value
+                elif fields[0] == 'connect':
+                    conns[fields[1]] = _sigspec(fields, 2)[0]
+                i += 1
+            module.cells.append((tokens[1], tokens[2], params, conns))
+            i += 1
+        elif kind == 'connect':
+            lhs, j = _sigspec(tokens, 1)
+            rhs, _ = _sigspec(tokens, j)
+            module.connects.append((lhs, rhs))
+        elif kind == 'process':
+            stmts, i = _parse_switch(lines, i)
+            syncs = []
+            while lines[i].split()[0] != 'end':
+                fields = lines[i].split()
+                if fields[0] == 'sync':
+                    syncs.append((fields[1], []))
+                elif fields[0] == 'update':
+                    lhs, j = _sigspec(fields, 1)
+                    rhs, _ = _sigspec(fields, j)
+                    syncs[-1][1].append((lhs, rhs))
+                i += 1
+            module.processes.append((stmts, syncs))
+            i += 1
+    return modules
+
+
+class _Graph:
+    """Combinational edges between the wires of a flattened design."""
+
+    def __init__(self):
+        self.preds = {}
+
+    def edge(self, src, dst, delay):
+        if src != dst:
+            self.preds.setdefault(dst, []).append((src, delay))
+
+    def longest_path(self, prefix):
+        """Return (depth, [(node, arrival)]) of the longest path between nodes under prefix.
+
+        The graph is built per wire, not per bit, so a loop through different bits of a wire
+        is cut where it is found.
+        """
+        def inside(node):
+            return not prefix or node[0] == prefix or node[0].startswith(prefix + '.')
+
+        arrival = {}
+        via = {}
+        for start in self.preds:
+            if not inside(start) or start in arrival:
+                continue
+            stack = [(start, iter(self.preds[start]))]
+            pending = {start}
+            while stack:
+                node, preds = stack[-1]
+                for src, _ in preds:
+                    if inside(src) and src not in arrival and src not in pending:
+                        pending.add(src)
+                        stack.append((src, iter(self.preds.get(src, ()))))
+                        break
+                else:
+                    stack.pop()
+                    pending.discard(node)
+                    arrival[node] = 0
+                    for src, delay in self.preds.get(node, ()):
+                        if src in arrival and inside(src) and \
+                                (node not in via or arrival[src] + delay > arrival[node]):
+                            arrival[node] = arrival[src] + delay
+                            via[node] = src
+        if not arrival:
+            return 0, []
+        node = max(arrival, key=arrival.get)
+        path = [node]
+        while path[-1] in via:
+            path.append(via[path[-1]])
+        return arrival[node], [(node, arrival[node]) for node in reversed(path)]
+
+
+def _width(module, chunks):
+    return sum(width if width is not None else module.wires.get(wire, 1)
+               for wire, width in chunks)
+
+
+def _wires(chunks):
+    return {wire for wire, _ in chunks if wire is not None}
+
+
+def _process(module, stmts, env, area):
+    """Evaluate a process body into {dest wire: {src wire: delay}}."""
+    for stmt in stmts:
+        if stmt[0] == 'assign':
+            _, lhs, rhs = stmt
+            srcs = _wires(rhs)
+            for wire, width in lhs:
+                if wire is None:
+                    continue
+                if width is None and len(lhs) == 1:
+                    env[wire] = dict.fromkeys(srcs, 0)
+                else:
+                    merged = dict(env.get(wire, {}))
+                    for src in srcs:
+                        merged.setdefault(src, 0)
+                    env[wire] = merged
+        else:
+            _, test, cases = stmt
+            test_width = _width(module, test)
+            compare = _clog2(test_width) + 1 if test_width > 1 else 0
+            results = [_process(module, case, dict(env), area) for case in cases]
+            changed = {}
+            for result in results:
+                for dest, srcs in result.items():
+                    if srcs is not env.get(dest):
+                        changed.setdefault(dest, []).append(srcs)
+            for dest, alternatives in changed.items():
+                levels = max(1, _clog2(len(alternatives) + 1))
+                merged = {}
+                for srcs in alternatives + [env.get(dest, {})]:
+                    for src, delay in srcs.items():
+                        merged[src] = max(merged.get(src, 0), delay + levels)
+                for src in _wires(test):
+                    merged[src] = max(merged.get(src, 0), compare + levels)
+                env[dest] = merged
+                area.cells['$mux' if len(alternatives) == 1 else '$pmux'] += 1
+                area.bits += module.wires.get(dest, 1)
+    return env
+
+
+def _elaborate(modules, name, path, graph, areas):
+    module = modules[name]
+    area = Area()
+    local = Area()
+    areas[path] = area
+
+    def node(wire):
+        return (path, wire)
+
+    for width, size in module.memories.values():
+        local.mem_bits += width * size
+    for kind, cell, params, conns in module.cells:
+        if kind in modules:
+            child = path + ('.' if path else '') + cell.lstrip('\\')
+            area.add(_elaborate(modules, kind, child, graph, areas))
+            ports = modules[kind].ports
+            for port, chunks in conns.items():
+                for wire in _wires(chunks):
+                    if ports.get(port) == 'output':
+                        graph.edge((child, port), node(wire), 0)
+                    else:
+                        graph.edge(node(wire), (child, port), 0)
+            continue
+        if kind in IGNORED:
+            continue
+        local.cells[kind] += 1
+        if kind in FLOPS:
+            local.ffs += params.get('WIDTH', 1)
+            continue
+        if kind.startswith('$mem') and 'SIZE' in params:
+            local.mem_bits += params.get('WIDTH', 1) * params['SIZE']
+        outputs = {'Y'}
+        if kind.startswith('$memrd'):
+            # a synchronous read port is a register
+            if params.get('CLK_ENABLE'):
+                continue
+            outputs = {'DATA'}
+        elif kind.startswith('$mem'):
+            continue
+        local.bits += params.get('Y_WIDTH', params.get('WIDTH', 1))
+        delay = cell_delay(kind, params)
+        srcs = set()
+        for port, chunks in conns.items():
+            if port[1:] not in outputs:
+                srcs |= _wires(chunks)
+        for port in outputs:
+            for dst in _wires(conns.get('\\' + port, [])):
+                for src in srcs:
+                    graph.edge(node(src), node(dst), delay)
+    for lhs, rhs in module.connects:
+        for dst in _wires(lhs):
+            for src in _wires(rhs):
+                graph.edge(node(src), node(dst), 0)
+    for stmts, syncs in module.processes:
+        env = _process(module, stmts, {}, local)
+        for dest, srcs in env.items():
+            for src, delay in srcs.items():
+                graph.edge(node(src), node(dest), delay)
+        for kind, updates in syncs:
+            if kind == 'init':
+                continue
+            for lhs, rhs in updates:
+                if kind == 'always':
+                    for dst in _wires(lhs):
+                        for src in _wires(rhs):
+                            graph.edge(node(src), node(dst), 0)
+                else:
+                    local.cells['$dff'] += 1
+                    local.ffs += _width(module, lhs)
+    area.add(local)
+    return area
+
+
+def estimate(design, name='top'):
+    """Return {module path: Area} for an Elaboratable, '' being the design itself.
+
+    The design is lowered with the RTLIL backend. Cells are counted per module the way a
+    synthesis tool sees them after lowering processes: a $mux or $pmux per switched signal
+    and a $dff per register. Areas include the submodules; depth is the longest path in logic
+    levels (see cell_delay) from a register or input to a register or output.
+    """
+    fragment = Fragment.get(design, None).prepare()
+    il_text, _ = rtlil.convert_fragment(fragment, name)
+    modules = parse(il_text)
+    graph = _Graph()
+    areas = {}
+    _elaborate(modules, '\\' + name, '', graph, areas)
+    for path, area in areas.items():
+        area.depth, area.path = graph.longest_path(path)
+    return areas
+
+
+def _delta(value, old):
+    if old is None or value == old:
+        return str(value)
+    return f'{value}({value - old:+d})'
+
+
+def report(results, baseline=None, cells=False, path=False):
+    """Print a table of results {design: {module path: Area dict}}, return the regressions."""
+    regressions = []
+    print(f"{'design':40s} {'cells':>12s} {'bits':>12s} {'ffs':>10s} {'mem bits':>12s} "
+          f"{'depth':>10s}")
+    for design, areas in results.items():
+        old_areas = (baseline or {}).get(design, {})
+        for module, area in areas.items():
+            old = old_areas.get(module, {})
+            label = design if not module else '  ' * (module.count('.') + 1) + module.split('.')[-1]
+            print(f"{label:40s} " + ' '.join(
+                f'{_delta(area[key], old.get(key)):>{width}s}'
+                for key, width in (('cells', 12), ('bits', 12), ('ffs', 10), ('mem_bits', 12),
+                                   ('depth', 10))))
+            for key in ('cells', 'bits', 'ffs', 'mem_bits', 'depth'):
+                if key in old and area[key] > old[key]:
+                    regressions.append(f'{design} {module or "(top)"} {key} {old[key]} -> '
+                                       f'{area[key]}')
+            if cells:
+                print(' ' * 42 + ' '.join(f'{kind}:{count}'
+                                          for kind, count in area['types'].items()))
+        if path:
+            print('  critical path: ' + ' -> '.join(
+                f'{module + "." if module else ""}{wire}@{arrival}'
+                for (module, wire), arrival in areas['']['path']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Estimate the area and logic depth of designs from their RTLIL.')
+    parser.add_argument('designs', nargs='*', default=DESIGNS,
+                        help='expressions over the core package, default: ' + ', '.join(DESIGNS))
+    parser.add_argument('--cells', action='store_true', help='print the cell counts by type')
+    parser.add_argument('--path', action='store_true',
+                        help="print the named wires on each design's critical path")
+    parser.add_argument('--json', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='compare with a previous --json, exit 1 if anything grew')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for design in args.designs:
+        areas = estimate(eval(design, vars(core)))
+        results[design] = {module: dict(area.to_dict(), path=area.path) if not module else
+                           area.to_dict() for module, area in areas.items()}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['designs']
+    regressions = report(results, baseline, args.cells, args.path)
+    if args.json:
+        for areas in results.values():
+            areas[''].pop('path')
+        with open(args.json, 'w') as f:
+            json.dump({'designs': results}, f, indent=2)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
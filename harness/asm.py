@@ -0,0 +1,962 @@
+import ast
+import operator
+import os
+import re
+from core.alu import AluFunc
+from core.branch import BRANCH
+from core.compressed import expand
+from core.decoder import Opcode
+from harness.elf import PF_R, PF_W, PF_X, Image, Segment, load_image
+
+
+MACRO_DIR = os.path.join(os.path.dirname(__file__), '..', 'programs', 'assembly', 'macros')
+
+# where programs/assembly/link.ld puts the sections
+TEXT_BASE = 0x200
+DATA_ALIGN = 0x1000
+
+
+class AsmError(Exception):
+    pass
+
+
+REG_NAMES = {
+    'zero': 0, 'ra': 1, 'sp': 2, 'gp': 3, 'tp': 4,
+    't0': 5, 't1': 6, 't2': 7, 's0': 8, 'fp': 8, 's1': 9,
+    'a0': 10, 'a1': 11, 'a2': 12, 'a3': 13, 'a4': 14, 'a5': 15, 'a6': 16, 'a7': 17,
+    's2': 18, 's3': 19, 's4': 20, 's5': 21, 's6': 22, 's7': 23, 's8': 24, 's9': 25,
+    's10': 26, 's11': 27, 't3': 28, 't4': 29, 't5': 30, 't6': 31,
+}
+REG_NAMES.update({f'x{i}': i for i in range(32)})
+
+CSR_NAMES = {
+    'mtohost': 0x780, 'mfromhost': 0x781,
+    'cycle': 0xC00, 'time': 0xC01, 'instret': 0xC02,
+    'cycleh': 0xC80, 'timeh': 0xC81, 'instreth': 0xC82,
+    'mcycle': 0xB00, 'minstret': 0xB02, 'mcycleh': 0xB80, 'minstreth': 0xB82,
+    'mhartid': 0xF14,
+}
+CSR_NAMES.update({f'mhpmcounter{i}': 0xB00 + i for i in range(3, 32)})
+CSR_NAMES.update({f'hpmcounter{i}': 0xC00 + i for i in range(3, 32)})
+
+OPCODE_SYSTEM = 0b1110011
+OPCODE_FENCE = 0b0001111
+
+R_OPS = {
+    'add': AluFunc.ADD, 'sub': AluFunc.SUB, 'sll': AluFunc.SLL, 'slt': AluFunc.SLT,
+    'sltu': AluFunc.SLTU, 'xor': AluFunc.XOR, 'srl': AluFunc.SRL, 'sra': AluFunc.SRA,
+    'or': AluFunc.OR, 'and': AluFunc.AND,
+}
+I_OPS = {
+    'addi': AluFunc.ADD, 'slti': AluFunc.SLT, 'sltiu': AluFunc.SLTU, 'xori': AluFunc.XOR,
+    'ori': AluFunc.OR, 'andi': AluFunc.AND,
+}
+SHIFT_OPS = {'slli': AluFunc.SLL, 'srli': AluFunc.SRL, 'srai': AluFunc.SRA}
+M_OPS = {'mul': 0, 'mulh': 1, 'mulhsu': 2, 'mulhu': 3, 'div': 4, 'divu': 5, 'rem': 6, 'remu': 7}
+BR_OPS = {
+    'beq': BRANCH.BEQ, 'bne': BRANCH.BNE, 'blt': BRANCH.BLT, 'bge': BRANCH.BGE,
+    'bltu': BRANCH.BLTU, 'bgeu': BRANCH.BGEU,
+}
+BR_SWAPPED = {'bgt': 'blt', 'ble': 'bge', 'bgtu': 'bltu', 'bleu': 'bgeu'}
+BR_ZERO = {'beqz': ('beq', False), 'bnez': ('bne', False), 'bltz': ('blt', False),
+           'bgez': ('bge', False), 'blez': ('bge', True), 'bgtz': ('blt', True)}
+LD_OPS = {'lb': 0b000, 'lh': 0b001, 'lw': 0b010, 'lbu': 0b100, 'lhu': 0b101}
+ST_OPS = {'sb': 0b000, 'sh': 0b001, 'sw': 0b010}
+CSR_OPS = {'csrrw': 0b001, 'csrrs': 0b010, 'csrrc': 0b011,
+           'csrrwi': 0b101, 'csrrsi': 0b110, 'csrrci': 0b111}
+AMO_OPS = {'amoadd.w': 0b00000, 'amoswap.w': 0b00001, 'amoxor.w': 0b00100,
+           'amoor.w': 0b01000, 'amoand.w': 0b01100, 'amomin.w': 0b10000,
+           'amomax.w': 0b10100, 'amominu.w': 0b11000, 'amomaxu.w': 0b11100}
+OPCODE_AMO = 0b0101111
+
+# compressed mnemonics as the base instruction they expand to, {n} is the nth operand
+C_OPS = {
+    'c.addi4spn': ('addi', '{0}, sp, {2}'), 'c.lw': ('lw', '{0}, {1}'),
+    'c.sw': ('sw', '{0}, {1}'), 'c.nop': ('addi', 'zero, zero, 0'),
+    'c.addi': ('addi', '{0}, {0}, {1}'), 'c.jal': ('jal', 'ra, {0}'),
+    'c.li': ('addi', '{0}, zero, {1}'), 'c.addi16sp': ('addi', 'sp, sp, {1}'),
+    'c.lui': ('lui', '{0}, {1}'), 'c.srli': ('srli', '{0}, {0}, {1}'),
+    'c.srai': ('srai', '{0}, {0}, {1}'), 'c.andi': ('andi', '{0}, {0}, {1}'),
+    'c.sub': ('sub', '{0}, {0}, {1}'), 'c.xor': ('xor', '{0}, {0}, {1}'),
+    'c.or': ('or', '{0}, {0}, {1}'), 'c.and': ('and', '{0}, {0}, {1}'),
+    'c.j': ('jal', 'zero, {0}'), 'c.beqz': ('beq', '{0}, zero, {1}'),
+    'c.bnez': ('bne', '{0}, zero, {1}'), 'c.slli': ('slli', '{0}, {0}, {1}'),
+    'c.lwsp': ('lw', '{0}, {1}'), 'c.jr': ('jalr', 'zero, 0({0})'),
+    'c.mv': ('add', '{0}, zero, {1}'), 'c.ebreak': ('ebreak', ''),
+    'c.jalr': ('jalr', 'ra, 0({0})'), 'c.add': ('add', '{0}, {0}, {1}'),
+    'c.swsp': ('sw', '{0}, {1}'),
+}
+# directives that leave the image as it is; .option rvc is one, c.* mnemonics are the only
+# instructions that assemble to compressed encodings
+NOP_DIRECTIVES = {'.globl', '.global', '.local', '.weak', '.type', '.size', '.file', '.ident',
+                  '.option', '.attribute', '.end'}
+STRING_DIRECTIVES = {'.ascii': b'', '.asciz': b'\0', '.string': b'\0'}
+
+# {32-bit instruction: its compressed encoding}, built on first use
+_compress = None
+
+
+def r_type(opcode, rd, funct3, rs1, rs2, funct7):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+
+def i_type(opcode, rd, funct3, rs1, imm):
+    return ((imm & 0xfff) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+
+def s_type(opcode, funct3, rs1, rs2, imm):
+    return (((imm >> 5) & 0x7f) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) \
+        | ((imm & 0x1f) << 7) | opcode
+
+
+def b_type(opcode, funct3, rs1, rs2, imm):
+    return (((imm >> 12) & 1) << 31) | (((imm >> 5) & 0x3f) << 25) | (rs2 << 20) \
+        | (rs1 << 15) | (funct3 << 12) | (((imm >> 1) & 0xf) << 8) \
+        | (((imm >> 11) & 1) << 7) | opcode
+
+
+def u_type(opcode, rd, imm):
+    return (imm & 0xfffff000) | (rd << 7) | opcode
+
+
+def j_type(opcode, rd, imm):
+    return (((imm >> 20) & 1) << 31) | (((imm >> 1) & 0x3ff) << 21) \
+        | (((imm >> 11) & 1) << 20) | (((imm >> 12) & 0xff) << 12) | (rd << 7) | opcode
+
+
+def hi_lo(value):
+    value &= 0xffffffff
+    lo = ((value & 0xfff) ^ 0x800) - 0x800
+    hi = (value - lo) & 0xffffffff
+    return hi, lo
+
+
+# --------------------------------------------------------------------------
+# Preprocessor: the subset of cpp the test macros use (#include, #define with
+# arguments, __VA_ARGS__-style "code..." parameters, ## pasting, #if[n]def/#elif/#else,
+# #error)
+
+
+DIRECTIVES = {'include', 'define', 'undef', 'if', 'ifdef', 'ifndef', 'elif', 'else', 'endif',
+              'error'}
+
+_IDENT = re.compile(r'[A-Za-z_]\w*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_LINE_MARKER = re.compile(r'#\s*(\d+)\s+"(.*)"\s*$')
+
+
+def _depth(lines):
+    # parentheses still open, ignoring strings and '#' comments
+    depth = 0
+    for line in lines:
+        line = _STRING.sub('', line).split('#', 1)[0]
+        depth += line.count('(') - line.count(')')
+    return depth
+
+
+_C_TOKEN = re.compile(r'\s*(?:(0[xX][0-9a-fA-F]+|\d+)[uUlL]*|([A-Za-z_]\w*)|'
+                      r'(<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%<>&^|!~()?:]))')
+# C binary operators by precedence, the comparisons and logical operators give 0 or 1
+_C_BINOPS = {
+    '*': (10, operator.mul), '/': (10, lambda a, b: _div(a, b)),
+    '%': (10, lambda a, b: _mod(a, b)), '+': (9, operator.add), '-': (9, operator.sub),
+    '<<': (8, operator.lshift), '>>': (8, operator.rshift),
+    '<': (7, lambda a, b: int(a < b)), '<=': (7, lambda a, b: int(a <= b)),
+    '>': (7, lambda a, b: int(a > b)), '>=': (7, lambda a, b: int(a >= b)),
+    '==': (6, lambda a, b: int(a == b)), '!=': (6, lambda a, b: int(a != b)),
+    '&': (5, operator.and_), '^': (4, operator.xor), '|': (3, operator.or_),
+    '&&': (2, lambda a, b: int(bool(a and b))), '||': (1, lambda a, b: int(bool(a or b))),
+}
+_C_UNOPS = {'-': operator.neg, '+': operator.pos, '~': operator.invert,
+            '!': lambda a: int(not a)}
+
+
+def _c_value(text):
+    """Value of a C constant expression, identifiers left in it are 0 as in cpp #if."""
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = _C_TOKEN.match(text, pos)
+        if m is None:
+            raise ValueError(text[pos:])
+        if m.group(1):
+            number = m.group(1)
+            tokens.append(int(number, 8) if re.fullmatch(r'0\d+', number) else int(number, 0))
+        elif m.group(2):
+            tokens.append(0)
+        else:
+            tokens.append(m.group(3))
+        pos = m.end()
+    tokens.append(None)
+    pos = 0
+
+    def take(expected=None):
+        nonlocal pos
+        token = tokens[pos]
+        if expected is not None and token != expected:
+            raise ValueError(f'expected {expected!r}')
+        pos += 1
+        return token
+
+    def unary():
+        token = take()
+        if token == '(':
+            value = ternary()
+            take(')')
+            return value
+        if token in _C_UNOPS:
+            return _C_UNOPS[token](unary())
+        if isinstance(token, int):
+            return token
+        raise ValueError(f'unexpected {token!r}')
+
+    def binary(level):
+        left = unary()
+        while tokens[pos] in _C_BINOPS and _C_BINOPS[tokens[pos]][0] >= level:
+            prec, op = _C_BINOPS[take()]
+            left = op(left, binary(prec + 1))
+        return left
+
+    def ternary():
+        cond = binary(1)
+        if tokens[pos] != '?':
+            return cond
+        take('?')
+        a = ternary()
+        take(':')
+        b = ternary()
+        return a if cond else b
+
+    value = ternary()
+    if tokens[pos] is not None:
+        raise ValueError(f'unexpected {tokens[pos]!r}')
+    return value
+
+
+class Macro:
+    def __init__(self, name, params, body):
+        self.name = name
+        self.params = params
+        self.body = body
+
+
+class Preprocessor:
+    def __init__(self, include_dirs=(), defines=None):
+        self.include_dirs = list(include_dirs)
+        self.macros = {}
+        for name, value in (defines or {}).items():
+            self.macros[name] = Macro(name, None, str(value))
+
+    def run(self, path):
+        with open(path) as f:
+            return self.process(f.read(), os.path.dirname(path), path)
+
+    def process(self, text, cwd='.', name='<source>'):
+        # every block of output is preceded by a cpp line marker, '# <line> "<file>"', so the
+        # assembler can name the source line after directives, includes and continuations
+        text = re.sub(r'/\*.*?\*/', lambda m: ' ' + '\n' * m.group().count('\n'), text,
+                      flags=re.S)
+        out = []
+        pending = []
+        start = 0
+        # per #if level: whether its lines are assembled, and whether a branch was taken
+        active = [True]
+        taken = [True]
+        lines = text.split('\n')
+        lineno = 0
+        while lineno < len(lines):
+            first = lineno
+            line = lines[lineno]
+            lineno += 1
+            while line.endswith('\\') and lineno < len(lines):
+                line = line[:-1] + ' ' + lines[lineno]
+                lineno += 1
+            line = re.sub(r'//.*', '', line)
+            stripped = line.strip()
+            m = re.match(r'#\s*(\w+)(.*)', stripped)
+            if m and m.group(1) in DIRECTIVES:
+                if pending:
+                    self.flush(out, pending, start, name)
+                    pending = []
+                self.directive(m.group(1), m.group(2).strip(), active, taken, out, cwd,
+                               f'{name}:{first + 1}')
+            elif re.match(r'#[A-Za-z_]', stripped) and all(active):
+                raise AsmError(f'{name}:{first + 1}: unknown directive {stripped.split()[0]!r}')
+            elif stripped.startswith('#'):
+                # '# text' is an assembly comment
+                continue
+            elif all(active):
+                if not pending:
+                    start = first + 1
+                pending.append(line)
+                # a macro invocation can run over several lines, it is expanded once its
+                # parentheses close
+                if _depth(pending) <= 0:
+                    self.flush(out, pending, start, name)
+                    pending = []
+        if pending:
+            self.flush(out, pending, start, name)
+        if len(active) > 1:
+            raise AsmError(f'{name}:{len(lines)}: #if without #endif')
+        return '\n'.join(out)
+
+    def flush(self, out, pending, line, name):
+        out.append(f'# {line} "{name}"')
+        out.append(self.expand('\n'.join(pending)))
+
+    def directive(self, name, rest, active, taken, out, cwd, where):
+        if name in ('elif', 'else', 'endif') and len(active) == 1:
+            raise AsmError(f'{where}: #{name} without #if')
+        if name == 'endif':
+            active.pop()
+            taken.pop()
+            return
+        if name == 'else':
+            active[-1] = all(active[:-1]) and not taken[-1]
+            taken[-1] = True
+            return
+        if name == 'elif':
+            if taken[-1] or not all(active[:-1]):
+                active[-1] = False
+            else:
+                active[-1] = taken[-1] = self.condition(rest, where)
+            return
+        if name in ('if', 'ifdef', 'ifndef'):
+            # a nested #if in a skipped branch is not evaluated, and none of its branches is
+            if not all(active):
+                active.append(False)
+                taken.append(True)
+                return
+            if name == 'if':
+                cond = self.condition(rest, where)
+            else:
+                cond = (rest.split()[0] in self.macros) == (name == 'ifdef')
+            active.append(cond)
+            taken.append(cond)
+            return
+        if not all(active):
+            return
+        if name == 'error':
+            raise AsmError(f'{where}: #error {rest}')
+        if name == 'include':
+            fname = rest.strip('"<>')
+            for d in [cwd] + self.include_dirs:
+                path = os.path.join(d, fname)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        out.append(self.process(f.read(), os.path.dirname(path), path))
+                    break
+            else:
+                raise AsmError(f'{where}: cannot find {fname}')
+        elif name == 'undef':
+            self.macros.pop(rest.split()[0], None)
+        elif name == 'define':
+            m = re.match(r'([A-Za-z_]\w*)(\(([^)]*)\))?\s*(.*)', rest, flags=re.S)
+            params = None
+            if m.group(2) is not None:
+                params = [p.strip() for p in m.group(3).split(',') if p.strip()]
+            self.macros[m.group(1)] = Macro(m.group(1), params, m.group(4).strip())
+
+    def condition(self, rest, where):
+        # defined X and defined(X) are replaced before the macros in the line are expanded
+        text = re.sub(r'\bdefined\s*(?:\(\s*([A-Za-z_]\w*)\s*\)|([A-Za-z_]\w*))',
+                      lambda m: str(int((m.group(1) or m.group(2)) in self.macros)), rest)
+        try:
+            return bool(_c_value(self.expand(text)))
+        except (ValueError, ZeroDivisionError):
+            raise AsmError(f'{where}: bad #if expression {rest!r}') from None
+
+    def expand(self, text, disabled=frozenset()):
+        out = []
+        pos = 0
+        while True:
+            m = _IDENT.search(text, pos)
+            if m is None:
+                out.append(text[pos:])
+                break
+            out.append(text[pos:m.start()])
+            name = m.group(0)
+            pos = m.end()
+            macro = self.macros.get(name)
+            if macro is None or name in disabled:
+                out.append(name)
+                continue
+            if macro.params is None:
+                out.append(self.expand(macro.body, disabled | {name}))
+                continue
+            j = pos
+            while j < len(text) and text[j] in ' \t\n':
+                j += 1
+            if j >= len(text) or text[j] != '(':
+                out.append(name)
+                continue
+            args, pos = self.collect_args(text, j)
+            out.append(self.expand(self.substitute(macro, args), disabled | {name}))
+        return ''.join(out)
+
+    def collect_args(self, text, start):
+        depth = 0
+        args = []
+        cur = []
+        for i in range(start, len(text)):
+            c = text[i]
+            if c == '(':
+                depth += 1
+                if depth == 1:
+                    continue
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    args.append(''.join(cur).strip())
+                    return args, i + 1
+            elif c == ',' and depth == 1:
+                args.append(''.join(cur).strip())
+                cur = []
+                continue
+            cur.append(c)
+        raise AsmError('unterminated macro invocation')
+
+    def substitute(self, macro, args):
+        params = list(macro.params)
+        values = {}
+        for i, p in enumerate(params):
+            if p.endswith('...'):
+                values[p[:-3]] = ', '.join(args[i:])
+            else:
+                values[p] = args[i] if i < len(args) else ''
+        body = macro.body
+
+        def repl(m):
+            name = m.group(0)
+            if name not in values:
+                return name
+            before = body[:m.start()].rstrip()
+            after = body[m.end():].lstrip()
+            if before.endswith('##') or after.startswith('##'):
+                return values[name]
+            return self.expand(values[name])
+        body = _IDENT.sub(repl, body)
+        return re.sub(r'\s*##\s*', '', body)
+
+
+# --------------------------------------------------------------------------
+# Assembler
+
+
+def _div(a, b):
+    # C and gas divide toward zero
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+
+def _mod(a, b):
+    return a - b * _div(a, b)
+
+
+_BINOPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: _div, ast.Mod: _mod,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_, ast.BitAnd: operator.and_, ast.BitXor: operator.xor,
+}
+_UNOPS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert}
+
+
+def _eval_node(node, names):
+    if isinstance(node, ast.Expression):
+        return _eval_node(node.body, names)
+    if isinstance(node, ast.Constant) and isinstance(node.value, int):
+        return node.value
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise KeyError(node.id)
+        return names[node.id]
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        return _BINOPS[type(node.op)](_eval_node(node.left, names), _eval_node(node.right, names))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNOPS:
+        return _UNOPS[type(node.op)](_eval_node(node.operand, names))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and len(node.args) == 1:
+        value = _eval_node(node.args[0], names)
+        if node.func.id == '_hi':
+            return hi_lo(value)[0] >> 12
+        if node.func.id == '_lo':
+            return hi_lo(value)[1]
+    raise AsmError('unsupported expression')
+
+
+class Statement:
+    def __init__(self, seq, file, line, section, addr, mnemonic, args):
+        self.seq = seq
+        self.file = file
+        self.line = line
+        self.section = section
+        self.addr = addr
+        self.mnemonic = mnemonic
+        self.args = args
+        self.size = 0
+
+
+class Assembler:
+    """Two passes over the preprocessed source: sizes and label addresses, then encodings.
+
+    .text starts at text_base and .data (then .bss) at the next data_align boundary, like
+    link.ld. assemble() returns an Image with an executable and a writable segment.
+    """
+
+    def __init__(self, text_base=TEXT_BASE, data_align=DATA_ALIGN, include_dirs=(MACRO_DIR,),
+                 defines=None):
+        self.text_base = text_base
+        self.data_align = data_align
+        self.include_dirs = include_dirs
+        self.defines = defines
+
+    def assemble_file(self, path):
+        pp = Preprocessor(self.include_dirs, self.defines)
+        return self.assemble(pp.run(path), name=path)
+
+    def assemble_source(self, source, name='<source>'):
+        pp = Preprocessor(self.include_dirs, self.defines)
+        return self.assemble(pp.process(source, name=name), name=name)
+
+    # statements -----------------------------------------------------------
+
+    def parse(self, text):
+        # statements are (file, line, mnemonic, args), placed by the preprocessor's line markers
+        stmts = []
+        fname, lineno = self.name, 0
+        for line in text.split('\n'):
+            lineno += 1
+            m = _LINE_MARKER.match(line)
+            if m:
+                fname, lineno = m.group(2), int(m.group(1)) - 1
+                continue
+            # string literals are set aside so '#', ';' and ',' in them do not split the line
+            strings = []
+
+            def hide(m):
+                strings.append(m.group())
+                return f'\0{len(strings) - 1}\0'
+
+            def restore(text):
+                return re.sub(r'\0(\d+)\0', lambda m: strings[int(m.group(1))], text)
+            line = re.sub(r'"(?:[^"\\]|\\.)*"', hide, line)
+            line = line.split('#', 1)[0]
+            for part in line.split(';'):
+                part = part.strip()
+                while part:
+                    m = re.match(r'([A-Za-z_.$][\w.$]*|\d+)\s*:(?!:)', part)
+                    if m is None:
+                        break
+                    stmts.append((fname, lineno, 'label', m.group(1)))
+                    part = part[m.end():].strip()
+                if part:
+                    m = re.match(r'(\S+)\s*(.*)', part)
+                    args = [restore(arg) for arg in self.split_args(m.group(2))]
+                    stmts.append((fname, lineno, m.group(1).lower(), args))
+        return stmts
+
+    @staticmethod
+    def split_args(text):
+        args, depth, cur = [], 0, []
+        for c in text:
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            if c == ',' and depth == 0:
+                args.append(''.join(cur).strip())
+                cur = []
+            else:
+                cur.append(c)
+        if ''.join(cur).strip():
+            args.append(''.join(cur).strip())
+        return args
+
+    def assemble(self, text, name='<source>'):
+        self.name = name
+        parsed = self.parse(text)
+        self.symbols = {}
+        self.constants = {}
+        self.local = {}
+        sections = {'.text': [], '.data': [], '.bss': []}
+        section = '.text'
+        stmts = []
+        pcs = {'.text': 0, '.data': 0, '.bss': 0}
+        for seq, (fname, lineno, mnemonic, args) in enumerate(parsed):
+            st = Statement(seq, fname, lineno, section, pcs[section], mnemonic, args)
+            if mnemonic == 'label':
+                if args.isdigit():
+                    self.local.setdefault(args, []).append((seq, section, pcs[section]))
+                elif args in self.constants:
+                    raise AsmError(f'{fname}:{lineno}: {args!r} is already defined')
+                else:
+                    self.symbols[args] = (section, pcs[section])
+                continue
+            if mnemonic in ('.equ', '.set'):
+                # constants take the value of their expression where they are defined
+                if len(args) != 2:
+                    raise AsmError(f'{fname}:{lineno}: {mnemonic} needs a symbol and a value')
+                if args[0] in self.constants or args[0] in self.symbols:
+                    raise AsmError(f'{fname}:{lineno}: {args[0]!r} is already defined')
+                self.constants[args[0]] = self.value(args[1], st, pc=None)
+                continue
+            if mnemonic in ('.text', '.data', '.bss'):
+                section = mnemonic
+                continue
+            if mnemonic == '.section':
+                section = args[0].split(',')[0] if args[0] in sections else '.data'
+                if args[0].startswith('.text'):
+                    section = '.text'
+                continue
+            st.section = section
+            st.addr = pcs[section]
+            st.size = self.size_of(st)
+            pcs[section] += st.size
+            stmts.append(st)
+            sections[section].append(st)
+
+        bases = {'.text': self.text_base}
+        bases['.data'] = _align(self.text_base + pcs['.text'], self.data_align)
+        bases['.bss'] = bases['.data'] + pcs['.data']
+        self.bases = bases
+        self.symbols = {k: bases[s] + off for k, (s, off) in self.symbols.items()}
+        self.local = {k: [(seq, bases[s] + off) for seq, s, off in v]
+                      for k, v in self.local.items()}
+
+        images = {s: bytearray(pcs[s]) for s in sections}
+        for st in stmts:
+            pc = bases[st.section] + st.addr
+            data = self.emit(st, pc)
+            images[st.section][st.addr:st.addr + len(data)] = data
+        segments = []
+        if pcs['.text']:
+            segments.append(Segment(bases['.text'], pcs['.text'],
+                                    memoryview(bytes(images['.text'])), PF_R | PF_X))
+        if pcs['.data'] or pcs['.bss']:
+            # .bss is the zero-filled rest of the data segment
+            segments.append(Segment(bases['.data'], pcs['.data'] + pcs['.bss'],
+                                    memoryview(bytes(images['.data'])), PF_R | PF_W))
+        return Image(segments, self.symbols.get('_start', self.text_base), dict(self.symbols))
+
+    # sizes -----------------------------------------------------------------
+
+    def size_of(self, st):
+        m, args = st.mnemonic, st.args
+        if m in ('.align', '.p2align', '.balign'):
+            align = int(self.value(args[0], st, pc=None)) if args else 0
+            if m != '.balign':
+                align = 1 << align
+            st.align = align
+            return (-st.addr) % align if align else 0
+        if m == '.word':
+            return 4 * len(args)
+        if m in ('.half', '.short'):
+            return 2 * len(args)
+        if m == '.byte':
+            return len(args)
+        if m in ('.space', '.zero', '.skip'):
+            return self.value(args[0], st, pc=None)
+        if m in STRING_DIRECTIVES:
+            st.data = b''.join(self.string(arg, st) + STRING_DIRECTIVES[m] for arg in args)
+            return len(st.data)
+        if m in NOP_DIRECTIVES:
+            return 0
+        if m.startswith('.'):
+            raise AsmError(f'{st.file}:{st.line}: unknown directive {m!r}')
+        if m in C_OPS:
+            return 2
+        if m in ('la', 'lla', 'call', 'tail'):
+            return 8
+        if m == 'li':
+            try:
+                value = self.value(args[1], st, pc=None, missing_ok=True)
+            except KeyError:
+                st.li_long = True
+                return 8
+            value = ((value & 0xffffffff) ^ 0x80000000) - 0x80000000
+            st.li_long = not -2048 <= value < 2048
+            return 8 if st.li_long and (value & 0xfff) else 4
+        return 4
+
+    # expressions -----------------------------------------------------------
+
+    def value(self, expr, st, pc, missing_ok=False):
+        # pc is None in the first pass, where labels are not known yet; with missing_ok an
+        # undefined symbol raises KeyError for the caller to handle instead of AsmError
+        expr = expr.strip()
+        names = {}
+        symbols = {}
+
+        def symbol(m):
+            symbols[_mangle(m.group(1))] = m.group(1)
+            return _mangle(m.group(1))
+
+        def local(m):
+            num, direction = m.group(1), m.group(2)
+            defs = self.local.get(num, [])
+            if direction == 'b':
+                cands = [a for seq, a in defs if seq <= st.seq]
+                if not cands:
+                    raise AsmError(f'{st.file}:{st.line}: undefined label {num}b')
+                addr = cands[-1]
+            else:
+                cands = [a for seq, a in defs if seq > st.seq]
+                if not cands:
+                    raise AsmError(f'{st.file}:{st.line}: undefined label {num}f')
+                addr = cands[0]
+            key = f'_local{len(names)}'
+            names[key] = addr
+            return key
+        if pc is not None:
+            expr = re.sub(r'\b(\d+)([bf])\b', local, expr)
+        expr = re.sub(r'%hi\(', '_hi(', expr)
+        expr = re.sub(r'%lo\(', '_lo(', expr)
+        expr = re.sub(r'(?<![\w.$])([A-Za-z_.$][\w.$]*)(?![\w.$]|\s*\()', symbol, expr)
+        for k, v in self.constants.items():
+            names[_mangle(k)] = v
+        if pc is not None:
+            for k, v in self.symbols.items():
+                names[_mangle(k)] = v
+        try:
+            tree = ast.parse(expr, mode='eval')
+        except SyntaxError:
+            raise AsmError(f'{st.file}:{st.line}: bad expression {expr!r}')
+        try:
+            return _eval_node(tree, names)
+        except ZeroDivisionError:
+            raise AsmError(f'{st.file}:{st.line}: division by zero') from None
+        except KeyError as e:
+            if missing_ok:
+                raise
+            name = symbols.get(e.args[0], e.args[0])
+            raise AsmError(f'{st.file}:{st.line}: undefined symbol {name!r}') from None
+
+    def string(self, text, st):
+        # a string literal with the escapes of C, as bytes
+        if not re.fullmatch(r'"(?:[^"\\]|\\.)*"', text) or not text.isascii():
+            raise AsmError(f'{st.file}:{st.line}: bad string {text!r}')
+        try:
+            return ast.literal_eval('b' + text)
+        except (SyntaxError, ValueError):
+            raise AsmError(f'{st.file}:{st.line}: bad string {text!r}')
+
+    def imm(self, expr, st, pc, bits, signed=True):
+        value = self.value(expr, st, pc)
+        lo, hi = (-(1 << (bits - 1)), (1 << (bits - 1))) if signed else (0, 1 << bits)
+        if not lo <= value < hi:
+            raise AsmError(f'{st.file}:{st.line}: immediate {value} out of range')
+        return value
+
+    def reg(self, name, st):
+        try:
+            return REG_NAMES[name.strip()]
+        except KeyError:
+            raise AsmError(f'{st.file}:{st.line}: bad register {name!r}')
+
+    def csr(self, name, st):
+        name = name.strip()
+        if name in CSR_NAMES:
+            return CSR_NAMES[name]
+        return self.imm(name, st, 0, 12, signed=False)
+
+    def mem_operand(self, text, st, pc):
+        m = re.match(r'(.*)\((\w+)\)\s*$', text.strip())
+        if m is None:
+            raise AsmError(f'{st.file}:{st.line}: bad memory operand {text!r}')
+        offset = self.imm(m.group(1) or '0', st, pc, 12)
+        return offset, self.reg(m.group(2), st)
+
+    def target(self, expr, st, pc, bits):
+        offset = self.value(expr, st, pc) - pc
+        if not -(1 << (bits - 1)) <= offset < (1 << (bits - 1)) or offset & 1:
+            raise AsmError(f'{st.file}:{st.line}: branch target out of range')
+        return offset
+
+    # encoding --------------------------------------------------------------
+
+    def emit(self, st, pc):
+        words = self.encode(st, pc)
+        if isinstance(words, (bytes, bytearray)):
+            return words
+        return b''.join((w & 0xffffffff).to_bytes(4, 'little') for w in words)
+
+    def encode(self, st, pc):
+        m, a = st.mnemonic, st.args
+        reg = lambda i: self.reg(a[i], st)
+
+        if m in ('.align', '.p2align', '.balign'):
+            pad = st.size
+            nops = (pad // 4) * i_type(Opcode.IMM, 0, 0, 0, 0).to_bytes(4, 'little')
+            if pad % 4 == 2:
+                # c.nop
+                nops = b'\x01\x00' + nops
+            return bytes(pad % 2) + nops if st.section == '.text' else bytes(pad)
+        if m == '.word':
+            return [self.value(x, st, pc) for x in a]
+        if m in ('.half', '.short'):
+            return b''.join((self.value(x, st, pc) & 0xffff).to_bytes(2, 'little') for x in a)
+        if m == '.byte':
+            return bytes(self.value(x, st, pc) & 0xff for x in a)
+        if m in ('.space', '.zero', '.skip'):
+            return bytes(st.size)
+        if m in STRING_DIRECTIVES:
+            return st.data
+        if m in NOP_DIRECTIVES:
+            return b''
+
+        if m in C_OPS:
+            return self.encode_compressed(st, m, a, pc)
+        if m in R_OPS and len(a) == 3 and a[2].strip() not in REG_NAMES:
+            m = m + 'i' if m + 'i' in I_OPS or m + 'i' in SHIFT_OPS else m
+        if m in R_OPS:
+            f = R_OPS[m]
+            return [r_type(Opcode.REG, reg(0), f >> 1, reg(1), reg(2), (f & 1) << 5)]
+        if m in M_OPS:
+            return [r_type(Opcode.REG, reg(0), M_OPS[m], reg(1), reg(2), 0b0000001)]
+        if m in I_OPS:
+            return [i_type(Opcode.IMM, reg(0), I_OPS[m] >> 1, reg(1), self.imm(a[2], st, pc, 12))]
+        if m in SHIFT_OPS:
+            f = SHIFT_OPS[m]
+            shamt = self.imm(a[2], st, pc, 5, signed=False)
+            return [r_type(Opcode.IMM, reg(0), f >> 1, reg(1), shamt, (f & 1) << 5)]
+        if m in LD_OPS:
+            offset, base = self.mem_operand(a[1], st, pc)
+            return [i_type(Opcode.LOAD, reg(0), LD_OPS[m], base, offset)]
+        if m in ST_OPS:
+            offset, base = self.mem_operand(a[1], st, pc)
+            return [s_type(Opcode.STORE, ST_OPS[m], base, reg(0), offset)]
+        if m in BR_OPS:
+            return [b_type(Opcode.BRANCH, BR_OPS[m], reg(0), reg(1), self.target(a[2], st, pc, 13))]
+        if m in BR_SWAPPED:
+            return [b_type(Opcode.BRANCH, BR_OPS[BR_SWAPPED[m]], reg(1), reg(0),
+                           self.target(a[2], st, pc, 13))]
+        if m in BR_ZERO:
+            op, swap = BR_ZERO[m]
+            rs1, rs2 = (0, reg(0)) if swap else (reg(0), 0)
+            return [b_type(Opcode.BRANCH, BR_OPS[op], rs1, rs2, self.target(a[1], st, pc, 13))]
+        if m == 'lui':
+            return [u_type(Opcode.LUI, reg(0), self.imm(a[1], st, pc, 20, signed=False) << 12)]
+        if m == 'auipc':
+            return [u_type(Opcode.AUIPC, reg(0), self.imm(a[1], st, pc, 20, signed=False) << 12)]
+        if m == 'jal':
+            rd, dest = (1, a[0]) if len(a) == 1 else (reg(0), a[1])
+            return [j_type(Opcode.JAL, rd, self.target(dest, st, pc, 21))]
+        if m == 'j':
+            return [j_type(Opcode.JAL, 0, self.target(a[0], st, pc, 21))]
+        if m == 'jalr':
+            if len(a) == 1:
+                return [i_type(Opcode.JALR, 1, 0, reg(0), 0)]
+            if len(a) == 2:
+                offset, base = self.mem_operand(a[1], st, pc)
+                return [i_type(Opcode.JALR, reg(0), 0, base, offset)]
+            return [i_type(Opcode.JALR, reg(0), 0, reg(1), self.imm(a[2], st, pc, 12))]
+        if m == 'jr':
+            return [i_type(Opcode.JALR, 0, 0, reg(0), 0)]
+        if m == 'ret':
+            return [i_type(Opcode.JALR, 0, 0, 1, 0)]
+        if m in ('call', 'tail'):
+            rd = 1 if m == 'call' else 6
+            hi, lo = hi_lo(self.value(a[0], st, pc) - pc)
+            return [u_type(Opcode.AUIPC, rd, hi),
+                    i_type(Opcode.JALR, 1 if m == 'call' else 0, 0, rd, lo)]
+        if m == 'nop':
+            return [i_type(Opcode.IMM, 0, 0, 0, 0)]
+        if m == 'mv':
+            return [i_type(Opcode.IMM, reg(0), 0, reg(1), 0)]
+        if m == 'not':
+            return [i_type(Opcode.IMM, reg(0), AluFunc.XOR >> 1, reg(1), -1)]
+        if m == 'neg':
+            return [r_type(Opcode.REG, reg(0), 0, 0, reg(1), 0b0100000)]
+        if m == 'seqz':
+            return [i_type(Opcode.IMM, reg(0), AluFunc.SLTU >> 1, reg(1), 1)]
+        if m == 'snez':
+            return [r_type(Opcode.REG, reg(0), AluFunc.SLTU >> 1, 0, reg(1), 0)]
+        if m == 'li':
+            value = self.value(a[1], st, pc) & 0xffffffff
+            hi, lo = hi_lo(value)
+            if not st.li_long:
+                return [i_type(Opcode.IMM, reg(0), 0, 0, lo)]
+            if st.size == 4:
+                return [u_type(Opcode.LUI, reg(0), hi)]
+            return [u_type(Opcode.LUI, reg(0), hi), i_type(Opcode.IMM, reg(0), 0, reg(0), lo)]
+        if m in ('la', 'lla'):
+            hi, lo = hi_lo(self.value(a[1], st, pc) - pc)
+            return [u_type(Opcode.AUIPC, reg(0), hi), i_type(Opcode.IMM, reg(0), 0, reg(0), lo)]
+        if m in CSR_OPS:
+            f = CSR_OPS[m]
+            src = self.imm(a[2], st, pc, 5, signed=False) if f & 0b100 else reg(2)
+            return [i_type(OPCODE_SYSTEM, reg(0), f, src, self.csr(a[1], st))]
+        if m in ('csrr', 'csrw', 'csrs', 'csrc', 'csrwi', 'csrsi', 'csrci'):
+            if m == 'csrr':
+                return [i_type(OPCODE_SYSTEM, reg(0), CSR_OPS['csrrs'], 0, self.csr(a[1], st))]
+            f = CSR_OPS['csrr' + m[3:]]
+            src = self.imm(a[1], st, pc, 5, signed=False) if f & 0b100 else reg(1)
+            return [i_type(OPCODE_SYSTEM, 0, f, src, self.csr(a[0], st))]
+        if m == 'ecall':
+            return [OPCODE_SYSTEM]
+        if m == 'ebreak':
+            return [(1 << 20) | OPCODE_SYSTEM]
+        if m == 'fence':
+            return [0x0ff0000f]
+        if m.split('.')[0] in ('lr', 'sc') or m.split('.aq')[0].split('.rl')[0] in AMO_OPS:
+            return [self.encode_amo(st, m, a)]
+        raise AsmError(f'{st.file}:{st.line}: unknown instruction {m!r}')
+
+    def encode_compressed(self, st, m, a, pc):
+        global _compress
+        if _compress is None:
+            _compress = {}
+            for half in range(1 << 16):
+                inst = expand(half) if half & 3 != 3 else None
+                if inst is not None:
+                    _compress.setdefault(inst, half)
+        base, fmt = C_OPS[m]
+        args = self.split_args(fmt.format(*a)) if fmt else []
+        full = Statement(st.seq, st.file, st.line, st.section, st.addr, base, args)
+        full.li_long = False
+        inst = self.encode(full, pc)[0] & 0xffffffff
+        if inst not in _compress:
+            raise AsmError(f'{st.file}:{st.line}: {m} {", ".join(a)} has no compressed form')
+        return _compress[inst].to_bytes(2, 'little')
+
+    def encode_amo(self, st, m, a):
+        parts = m.split('.')
+        aq = int('aq' in parts or 'aqrl' in parts)
+        rl = int('rl' in parts or 'aqrl' in parts)
+        base = '.'.join(parts[:2])
+        rs1 = self.reg(a[-1].strip().strip('()'), st)
+        if base == 'lr.w':
+            funct5, rs2 = 0b00010, 0
+        elif base == 'sc.w':
+            funct5, rs2 = 0b00011, self.reg(a[1], st)
+        else:
+            funct5, rs2 = AMO_OPS[base], self.reg(a[1], st)
+        funct7 = (funct5 << 2) | (aq << 1) | rl
+        return r_type(OPCODE_AMO, self.reg(a[0], st), 0b010, rs1, rs2, funct7)
+
+
+def assemble(source, name='<source>', **kwargs):
+    """Assemble source text into an Image, kwargs go to Assembler."""
+    return Assembler(**kwargs).assemble_source(source, name)
+
+
+def assemble_file(path, **kwargs):
+    return Assembler(**kwargs).assemble_file(path)
+
+
+def load_program(path):
+    # assembly sources are built in memory, anything else goes to load_image
+    if os.path.splitext(path)[1] in ('.S', '.s'):
+        return assemble_file(path)
+    return load_image(path)
+
+
+def _mangle(name):
+    if name.startswith('_local'):
+        return name
+    return 'sym_' + name.replace('.', '_dot_').replace('$', '_dollar_')
+
+
+def _align(value, align):
+    return (value + align - 1) // align * align
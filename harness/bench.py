@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import sys
+from harness.runner import add_options, find_tests, get_options, run
+
+
+BENCH_DIR = os.path.join(os.path.dirname(__file__), '..', 'programs', 'benchmarks', 'src')
+BASELINE = os.path.join(os.path.dirname(__file__), '..', 'programs', 'benchmarks',
+                        'baseline.json')
+
+# the options that change cycle counts and their defaults; baselines are kept per
+# combination of the ones that differ, named by them in alphabetical order
+CONFIG = {
+    'core': 'fsm',
+    'bpred': False,
+    'dcache': False,
+    'ifetch': False,
+    'rom_wait_states': 0,
+    'ram_wait_states': 0,
+    'muldiv': 'single',
+    'compressed': False,
+    'fusion': False,
+}
+
+
+def config_name(options):
+    changed = [f'{name}={options[name]}' for name, default in sorted(CONFIG.items())
+               if options[name] != default]
+    return ','.join(changed) or 'default'
+
+
+def measure(result):
+    return {
+        'cycles': result['cycles'],
+        'retired': result['retired'],
+        'cpi': round(result['cycles'] / result['retired'], 3) if result['retired'] else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the results against baseline {name: measure}, return the regressions."""
+    regressions = []
+    print(f"{'benchmark':16s} {'cycles':>8s} {'retired':>8s} {'CPI':>6s} {'baseline':>9s} "
+          f"{'change':>8s}")
+    for result in results:
+        name = result['name']
+        now = measure(result)
+        old = baseline.get(name)
+        line = f"{name:16s} {now['cycles']:8d} {now['retired']:8d} {now['cpi'] or 0:6.3f}"
+        if old is not None and result['passed']:
+            change = (now['cycles'] - old['cycles']) / old['cycles'] * 100
+            line += f" {old['cycles']:9d} {change:+7.2f}%"
+            if change > threshold:
+                regressions.append(f"{name} cycles {old['cycles']} -> {now['cycles']} "
+                                   f"({change:+.2f}%)")
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    env = os.environ
+    parser = argparse.ArgumentParser(
+        description='Run the benchmarks and compare their cycle counts with the baselines.')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmark names, .S sources or .riscv files, default: every '
+                        'source in ' + BENCH_DIR)
+    add_options(parser)
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--threshold', type=float, default=float(env.get('threshold', 1.0)),
+                        help='percent of extra cycles allowed before a benchmark fails')
+    parser.add_argument('--update', action='store_true',
+                        help="replace this configuration's baseline with the results")
+    parser.add_argument('--json', help='write a JSON report')
+    args = parser.parse_args(argv)
+    options = get_options(parser, args)
+    if options['harts'] > 1:
+        parser.error('the benchmarks run on one core')
+
+    paths = find_tests(args.benchmarks, BENCH_DIR)
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing or not paths:
+        print(f"ERROR: {missing[0] if missing else BENCH_DIR + '/*.S'} does not exist")
+        return 2
+
+    results = run(paths, options, args.jobs)
+    baselines = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    config = config_name(options)
+    print(f'configuration: {config}')
+    regressions = compare(results, baselines.get(config, {}), args.threshold)
+    failed = [result['name'] for result in results if not result['passed']]
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': options, 'config': config,
+                       'benchmarks': {result['name']: measure(result) for result in results}},
+                      f, indent=2)
+    if args.update and not failed:
+        baselines.setdefault(config, {}).update(
+            (result['name'], measure(result)) for result in results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'updated the {config} baseline in {args.baseline}')
+        return 0
+    if config not in baselines:
+        print(f'no baseline for {config}, --update records one')
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    if failed:
+        print(f"failed: {' '.join(failed)}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
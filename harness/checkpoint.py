@@ -0,0 +1,267 @@
+import argparse
+import gzip
+import json
+import sys
+from core.iss import ISS, SimMemory
+from harness.asm import load_program
+from harness.cosim import Cosim, rom_memory
+from harness.elf import PF_R, PF_W, PF_X, Image, Segment
+from harness.runner import RAM_SIZE, RESET_ADDRESS, add_options, get_options, make_cpu
+from harness.session import Exit, Session, run_to_exit
+
+
+FORMAT = 1
+# RAM is stored as the pages that are not all zero
+PAGE_SIZE = 4096
+
+
+class Checkpoint:
+    """Architectural state between two instructions: the pc, the registers, instret and
+    the memories. Reservations and the microarchitecture (caches, predictor) are not kept,
+    a restored core starts them cold.
+    """
+
+    def __init__(self, pc, regs, instret, rom, ram, ram_base=0x0000_0000, ram_size=RAM_SIZE,
+                 tohost=()):
+        # rom is the instruction side's bytes from address 0, ram {offset: page bytes}
+        self.pc = pc
+        self.regs = list(regs)
+        self.instret = instret
+        self.rom = bytes(rom)
+        self.ram = dict(ram)
+        self.ram_base = ram_base
+        self.ram_size = ram_size
+        self.tohost = list(tohost)
+
+    @classmethod
+    def from_iss(cls, iss, ram_base=0x0000_0000):
+        zero = bytes(PAGE_SIZE)
+        data = iss.dmem.data
+        ram = {offset: bytes(data[offset:offset + PAGE_SIZE])
+               for offset in range(0, iss.dmem.size, PAGE_SIZE)
+               if data[offset:offset + PAGE_SIZE] != zero}
+        rom = bytes(iss.imem.data).rstrip(b'\0')
+        rom += bytes(-len(rom) % 4)
+        return cls(iss.pc, iss.regs, iss.instret, rom, ram, ram_base, iss.dmem.size, iss.tohost)
+
+    def image(self):
+        """The memories as an Image, for Session.run and Cosim."""
+        segments = [Segment(0x0000_0000, len(self.rom), memoryview(self.rom), PF_R | PF_X)]
+        segments += [Segment(self.ram_base + offset, len(page), memoryview(page), PF_R | PF_W)
+                     for offset, page in sorted(self.ram.items())]
+        return Image(segments, self.pc)
+
+    def iss(self, rom_words=2048):
+        """An ISS in this state."""
+        image = self.image()
+        ram = SimMemory(self.ram_size)
+        image.data().load(ram, self.ram_base)
+        iss = ISS(rom_memory(image.code(), rom_words), ram, self.pc)
+        iss.regs[:] = self.regs
+        iss.instret = self.instret
+        iss.tohost = list(self.tohost)
+        return iss
+
+    def make_cpu(self, rom_words=2048, **options):
+        # a core for the checkpoints with this RAM size, options as for runner.make_cpu;
+        # restore() sets its pc, so one core runs any number of them
+        if options.get('harts', 1) > 1:
+            raise ValueError('checkpoints hold the state of one hart')
+        return make_cpu([0] * rom_words, reset_address=self.pc, ram_size=self.ram_size,
+                        **options)
+
+    def restore(self, cpu):
+        """Writes the pc, registers and counters of a core after Session.reset loaded
+        image()."""
+        yield cpu.fetch_pc.eq(self.pc)
+        for reg, value in enumerate(self.regs):
+            if reg:
+                yield cpu.regs.mem[reg].eq(value)
+        # the model counts one cycle per instruction
+        yield cpu.csr.instret.eq(self.instret)
+        yield cpu.csr.cycle.eq(self.instret)
+
+    def save(self, path):
+        state = {
+            'format': FORMAT,
+            'pc': self.pc,
+            'regs': self.regs,
+            'instret': self.instret,
+            'rom': self.rom.hex(),
+            'ram_base': self.ram_base,
+            'ram_size': self.ram_size,
+            'ram': {str(offset): page.hex() for offset, page in sorted(self.ram.items())},
+            'tohost': self.tohost,
+        }
+        with gzip.open(path, 'wt') as f:
+            json.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt') as f:
+            state = json.load(f)
+        if state.get('format') != FORMAT:
+            raise ValueError(f"{path}: checkpoint format {state.get('format')}, "
+                             f"expected {FORMAT}")
+        return cls(state['pc'], state['regs'], state['instret'], bytes.fromhex(state['rom']),
+                   {int(offset): bytes.fromhex(page) for offset, page in state['ram'].items()},
+                   state['ram_base'], state['ram_size'], state['tohost'])
+
+
+def start(image, rom_words=2048, ram_size=RAM_SIZE, ram_base=0x0000_0000):
+    """An ISS at the reset address with image loaded, to fast-forward with ISS.run."""
+    ram = SimMemory(ram_size)
+    image.data().load(ram, ram_base)
+    return ISS(rom_memory(image.code(), rom_words), ram, RESET_ADDRESS)
+
+
+def fast_forward(image, instructions=None, until_pc=None, rom_words=2048, ram_size=RAM_SIZE):
+    """Runs image on the ISS for instructions or up to until_pc, returns the Checkpoint."""
+    iss = start(image, rom_words, ram_size)
+    iss.run(instructions, until_pc)
+    if iss.halted:
+        raise ValueError(f'the program exited after {iss.instret} instructions')
+    return Checkpoint.from_iss(iss)
+
+
+def make_session(checkpoint, options):
+    """A Session around a core configured by options, for run_window."""
+    return Session(checkpoint.make_cpu(options['rom_words'], **{
+        name: options[name] for name in ('core', 'bpred', 'dcache', 'ifetch', 'rom_wait_states',
+                                         'ram_wait_states', 'muldiv', 'compressed',
+                                         'fusion')}))
+
+
+def run_window(checkpoint, options, instructions=None, warmup=0, cosim=False, session=None):
+    """Runs warmup + instructions from checkpoint, on session's core or a fresh one.
+
+    Returns the run_to_exit result with the window's cycles and retired instructions, the
+    warmup excluded. With cosim every commit is checked against the ISS.
+    """
+    if session is None:
+        session = make_session(checkpoint, options)
+    cpu = session.cpu
+    if cpu.ram.size != checkpoint.ram_size:
+        raise ValueError(f'the checkpoint has {checkpoint.ram_size} bytes of RAM, '
+                         f'the core {cpu.ram.size}')
+    image = checkpoint.image()
+    monitors = []
+    checker = None
+    if cosim:
+        checker = Cosim(cpu, image, reset_address=checkpoint.pc)
+        checker.iss = checkpoint.iss(options['rom_words'])
+        monitors.append(checker.commit)
+    result = {}
+    warm = {'cycles': 0}
+
+    def mark():
+        # the cycle the last warmup instruction committed in
+        if warmup and 'retired' not in warm and result['retired'] >= warmup:
+            warm.update(cycles=result['cycles'] - 1, retired=result['retired'])
+        return
+        yield
+
+    if warmup:
+        monitors.append(mark)
+
+    def process():
+        yield from checkpoint.restore(cpu)
+        yield from run_to_exit(cpu, result, options['max_cycles'], monitors,
+                               None if instructions is None else warmup + instructions)
+
+    session.run(image, process)
+    if checker is not None and checker.divergence is not None:
+        raise checker.divergence
+    result['cycles'] -= warm['cycles']
+    result['retired'] -= warm.get('retired', 0)
+    return result
+
+
+def report(name, checkpoint, result):
+    cpi = result['cycles'] / result['retired'] if result['retired'] else 0
+    print(f"{name:12s} instret={checkpoint.instret} pc={checkpoint.pc:#010x} "
+          f"cycles={result['cycles']} retired={result['retired']} cpi={cpi:.3f} "
+          f"end={result['reason']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fast-forward programs on the ISS, save checkpoints and run detailed '
+        'windows from them on the RTL.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    save = commands.add_parser('save', help='fast-forward a program and save a checkpoint')
+    save.add_argument('program', help='.S source or .riscv file')
+    save.add_argument('-o', '--output', required=True, help='checkpoint file')
+    save.add_argument('--instructions', type=int, help='instructions to fast-forward')
+    save.add_argument('--pc', type=lambda text: int(text, 0),
+                      help='fast-forward until the pc reaches this address')
+    save.add_argument('--rom-words', type=int, default=2048)
+    save.add_argument('--ram-size', type=lambda text: int(text, 0), default=RAM_SIZE)
+
+    run = commands.add_parser('run', help='run a detailed window from a checkpoint')
+    run.add_argument('checkpoint')
+    run.add_argument('--window', type=int, help='instructions, default: up to the exit')
+    run.add_argument('--warmup', type=int, default=0,
+                     help='instructions run before the window and left out of its counts')
+    add_options(run)
+
+    sample = commands.add_parser(
+        'sample', help='detailed windows at regular intervals of a fast-forwarded program')
+    sample.add_argument('program')
+    sample.add_argument('--interval', type=int, required=True,
+                        help='instructions from the start of one window to the next')
+    sample.add_argument('--window', type=int, required=True)
+    sample.add_argument('--warmup', type=int, default=0)
+    add_options(sample)
+
+    args = parser.parse_args(argv)
+    if args.command == 'save':
+        if (args.instructions is None) == (args.pc is None):
+            save.error('give one of --instructions and --pc')
+        try:
+            checkpoint = fast_forward(load_program(args.program), args.instructions, args.pc,
+                                      args.rom_words, args.ram_size)
+        except ValueError as e:
+            print(f'ERROR: {e}')
+            return 2
+        checkpoint.save(args.output)
+        print(f'{args.output}: instret={checkpoint.instret} pc={checkpoint.pc:#010x}')
+        return 0
+
+    options = get_options(run if args.command == 'run' else sample, args)
+    if args.command == 'run':
+        checkpoint = Checkpoint.load(args.checkpoint)
+        result = run_window(checkpoint, options, args.window, args.warmup, options['cosim'])
+        report('window', checkpoint, result)
+        return 0 if result['reason'] in (Exit.RETIRED, Exit.TOHOST) and \
+            not result['exit_code'] else 1
+
+    # one ISS runs the whole program, a checkpoint every interval feeds a detailed window;
+    # the windows share one elaborated core, reset and restored for each
+    iss = start(load_program(args.program), options['rom_words'], options['ram_size'])
+    cycles = retired = 0
+    n = 0
+    session = None
+    while not iss.halted:
+        checkpoint = Checkpoint.from_iss(iss)
+        if session is None:
+            session = make_session(checkpoint, options)
+        result = run_window(checkpoint, options, args.window, args.warmup, options['cosim'],
+                            session)
+        report(f'window {n}', checkpoint, result)
+        cycles += result['cycles']
+        retired += result['retired']
+        n += 1
+        iss.run(args.interval)
+    if not retired:
+        print('no instructions in the windows')
+        return 1
+    cpi = cycles / retired
+    print(f'{n} windows, {retired} of {iss.instret} instructions in detail, cpi={cpi:.3f}, '
+          f'estimated cycles={round(cpi * iss.instret)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+from collections import deque
+from nmigen.sim import *
+from core.decoder import Opcode
+from core.iss import ISS, ISSError, SimMemory
+from harness.session import add_models
+
+
+def rom_memory(image, words):
+    # the ROM ignores the address bits above its size, so does the model
+    size = 4
+    while size < 4 * words:
+        size *= 2
+    memory = SimMemory(size)
+    image.load(memory)
+    return memory
+
+
+class Divergence(Exception):
+    # expected is None when the reference model failed on the instruction, error says why
+    def __init__(self, cycle, retired, inst, expected, actual, history, error=None):
+        self.cycle = cycle
+        self.retired = retired
+        self.inst = inst
+        self.expected = expected
+        self.actual = actual
+        self.history = history
+        self.error = error
+        super().__init__(self.report())
+
+    def report(self):
+        def fmt(commit):
+            pc, rd, value = commit
+            return f'pc={pc:08x} x{rd:<2d}={value:08x}' if rd else f'pc={pc:08x}'
+        lines = [f'DIVERGED at cycle {self.cycle}, commit {self.retired}, '
+                 f'inst {self.inst:08x}',
+                 f'  expected: {fmt(self.expected)}' if self.error is None else
+                 f'  iss:      {type(self.error).__name__}: {self.error}',
+                 f'  rtl:      {fmt(self.actual)}']
+        if self.history:
+            lines.append('  last commits:')
+            lines += [f'    {fmt(commit)}' for commit in self.history]
+        return '\n'.join(lines)
+
+
+class Cosim:
+    def __init__(self, cpu, image, reset_address=0x0000_0000, history=8):
+        self.cpu = cpu
+        self.image = image
+        ram = SimMemory(cpu.ram.size)
+        image.data().load(ram, cpu.ram_base)
+        self.iss = ISS(rom_memory(image.code(), cpu.rom.mem.depth), ram, reset_address)
+        self.history = deque(maxlen=history)
+        self.cycles = 0
+        self.retired = 0
+        self.divergence = None
+
+    def commit(self):
+        # called once per settled cycle, compares the RTL commit if there is one
+        cpu = self.cpu
+        self.cycles += 1
+        if not (yield cpu.valid):
+            return
+        pc = yield cpu.pc
+        inst = yield cpu.instruction
+        rd = (yield cpu.regs.rd_addr) if (yield cpu.regs.rd_we) else 0
+        actual = (pc, rd, (yield cpu.regs.rd_data) if rd else 0)
+
+        iss = self.iss
+        fused = getattr(cpu, 'fusion', None) is not None and (yield cpu.fused)
+        try:
+            if fused:
+                # a fused pair commits the first pc and the second instruction's write
+                first = iss.step()[0]
+                expected = (first,) + iss.step()[1:]
+                if not expected[1]:
+                    expected = (first, 0, 0)
+            elif inst & 0x7f == Opcode.SYSTEM:
+                # counters and other CSRs are implementation specific, take the RTL's write
+                regs = list(iss.regs)
+                expected = (iss.step()[0],) + actual[1:]
+                iss.regs[:] = regs
+                iss.regs[rd] = actual[2]
+                iss.regs[0] = 0
+            else:
+                expected = iss.step()
+                if not expected[1]:
+                    expected = (expected[0], 0, 0)
+        except (ISSError, IndexError) as error:
+            # an instruction the model rejects is a divergence whatever the RTL did with it
+            self.retired += 2 if fused else 1
+            self.divergence = Divergence(self.cycles, self.retired, inst, None, actual,
+                                         list(self.history), error)
+            return
+        self.retired += 2 if fused else 1
+        if expected != actual:
+            self.divergence = Divergence(self.cycles, self.retired, inst, expected, actual,
+                                         list(self.history))
+        self.history.append(actual)
+
+    def process(self, max_cycles=100_000):
+        while self.cycles < max_cycles:
+            yield Tick()
+            yield Settle()
+            yield from self.commit()
+            if self.divergence is not None or self.iss.halted:
+                return
+
+    def run(self, max_cycles=100_000, session=None):
+        def process():
+            yield from self.process(max_cycles)
+
+        if session is not None:
+            session.run(self.image, process)
+        else:
+            sim = Simulator(self.cpu)
+            sim.add_clock(1e-6)
+            add_models(sim, self.cpu)
+            sim.add_sync_process(process)
+            sim.run()
+        if self.divergence is not None:
+            raise self.divergence
+        return self.iss.halted
@@ -0,0 +1,137 @@
+import mmap
+import struct
+from collections import namedtuple
+
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFDATA2LSB = 1
+EM_RISCV = 243
+
+PT_LOAD = 1
+SHT_SYMTAB = 2
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+EHDR = struct.Struct('<16sHHIIIIIHHHHHH')
+PHDR = struct.Struct('<IIIIIIII')
+SHDR = struct.Struct('<IIIIIIIIII')
+SYM = struct.Struct('<IIIBBH')
+
+
+class ElfError(Exception):
+    pass
+
+
+# data is a view of the file bytes, size the size in memory (the rest is zero)
+Segment = namedtuple('Segment', 'address size data flags')
+
+
+class Image:
+    def __init__(self, segments, entry=None, symbols=None):
+        self.segments = sorted(segments, key=lambda segment: segment.address)
+        self.entry = entry
+        self.symbols = symbols if symbols is not None else {}
+
+    @classmethod
+    def from_words(cls, words, address=0x0000_0000):
+        data = b''.join(word.to_bytes(4, 'little') for word in words)
+        return cls([Segment(address, len(data), memoryview(data), PF_R | PF_W | PF_X)])
+
+    def code(self):
+        # what the instruction side fetches: the executable segments
+        return Image([segment for segment in self.segments if segment.flags & PF_X],
+                     self.entry, self.symbols)
+
+    def data(self):
+        # what the data side sees: the writable segments and anything not executable
+        return Image([segment for segment in self.segments
+                      if segment.flags & PF_W or not segment.flags & PF_X],
+                     self.entry, self.symbols)
+
+    @property
+    def tohost(self):
+        return self.symbols.get('tohost')
+
+    @property
+    def end(self):
+        return max((segment.address + segment.size for segment in self.segments), default=0)
+
+    def check(self, base, size):
+        for segment in self.segments:
+            if segment.address < base or segment.address + segment.size > base + size:
+                raise ValueError(f'segment {segment.address:#x}-'
+                                 f'{segment.address + segment.size:#x} is outside '
+                                 f'{base:#x}-{base + size:#x}')
+
+    def region(self, base, size):
+        # the words of [base, base + size), every segment has to fall inside it
+        self.check(base, size)
+        data = bytearray(size)
+        for segment in self.segments:
+            start = segment.address - base
+            data[start:start + len(segment.data)] = segment.data
+        return memoryview(data).cast('I')
+
+    def load(self, memory, base=0x0000_0000):
+        # copies the parts of the segments that fall into a SimMemory mapped at base
+        for segment in self.segments:
+            start = max(segment.address, base)
+            end = min(segment.address + segment.size, base + memory.size)
+            if start >= end:
+                continue
+            data = bytes(segment.data[start - segment.address:end - segment.address])
+            memory.data[start - base:end - base] = data.ljust(end - start, b'\0')
+
+
+def parse_elf(data):
+    # data supports the buffer protocol, segments are views of it
+    view = memoryview(data)
+    if len(view) < EHDR.size:
+        raise ElfError('file too short for an ELF header')
+    (ident, e_type, machine, version, entry, phoff, shoff, flags, ehsize, phentsize,
+     phnum, shentsize, shnum, shstrndx) = EHDR.unpack_from(view)
+    if ident[:4] != ELF_MAGIC:
+        raise ElfError('not an ELF file')
+    if ident[4] != ELFCLASS32 or ident[5] != ELFDATA2LSB:
+        raise ElfError('not a little-endian ELF32 file')
+    if machine != EM_RISCV:
+        raise ElfError(f'not a RISC-V ELF file (machine {machine})')
+
+    segments = []
+    for i in range(phnum):
+        p_type, offset, vaddr, paddr, filesz, memsz, p_flags, align = \
+            PHDR.unpack_from(view, phoff + i * phentsize)
+        if p_type != PT_LOAD or memsz == 0:
+            continue
+        if offset + filesz > len(view):
+            raise ElfError(f'segment at {vaddr:#x} extends past the end of the file')
+        segments.append(Segment(vaddr, memsz, view[offset:offset + filesz], p_flags))
+
+    symbols = {}
+    sections = [SHDR.unpack_from(view, shoff + i * shentsize) for i in range(shnum)]
+    for name, sh_type, _, _, offset, size, link, _, _, entsize in sections:
+        if sh_type != SHT_SYMTAB:
+            continue
+        strtab = sections[link]
+        strings = view[strtab[4]:strtab[4] + strtab[5]].tobytes()
+        for st_name, value, _, _, _, _ in SYM.iter_unpack(view[offset:offset + size]):
+            if st_name:
+                symbols[strings[st_name:strings.index(b'\0', st_name)].decode()] = value
+
+    return Image(segments, entry, symbols)
+
+
+def load_image(path):
+    # an ELF file is loaded by its segments, anything else is a flat image at address 0
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            return Image([])
+    if data[:4] == ELF_MAGIC:
+        return parse_elf(data)
+    return Image([Segment(0, len(data), memoryview(data), PF_R | PF_W | PF_X)])
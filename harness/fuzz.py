@@ -0,0 +1,338 @@
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+from harness.asm import assemble
+from harness.runner import CORES, RESET_ADDRESS, make_cpu
+from harness.session import Exit, Session, run_to_exit
+
+
+R_OPS = ['add', 'sub', 'sll', 'slt', 'sltu', 'xor', 'srl', 'sra', 'or', 'and']
+I_OPS = ['addi', 'slti', 'sltiu', 'xori', 'ori', 'andi']
+SHIFT_OPS = ['slli', 'srli', 'srai']
+U_OPS = ['lui', 'auipc']
+BRANCH_OPS = ['beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu']
+COMPARE_OPS = ['slt', 'sltu', 'slti', 'sltiu'] + BRANCH_OPS
+# the ALU operation behind each immediate op
+BASE_OP = {'addi': 'add', 'slti': 'slt', 'sltiu': 'sltu', 'xori': 'xor', 'ori': 'or',
+           'andi': 'and', 'slli': 'sll', 'srli': 'srl', 'srai': 'sra'}
+
+SPECIAL_VALUES = [0, 1, 2, 0x1f, 0x20, 0x7ff, 0x800, 0x7fffffff, 0x80000000, 0xfffff800,
+                  0xfffffffe, 0xffffffff]
+SPECIAL_IMMS = [0, 1, -1, 0x7ff, -0x800, 0x1f, 0x20]
+
+# the prologue sets x1-x31 with a lui/addi pair each, so the body's addresses are fixed
+BODY_ADDRESS = RESET_ADDRESS + 8 * 31
+
+# op, destination, sources and immediate; a branch's imm is the index it jumps to
+Inst = namedtuple('Inst', 'op rd rs1 rs2 imm')
+
+
+def coverage_points():
+    """Every coverage point, see Model.run for when each is hit."""
+    points = [('op', op) for op in R_OPS + I_OPS + SHIFT_OPS + U_OPS + BRANCH_OPS]
+    points += [('taken', op, taken) for op in BRANCH_OPS for taken in (False, True)]
+    points += [('shamt', op, amount) for op in ['sll', 'srl', 'sra'] + SHIFT_OPS
+               for amount in (0, 31, 'other')]
+    points += [('shamt', op, 'over 31') for op in ('sll', 'srl', 'sra')]
+    points += [('signs', op, neg1, neg2) for op in COMPARE_OPS
+               for neg1 in (False, True) for neg2 in (False, True)]
+    points += [('equal', op) for op in COMPARE_OPS]
+    points += [('overflow', op) for op in ('add', 'sub', 'addi')]
+    points += [('x0', kind) for kind in ('r', 'i', 'u')]
+    points += [('raw', operand, distance) for operand in ('rs1', 'rs2')
+               for distance in (1, 2, 3)]
+    return points
+
+
+def generate(rng, length):
+    """A random program of length instructions, branches only jump forward."""
+    program = []
+    for i in range(length):
+        kind = rng.choice(['r', 'i', 'u', 'b'], p=[0.35, 0.35, 0.1, 0.2])
+        rd = 0 if rng.random() < 0.05 else int(rng.integers(1, 32))
+        rs1, rs2 = (int(reg) for reg in rng.integers(0, 32, 2))
+        if kind == 'r':
+            program.append(Inst(str(rng.choice(R_OPS)), rd, rs1, rs2, 0))
+        elif kind == 'i':
+            op = str(rng.choice(I_OPS + SHIFT_OPS))
+            if op in SHIFT_OPS:
+                imm = int(rng.choice([0, 31, int(rng.integers(1, 31))]))
+            elif rng.random() < 0.5:
+                imm = int(rng.choice(SPECIAL_IMMS))
+            else:
+                imm = int(rng.integers(-0x800, 0x800))
+            program.append(Inst(op, rd, rs1, 0, imm))
+        elif kind == 'u':
+            imm = int(rng.choice([0, 0x80000, 0xfffff, int(rng.integers(0, 1 << 20))]))
+            program.append(Inst(str(rng.choice(U_OPS)), rd, 0, 0, imm))
+        else:
+            # to at most 8 instructions ahead, the index length is the end of the body
+            target = i + int(rng.integers(1, min(8, length - i) + 1))
+            program.append(Inst(str(rng.choice(BRANCH_OPS)), 0, rs1, rs2, target))
+    return program
+
+
+def random_registers(rng, lanes):
+    """(32, lanes) initial register values, a third of them edge cases."""
+    regs = rng.integers(0, 1 << 32, (32, lanes), dtype=np.uint64).astype(np.uint32)
+    special = rng.random((32, lanes)) < 1 / 3
+    regs[special] = rng.choice(np.array(SPECIAL_VALUES, dtype=np.uint32), special.sum())
+    regs[0] = 0
+    return regs
+
+
+def source(program, regs):
+    """Assembly for one lane: set the registers, run the program, exit through mtohost."""
+    lines = ['_start:']
+    for reg in range(1, 32):
+        lines.append(f'  lui x{reg}, %hi({int(regs[reg]):#x})')
+        lines.append(f'  addi x{reg}, x{reg}, %lo({int(regs[reg]):#x})')
+    for i, inst in enumerate(program):
+        if inst.op in BRANCH_OPS:
+            text = f'{inst.op} x{inst.rs1}, x{inst.rs2}, L{inst.imm}'
+        elif inst.op in U_OPS:
+            text = f'{inst.op} x{inst.rd}, {inst.imm:#x}'
+        elif inst.op in R_OPS:
+            text = f'{inst.op} x{inst.rd}, x{inst.rs1}, x{inst.rs2}'
+        else:
+            text = f'{inst.op} x{inst.rd}, x{inst.rs1}, {inst.imm}'
+        lines.append(f'L{i}: {text}')
+    lines += [f'L{len(program)}:', '  csrw mtohost, zero', '1:', '  j 1b']
+    return '\n'.join(lines) + '\n'
+
+
+class Model:
+    """RV32I reference for a straight-line program, one register file per lane.
+
+    Every lane runs the same program from its own registers. Branches only go forward, so
+    the instructions are visited in order and each applies to the lanes whose pc is at it.
+    """
+
+    def run(self, program, regs):
+        """Run program on regs (32, lanes) in place, return {coverage point: first lane}."""
+        lanes = regs.shape[1]
+        pc = np.zeros(lanes, dtype=np.int32)
+        steps = np.zeros(lanes, dtype=np.int32)
+        written = np.full((32, lanes), -8, dtype=np.int32)
+        self.coverage = {}
+        for i, inst in enumerate(program):
+            active = pc == i
+            if not active.any():
+                continue
+            self.active = active
+            op = inst.op
+            a = regs[inst.rs1]
+            signed_a = a.view(np.int32)
+            if op in U_OPS:
+                sources = []
+            elif op in BASE_OP:
+                sources = [('rs1', inst.rs1)]
+            else:
+                sources = [('rs1', inst.rs1), ('rs2', inst.rs2)]
+            # steps numbers the instructions each lane has run, this one included; written
+            # holds the number of the last write to each register, so 1 is back to back
+            steps += active
+            for operand, reg in sources:
+                if reg:
+                    distance = steps - written[reg]
+                    for d in (1, 2, 3):
+                        self.hit(('raw', operand, d), distance == d)
+
+            if op in BRANCH_OPS:
+                b = regs[inst.rs2]
+                self.compare(op, a, b)
+                taken = {
+                    'beq': a == b,
+                    'bne': a != b,
+                    'blt': signed_a < b.view(np.int32),
+                    'bge': signed_a >= b.view(np.int32),
+                    'bltu': a < b,
+                    'bgeu': a >= b,
+                }[op]
+                self.hit(('op', op), active)
+                self.hit(('taken', op, False), ~taken)
+                self.hit(('taken', op, True), taken)
+                pc = np.where(active, np.where(taken, inst.imm, i + 1), pc)
+                continue
+
+            if op in U_OPS:
+                value = np.uint32((inst.imm << 12) & 0xffffffff)
+                if op == 'auipc':
+                    value = np.uint32((BODY_ADDRESS + 4 * i + (inst.imm << 12)) & 0xffffffff)
+                result = np.full(lanes, value, dtype=np.uint32)
+                kind = 'u'
+            else:
+                if op in R_OPS:
+                    b = regs[inst.rs2]
+                    kind = 'r'
+                else:
+                    b = np.full(lanes, inst.imm & 0xffffffff, dtype=np.uint32)
+                    kind = 'i'
+                result = self.alu(BASE_OP.get(op, op), op, a, b)
+
+            self.hit(('op', op), active)
+            if inst.rd == 0:
+                self.hit(('x0', kind), active)
+            else:
+                regs[inst.rd] = np.where(active, result, regs[inst.rd])
+                written[inst.rd] = np.where(active, steps, written[inst.rd])
+            pc = np.where(active, i + 1, pc)
+        return self.coverage
+
+    def alu(self, base, op, a, b):
+        signed_a = a.view(np.int32)
+        signed_b = b.view(np.int32)
+        if base in ('sll', 'srl', 'sra'):
+            amount = b & 31
+            self.hit(('shamt', op, 0), amount == 0)
+            self.hit(('shamt', op, 31), amount == 31)
+            self.hit(('shamt', op, 'other'), (amount != 0) & (amount != 31))
+            if op in R_OPS:
+                self.hit(('shamt', op, 'over 31'), b > 31)
+        if base in ('slt', 'sltu'):
+            self.compare(op, a, b)
+        if base == 'add':
+            result = a + b
+            self.hit(('overflow', op),
+                     ((signed_a >= 0) == (signed_b >= 0)) & ((result.view(np.int32) >= 0) !=
+                                                             (signed_a >= 0)))
+            return result
+        if base == 'sub':
+            result = a - b
+            self.hit(('overflow', op),
+                     ((signed_a >= 0) != (signed_b >= 0)) & ((result.view(np.int32) >= 0) !=
+                                                             (signed_a >= 0)))
+            return result
+        if base == 'sll':
+            return a << (b & 31)
+        if base == 'srl':
+            return a >> (b & 31)
+        if base == 'sra':
+            return (signed_a >> (b & 31).astype(np.int32)).view(np.uint32)
+        if base == 'slt':
+            return (signed_a < signed_b).astype(np.uint32)
+        if base == 'sltu':
+            return (a < b).astype(np.uint32)
+        if base == 'xor':
+            return a ^ b
+        if base == 'or':
+            return a | b
+        if base == 'and':
+            return a & b
+        raise ValueError(op)
+
+    def compare(self, op, a, b):
+        negative_a = a.view(np.int32) < 0
+        negative_b = b.view(np.int32) < 0
+        for neg1 in (False, True):
+            for neg2 in (False, True):
+                self.hit(('signs', op, neg1, neg2),
+                         (negative_a == neg1) & (negative_b == neg2))
+        self.hit(('equal', op), a == b)
+
+    def hit(self, point, lanes):
+        lanes = lanes & self.active
+        if point not in self.coverage and lanes.any():
+            self.coverage[point] = int(lanes.argmax())
+
+
+def select_lanes(coverage, covered, limit):
+    """Lanes reaching points not yet covered, the ones reaching most first."""
+    new = {}
+    for point, lane in coverage.items():
+        if point not in covered:
+            new.setdefault(lane, []).append(point)
+    return sorted(new.items(), key=lambda item: -len(item[1]))[:limit]
+
+
+def check_rtl(session, text, max_cycles):
+    """Run text on the session's core, return (registers, result) after it exits."""
+    cpu = session.cpu
+    result = {}
+
+    def process():
+        yield from run_to_exit(cpu, result, max_cycles)
+        regs = []
+        for i in range(32):
+            regs.append((yield cpu.regs.mem[i]))
+        return regs
+
+    return session.run(assemble(text), process), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fuzz the decoder, ALU and branch unit with random RV32I programs.')
+    parser.add_argument('--programs', type=int, default=200, help='programs to generate')
+    parser.add_argument('--length', type=int, default=48, help='instructions per program')
+    parser.add_argument('--lanes', type=int, default=4096,
+                        help='register states each program runs from in the model')
+    parser.add_argument('--lanes-per-program', type=int, default=4,
+                        help='most lanes of one program run on the RTL')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--core', choices=sorted(CORES), default=os.environ.get('core', 'fsm'))
+    parser.add_argument('--bpred', action='store_true', default=os.environ.get('bpred') == '1')
+    parser.add_argument('--fusion', action='store_true', default=os.environ.get('fusion') == '1')
+    parser.add_argument('--max-cycles', type=int, default=10_000,
+                        help='cycle budget per RTL run')
+    parser.add_argument('--out', metavar='DIR', default='fuzz-failures',
+                        help='where mismatching programs are written as .S files')
+    args = parser.parse_args(argv)
+
+    seed = args.seed if args.seed is not None else int(time.time())
+    rng = np.random.default_rng(seed)
+    print(f'seed {seed}')
+    points = coverage_points()
+    covered = set()
+    core = 'pipeline' if args.bpred else args.core
+    session = Session(make_cpu([0] * 2048, core, args.bpred, fusion=args.fusion))
+    model = Model()
+    model_time = rtl_time = 0.0
+    rtl_runs = 0
+    mismatches = 0
+    for n in range(args.programs):
+        program = generate(rng, args.length)
+        initial = random_registers(rng, args.lanes)
+        regs = initial.copy()
+        start = time.time()
+        coverage = model.run(program, regs)
+        model_time += time.time() - start
+
+        for lane, new in select_lanes(coverage, covered, args.lanes_per_program):
+            text = source(program, initial[:, lane])
+            start = time.time()
+            actual, result = check_rtl(session, text, args.max_cycles)
+            rtl_time += time.time() - start
+            rtl_runs += 1
+            expected = [int(value) for value in regs[:, lane]]
+            if result['reason'] == Exit.BUDGET or actual != expected:
+                mismatches += 1
+                os.makedirs(args.out, exist_ok=True)
+                path = os.path.join(args.out, f'fuzz_{seed}_{n}_{lane}.S')
+                with open(path, 'w') as f:
+                    f.write(text)
+                diffs = [f'x{reg}={actual[reg]:#x} expected {expected[reg]:#x}'
+                         for reg in range(32) if actual[reg] != expected[reg]]
+                print(f'MISMATCH program {n} lane {lane}, written to {path}: ' +
+                      (', '.join(diffs) if result['reason'] != Exit.BUDGET else
+                       f'no exit after {args.max_cycles} cycles'))
+            else:
+                covered.update(new)
+                print(f'program {n} lane {lane}: {len(new)} new points, '
+                      f'{len(covered)}/{len(points)} covered')
+
+    lane_insts = args.programs * args.lanes * args.length
+    print(f'{args.programs} programs x {args.lanes} lanes in {model_time:.2f}s '
+          f'({lane_insts / max(model_time, 1e-9) / 1e6:.1f}M instructions/s), '
+          f'{rtl_runs} RTL runs in {rtl_time:.2f}s')
+    missing = [point for point in points if point not in covered]
+    print(f'coverage {len(points) - len(missing)}/{len(points)}' +
+          (', not covered: ' + ' '.join(str(point) for point in missing) if missing else ''))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import os
+import re
+from collections import defaultdict
+from core.csr import HpmEvent
+from core.decoder import IType
+from core.iss import itype
+
+
+ITYPE_NAMES = {
+    IType.ALU: 'ALU',
+    IType.BR:  'BR',
+    IType.J:   'J',
+    IType.JR:  'JR',
+    IType.LD:  'LD',
+    IType.ST:  'ST',
+    IType.CSR: 'CSR',
+    IType.MULDIV: 'MULDIV',
+}
+
+STALLS = {
+    'fetch': HpmEvent.FETCH_STALL,
+    'mem': HpmEvent.MEM_WAIT,
+    'load_use': HpmEvent.LOAD_USE,
+    'muldiv': HpmEvent.MULDIV_WAIT,
+}
+
+DUMP_DIR = os.path.join(os.path.dirname(__file__), '..', 'programs', 'build', 'assembly', 'dump')
+
+DUMP_LINE = re.compile(r'^\s*([0-9a-f]+):\s+([0-9a-f]{8})\s')
+
+
+class Stats:
+    def __init__(self):
+        self.count = 0
+        self.cycles = 0
+        self.stalls = dict.fromkeys(list(STALLS) + ['other'], 0)
+
+    def add(self, cycles, stalls):
+        self.count += 1
+        self.cycles += cycles
+        explained = 0
+        for name, value in stalls.items():
+            self.stalls[name] += value
+            explained += value
+        self.stalls['other'] += max(0, cycles - 1 - explained)
+
+    @property
+    def cpi(self):
+        return self.cycles / self.count if self.count else 0.0
+
+
+class Profiler:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.pcs = defaultdict(Stats)
+        self.itypes = defaultdict(Stats)
+        self.insts = {}
+        self.cycles = 0
+        # cycles without a commit are charged to the next instruction that commits
+        self.pending = 0
+        self.pending_stalls = dict.fromkeys(STALLS, 0)
+
+    def sample(self):
+        cpu = self.cpu
+        self.cycles += 1
+        self.pending += 1
+        events = yield cpu.csr.events
+        for name, event in STALLS.items():
+            if events >> event & 1:
+                self.pending_stalls[name] += 1
+        if not (yield cpu.valid):
+            return
+        pc = yield cpu.pc
+        inst = yield cpu.instruction
+        if getattr(cpu, 'fusion', None) is not None and (yield cpu.fused):
+            # a fused pair: the second instruction gets the cycle the pair executes in,
+            # the first the cycles before it
+            tail = yield cpu.fusion.tail
+            self.book(pc, inst, self.pending - 1, self.pending_stalls)
+            self.book(pc + 4, tail, 1, dict.fromkeys(STALLS, 0))
+        else:
+            self.book(pc, inst, self.pending, self.pending_stalls)
+        self.pending = 0
+        self.pending_stalls = dict.fromkeys(STALLS, 0)
+
+    def book(self, pc, inst, cycles, stalls):
+        self.insts[pc] = inst
+        self.pcs[pc].add(cycles, stalls)
+        self.itypes[itype(inst)].add(cycles, stalls)
+
+    def report(self, top=10):
+        committed = sum(stats.count for stats in self.itypes.values())
+        lines = [f'{self.cycles} cycles, {committed} instructions, '
+                 f'CPI {self.cycles / max(1, committed):.2f}',
+                 '',
+                 f"{'class':6s} {'count':>7s} {'cycles':>8s} {'CPI':>6s} " +
+                 ' '.join(f'{name:>9s}' for name in list(STALLS) + ['other'])]
+        for kind, stats in sorted(self.itypes.items()):
+            lines.append(f'{ITYPE_NAMES[kind]:6s} {stats.count:7d} {stats.cycles:8d} '
+                         f'{stats.cpi:6.2f} ' +
+                         ' '.join(f'{value:9d}' for value in stats.stalls.values()))
+        lines += ['', f"{'pc':>8s} {'inst':>8s} {'count':>7s} {'cycles':>8s} {'CPI':>6s}"]
+        hottest = sorted(self.pcs.items(), key=lambda item: item[1].cycles, reverse=True)
+        for pc, stats in hottest[:top]:
+            lines.append(f'{pc:8x} {self.insts[pc]:08x} {stats.count:7d} {stats.cycles:8d} '
+                         f'{stats.cpi:6.2f}')
+        return '\n'.join(lines)
+
+    def annotate(self, dump_lines):
+        # prefixes the instructions of an objdump listing with their count and cycles
+        out = []
+        for line in dump_lines:
+            line = line.rstrip('\n')
+            match = DUMP_LINE.match(line)
+            if match and int(match.group(1), 16) in self.pcs:
+                stats = self.pcs[int(match.group(1), 16)]
+                out.append(f'{stats.count:7d} {stats.cycles:8d} | {line}')
+            else:
+                out.append(f"{'':7s} {'':8s} | {line}")
+        return '\n'.join(out)
+
+    def listing(self):
+        # without a dump, one line per committed PC
+        return '\n'.join(f'{stats.count:7d} {stats.cycles:8d} | {pc:8x}:\t{self.insts[pc]:08x}'
+                         for pc, stats in sorted(self.pcs.items()))
+
+
+def write_profile(profiler, name, directory, dump_dir=DUMP_DIR):
+    # <directory>/<name>.prof: the report, then the objdump listing annotated with
+    # count and cycles when programs/build/assembly/dump has it
+    os.makedirs(directory, exist_ok=True)
+    dump = os.path.join(dump_dir, f'{name}.riscv.dump')
+    if os.path.isfile(dump):
+        with open(dump) as f:
+            listing = profiler.annotate(f)
+    else:
+        listing = profiler.listing()
+    path = os.path.join(directory, f'{name}.prof')
+    with open(path, 'w') as f:
+        f.write(profiler.report(top=20) + '\n\n' + listing + '\n')
+    return path
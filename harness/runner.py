@@ -0,0 +1,402 @@
+import argparse
+import glob
+import json
+import os
+import re
+import signal
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from nmigen.sim import *
+from core.cache import DataCache
+from core.cpu import CPU
+from core.csr import HpmEvent
+from core.fetch import FetchBuffer
+from core.memory import SparseMemory
+from core.muldiv import MulDiv
+from core.pipeline import PipelinedCPU
+from core.predictor import BranchPredictor
+from core.soc import SoC
+from harness.asm import load_program
+from harness.cosim import Cosim, Divergence
+from harness.profile import Profiler, write_profile
+from harness.session import Exit, Session, run_to_exit
+from harness.trace import Trace
+
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', 'programs', 'assembly', 'src')
+
+CORES = {
+    'fsm': CPU,
+    'pipeline': PipelinedCPU,
+}
+
+
+class TestTimeout(Exception):
+    pass
+
+
+RESET_ADDRESS = 0x200
+RAM_SIZE = 1 << 20
+
+
+def make_cpu(data, core='fsm', bpred=False, dcache=False, ifetch=False, ram_size=RAM_SIZE,
+             rom_wait_states=0, ram_wait_states=0, muldiv='single', compressed=False, harts=1,
+             shared_rom=True, reset_address=RESET_ADDRESS, fusion=False):
+    if bpred and core != 'pipeline':
+        raise ValueError('the branch predictor is only supported by the pipelined core')
+    if compressed and (core != 'fsm' or bpred):
+        raise ValueError('compressed instructions are only supported by the fsm core')
+    if fusion and (core != 'fsm' or bpred or compressed):
+        raise ValueError('fusion is only supported by the fsm core without compressed '
+                         'instructions')
+    if ifetch and (core != 'fsm' or bpred):
+        raise ValueError('the fetch buffer is only supported by the fsm core without a branch '
+                         'predictor')
+    if harts > 1 and (core != 'fsm' or bpred or dcache or ifetch or compressed or fusion):
+        raise ValueError('the harts of an SoC are plain fsm cores')
+    cache = DataCache() if dcache else None
+    ram = SparseMemory(ram_size, wait_states=ram_wait_states, shared=harts > 1)
+    if harts > 1:
+        return SoC(harts, reset_address=reset_address, data=data, shared_rom=shared_rom,
+                   ram=ram, rom_wait_states=rom_wait_states,
+                   iterative_muldiv=muldiv == 'iterative')
+    unit = MulDiv(iterative=muldiv == 'iterative')
+    if bpred:
+        return PipelinedCPU(reset_address=reset_address, data=data, predictor=BranchPredictor(),
+                            dcache=cache, ram=ram, rom_wait_states=rom_wait_states, muldiv=unit)
+    if ifetch:
+        return CPU(reset_address=reset_address, data=data, dcache=cache, ifetch=FetchBuffer(),
+                   ram=ram, rom_wait_states=rom_wait_states, muldiv=unit, compressed=compressed,
+                   fusion=fusion)
+    if compressed or fusion:
+        return CPU(reset_address=reset_address, data=data, dcache=cache, ram=ram,
+                   rom_wait_states=rom_wait_states, muldiv=unit, compressed=compressed,
+                   fusion=fusion)
+    return CORES[core](reset_address=reset_address, data=data, dcache=cache, ram=ram,
+                       rom_wait_states=rom_wait_states, muldiv=unit)
+
+
+def run_test(cpu, result, max_cycles, monitors=()):
+    yield from run_to_exit(cpu, result, max_cycles, monitors)
+    result['testnum'] = result['exit_code']
+    result['passed'] = result['exit_code'] == 0
+    if result['reason'] == Exit.BUDGET:
+        result['error'] = f'no exit after {max_cycles} cycles'
+    result['counters'] = yield from read_counters(cpu)
+
+
+def read_counters(cpu):
+    counters = {}
+    units = [
+        (getattr(cpu, 'predictor', None), ('predictions', 'mispredictions')),
+        (getattr(cpu, 'dcache', None), ('hits', 'misses', 'writebacks')),
+        (getattr(cpu, 'ifetch', None), ('fetch_stalls', 'flushes')),
+    ]
+    for unit, names in units:
+        if unit is not None:
+            for name in names:
+                counters[name] = yield getattr(unit, name)
+    if getattr(cpu, 'fusion', None) is not None:
+        counters['fusions'] = yield cpu.csr.hpmcounters[HpmEvent.FUSED]
+    for i, hart in enumerate(getattr(cpu, 'harts', ())):
+        counters[f'hart{i}_retired'] = yield hart.csr.instret
+        counters[f'hart{i}_arb_stalls'] = yield cpu.arb_stalls[i]
+    return counters
+
+
+# worker state, one elaborated design per process
+
+_options = None
+_session = None
+
+
+def _on_alarm(signum, frame):
+    raise TestTimeout()
+
+
+def _init_worker(options):
+    global _options
+    _options = options
+    signal.signal(signal.SIGALRM, _on_alarm)
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        cpu = make_cpu([0] * _options['rom_words'], _options['core'], _options['bpred'],
+                       _options['dcache'], _options['ifetch'], _options['ram_size'],
+                       _options['rom_wait_states'], _options['ram_wait_states'],
+                       _options['muldiv'], _options['compressed'], _options['harts'],
+                       _options['shared_rom'], fusion=_options['fusion'])
+        _session = Session(cpu)
+    return _session
+
+
+def _run_test(path):
+    global _session
+    name = os.path.splitext(os.path.basename(path))[0]
+    result = {'name': name, 'passed': False, 'testnum': None, 'reason': None, 'retired': 0,
+              'cycles': 0, 'counters': {}, 'time': 0.0, 'error': None}
+    session = _get_session()
+    cpu = session.cpu
+    trace = None
+    start = time.time()
+    signal.setitimer(signal.ITIMER_REAL, _options['timeout'])
+    try:
+        image = load_program(path)
+        if image.entry not in (None, RESET_ADDRESS):
+            raise ValueError(f'entry point {image.entry:#x}, the cores reset to {RESET_ADDRESS:#x}')
+        if _options['cosim']:
+            cosim = Cosim(cpu, image, reset_address=RESET_ADDRESS)
+            try:
+                halted = cosim.run(_options['max_cycles'], session=session)
+                result['testnum'] = cosim.iss.exit_code
+                result['passed'] = halted and cosim.iss.exit_code == 0
+                result['reason'] = Exit.TOHOST if halted else Exit.BUDGET
+                if not halted:
+                    result['error'] = f"no exit after {_options['max_cycles']} cycles"
+            except Divergence as divergence:
+                result['error'] = divergence.report()
+            result['retired'] = cosim.retired
+            result['cycles'] = cosim.cycles
+        else:
+            monitors = []
+            if _options['profile']:
+                profiler = Profiler(cpu)
+                monitors.append(profiler.sample)
+            if _options['trace']:
+                # the last trace_depth cycles, written out if the test fails
+                trace = Trace(cpu, depth=_options['trace_depth'])
+                monitors.append(trace.sample)
+
+            def process():
+                yield from run_test(cpu, result, _options['max_cycles'], monitors)
+
+            session.run(image, process)
+            if _options['profile']:
+                write_profile(profiler, name, _options['profile'])
+    except TestTimeout:
+        # the interrupted simulator cannot be resumed, build a new one
+        _session = None
+        result['error'] = f"timeout after {_options['timeout']}s"
+    except Exception as e:
+        _session = None
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if trace is not None and not result['passed']:
+        os.makedirs(_options['trace'], exist_ok=True)
+        trace.write_vcd(os.path.join(_options['trace'], f'{name}.vcd'))
+    if result['passed']:
+        result['testnum'] = None
+    result['time'] = round(time.time() - start, 3)
+    return result
+
+
+def find_tests(names, src_dir=SRC_DIR):
+    # names are sources in src_dir, assembled as they run, or .S/.riscv files
+    if not names:
+        return sorted(glob.glob(os.path.join(src_dir, '*.S')))
+    return [name if os.sep in name or name.endswith(('.riscv', '.S'))
+            else os.path.join(src_dir, f'{name}.S') for name in names]
+
+
+def required_extensions(path):
+    # the extensions beyond RV32I a test's source uses, a .riscv file is taken to need none
+    if not path.endswith('.S'):
+        return set()
+    with open(path) as f:
+        source = f.read()
+    required = set()
+    if re.search(r'^\s*\.option\s+rvc\b', source, re.M):
+        required.add('C')
+    if re.search(r'^\s*(?:\w+:\s*)?(?:amo\w+|lr|sc)\.w\b', source, re.M):
+        required.add('A')
+    return required
+
+
+def extensions(options):
+    """The extensions beyond RV32I the configured core implements."""
+    return {'M', 'A'} | ({'C'} if options['compressed'] else set())
+
+
+def find_skipped(paths, options):
+    """{test name: missing extensions} of the paths the configured core cannot run."""
+    have = extensions(options)
+    skipped = {}
+    for path in paths:
+        missing = required_extensions(path) - have
+        if missing:
+            skipped[os.path.splitext(os.path.basename(path))[0]] = ''.join(sorted(missing))
+    return skipped
+
+
+def run(paths, options, jobs=None):
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=_init_worker,
+                             initargs=(options,)) as pool:
+        futures = [pool.submit(_run_test, path) for path in paths]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = 'PASSED' if result['passed'] else 'FAILED'
+            print(f"{result['name']:16s} {status} retired={result['retired']} "
+                  f"cycles={result['cycles']} time={result['time']:.2f}s"
+                  + ''.join(f' {name}={value}' for name, value in result['counters'].items())
+                  + (f" testnum={result['testnum']}" if result['testnum'] else '')
+                  + (f" ({result['error'].splitlines()[0]})" if result['error'] else ''))
+    return sorted(results, key=lambda result: result['name'])
+
+
+def write_json(path, results, options, skipped=None):
+    with open(path, 'w') as f:
+        json.dump({'options': options, 'tests': results, 'skipped': skipped or {}}, f,
+                  indent=2)
+
+
+def write_junit(path, results, skipped=None):
+    skipped = skipped or {}
+    suite = ET.Element('testsuite', name='riscv-assembly',
+                       tests=str(len(results) + len(skipped)),
+                       failures=str(sum(not r['passed'] and not r['error'] for r in results)),
+                       errors=str(sum(bool(r['error']) for r in results)),
+                       skipped=str(len(skipped)),
+                       time=f"{sum(r['time'] for r in results):.3f}")
+    for name, missing in sorted(skipped.items()):
+        case = ET.SubElement(suite, 'testcase', classname='assembly', name=name, time='0.000')
+        ET.SubElement(case, 'skipped', message=f'needs {missing}')
+    for result in results:
+        case = ET.SubElement(suite, 'testcase', classname='assembly', name=result['name'],
+                             time=f"{result['time']:.3f}")
+        if result['error']:
+            ET.SubElement(case, 'error', message=result['error'].splitlines()[0]).text = \
+                result['error']
+        elif not result['passed']:
+            ET.SubElement(case, 'failure', message=f"TESTNUM {result['testnum']}")
+        ET.SubElement(case, 'system-out').text = \
+            f"retired={result['retired']} cycles={result['cycles']}"
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def add_options(parser, env=os.environ):
+    """Add the options that configure the core and the runs, defaults from env."""
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes, default: one per core')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds per test')
+    parser.add_argument('--max-cycles', type=int, default=int(env.get('max_cycles', 100_000)),
+                        help='cycle budget per test')
+    parser.add_argument('--core', choices=sorted(CORES), default=env.get('core', 'fsm'))
+    parser.add_argument('--bpred', action='store_true', default=env.get('bpred') == '1',
+                        help='branch predictor in front of fetch, implies --core pipeline')
+    parser.add_argument('--dcache', action='store_true', default=env.get('dcache') == '1')
+    parser.add_argument('--ifetch', action='store_true', default=env.get('ifetch') == '1')
+    parser.add_argument('--cosim', action='store_true', default=env.get('cosim') == '1')
+    parser.add_argument('--rom-words', type=int, default=int(env.get('rom_words', 2048)))
+    parser.add_argument('--ram-size', type=lambda text: int(text, 0),
+                        default=int(env.get('ram_size', str(RAM_SIZE)), 0),
+                        help='bytes of RAM at address 0 on the data side, a power of two')
+    parser.add_argument('--rom-wait-states', type=int,
+                        default=int(env.get('rom_wait_states', 0)),
+                        help='extra cycles per ROM access')
+    parser.add_argument('--ram-wait-states', type=int,
+                        default=int(env.get('ram_wait_states', 0)),
+                        help='extra cycles per RAM access, bursts pay them once')
+    parser.add_argument('--muldiv', choices=['single', 'iterative'],
+                        default=env.get('muldiv', 'single'),
+                        help='RV32M unit: combinational or one bit per cycle')
+    parser.add_argument('--compressed', action='store_true',
+                        default=env.get('compressed') == '1',
+                        help='RV32C fetch on the fsm core')
+    parser.add_argument('--fusion', action='store_true', default=env.get('fusion') == '1',
+                        help='fuse lui/auipc with the addi or jalr after them on the fsm core')
+    parser.add_argument('--harts', type=int, default=int(env.get('harts', 1)),
+                        help='fsm cores sharing the RAM, more than one builds a core.SoC')
+    parser.add_argument('--private-rom', action='store_true',
+                        default=env.get('private_rom') == '1',
+                        help='a ROM per hart instead of one shared through the arbiter')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write a per-PC cycle profile of each test to DIR/<test>.prof')
+    parser.add_argument('--trace', metavar='DIR',
+                        help='write the last cycles of each failing test to DIR/<test>.vcd')
+    parser.add_argument('--trace-depth', type=int, default=1000,
+                        help='cycles kept for --trace')
+
+
+def get_options(parser, args):
+    """Check the options added by add_options and return them as the workers' dict."""
+    if args.bpred:
+        # the predictor is part of the pipelined core, reports and baselines name it
+        args.core = 'pipeline'
+    if args.compressed and (args.core != 'fsm' or args.bpred):
+        parser.error('--compressed needs the fsm core')
+    if args.fusion and (args.core != 'fsm' or args.bpred or args.compressed):
+        parser.error('--fusion needs the fsm core without --compressed')
+    if args.ifetch and (args.core != 'fsm' or args.bpred):
+        parser.error('--ifetch needs the fsm core without --bpred')
+    if args.harts > 1 and (args.core != 'fsm' or args.bpred or args.dcache or args.ifetch or
+                           args.compressed or args.fusion or args.cosim or args.profile or
+                           args.trace):
+        parser.error('--harts runs plain fsm cores, without cosim, profile or trace')
+    return {
+        'core': args.core,
+        'bpred': args.bpred,
+        'dcache': args.dcache,
+        'ifetch': args.ifetch,
+        'cosim': args.cosim,
+        'rom_words': args.rom_words,
+        'ram_size': args.ram_size,
+        'rom_wait_states': args.rom_wait_states,
+        'ram_wait_states': args.ram_wait_states,
+        'muldiv': args.muldiv,
+        'compressed': args.compressed,
+        'fusion': args.fusion,
+        'harts': args.harts,
+        'shared_rom': not args.private_rom,
+        'timeout': args.timeout,
+        'max_cycles': args.max_cycles,
+        'profile': args.profile,
+        'trace': args.trace,
+        'trace_depth': args.trace_depth,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the assembly tests in parallel.')
+    parser.add_argument('tests', nargs='*',
+                        help='test names, .S sources or .riscv files, default: every source in '
+                        + SRC_DIR)
+    add_options(parser)
+    parser.add_argument('--json', help='write a JSON report')
+    parser.add_argument('--junit', help='write a JUnit XML report')
+    args = parser.parse_args(argv)
+    options = get_options(parser, args)
+
+    paths = find_tests(args.tests)
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing or not paths:
+        print(f"ERROR: {missing[0] if missing else SRC_DIR + '/*.S'} does not exist")
+        return 2
+
+    # tests for extensions the core lacks are skipped, not failed
+    skipped = find_skipped(paths, options)
+    for name, missing in sorted(skipped.items()):
+        print(f'{name:16s} SKIPPED (needs {missing})')
+    paths = [path for path in paths
+             if os.path.splitext(os.path.basename(path))[0] not in skipped]
+
+    results = run(paths, options, args.jobs) if paths else []
+    if args.json:
+        write_json(args.json, results, options, skipped)
+    if args.junit:
+        write_junit(args.junit, results, skipped)
+    failed = [result['name'] for result in results if not result['passed']]
+    print(f'{len(results) - len(failed)}/{len(results)} passed'
+          + (f", failed: {' '.join(failed)}" if failed else '')
+          + (f", skipped: {' '.join(sorted(skipped))}" if skipped else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+from nmigen import *
+from nmigen.sim import *
+from core.memory import SparseMemory
+
+
+class Session:
+    def __init__(self, cpu):
+        # cpu is built once with a fixed-size ROM, e.g. data=[0] * rom_words
+        self.cpu = cpu
+        self.rom_words = cpu.rom.mem.depth
+        self.rom_init = list(cpu.rom.mem.init) + [0] * (self.rom_words - len(cpu.rom.mem.init))
+        self.programs = 0
+
+        m = Module()
+        m.domains.sync = self.domain = ClockDomain("sync")
+        m.submodules.cpu = cpu
+        self.sim = Simulator(m)
+        self.sim.add_clock(1e-6)
+        add_models(self.sim, cpu)
+
+    def reset(self, image):
+        # a synchronous reset also returns every memory to its init contents, image is a
+        # harness.elf.Image: its code goes into the ROM, its data into the RAM
+        cpu = self.cpu
+        words = image.code().region(0, 4 * self.rom_words)
+        data = image.data()
+        yield self.domain.rst.eq(1)
+        yield Tick()
+        yield self.domain.rst.eq(0)
+        yield Settle()
+        # an SoC with a ROM per hart lists them in roms
+        for rom in getattr(cpu, 'roms', [cpu.rom]):
+            for addr, word in enumerate(words):
+                if word != self.rom_init[addr]:
+                    yield rom.mem[addr].eq(word)
+        if isinstance(cpu.ram, SparseMemory):
+            data.check(cpu.ram_base, cpu.ram.size)
+            cpu.ram.clear()
+            for segment in data.segments:
+                cpu.ram.load(segment.address - cpu.ram_base, segment.data)
+        else:
+            for addr, word in enumerate(data.region(cpu.ram_base, cpu.ram.size)):
+                if word:
+                    yield cpu.ram.mem[addr].eq(word)
+
+    def run(self, image, process):
+        # loads image and runs the generator function process on it, returning its result
+        result = []
+
+        def proc():
+            yield from self.reset(image)
+            result.append((yield from process()))
+
+        self.sim.add_sync_process(proc)
+        self.sim.run()
+        self.programs += 1
+        return result[0]
+
+
+def add_models(sim, cpu):
+    # parts of the design that only exist in simulation answer their buses from processes
+    if isinstance(cpu.ram, SparseMemory):
+        sim.add_sync_process(cpu.ram.process)
+
+
+class Exit:
+    TOHOST = 'tohost'
+    ECALL  = 'ecall'
+    BUDGET = 'budget'
+    RETIRED = 'retired'
+
+
+def run_to_exit(cpu, result, max_cycles=100_000, monitors=(), max_retired=None):
+    # steps until the program writes its exit code to mtohost (riscv_test.h: values
+    # below 0x10000, the others are console output) or executes ecall; max_cycles is
+    # the watchdog, monitors are generator functions sampling every settled cycle, and
+    # max_retired ends a window of that many instructions
+    result.update(reason=Exit.BUDGET, exit_code=None, cycles=0, retired=0, tohost=[])
+    # the FSM core with fusion retires two instructions in one commit
+    fused = cpu.fused if getattr(cpu, 'fusion', None) is not None else None
+    while result['cycles'] < max_cycles:
+        yield Tick()
+        yield Settle()
+        result['cycles'] += 1
+        for monitor in monitors:
+            yield from monitor()
+        if not (yield cpu.valid):
+            continue
+        result['retired'] += 1 + (yield fused) if fused is not None else 1
+        if (yield cpu.tohost_we):
+            value = yield cpu.tohost
+            if value >> 16 == 0:
+                result.update(reason=Exit.TOHOST, exit_code=value)
+                return
+            result['tohost'].append(value)
+        if (yield cpu.ecall):
+            result.update(reason=Exit.ECALL, exit_code=(yield cpu.regs.mem[28]))
+            return
+        if max_retired is not None and result['retired'] >= max_retired:
+            result['reason'] = Exit.RETIRED
+            return
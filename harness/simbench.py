@@ -0,0 +1,184 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+from collections import Counter
+from nmigen import *
+from nmigen.sim import *
+from harness.asm import load_program
+from harness.bench import BENCH_DIR
+from harness.runner import make_cpu
+from harness.session import Exit, add_models, run_to_exit
+
+
+CONFIGS = {
+    'fsm': {},
+    'pipeline': {'core': 'pipeline'},
+    'bpred': {'core': 'pipeline', 'bpred': True},
+    'ifetch': {'ifetch': True},
+    'dcache': {'dcache': True},
+    'fusion': {'fusion': True},
+}
+
+# settle: Tick and Settle every cycle and read valid/tohost_we, as run_to_exit does
+# tick: a Tick every cycle and nothing else
+# clock: no process at all, the simulator only runs the clock
+STYLES = ['settle', 'tick', 'clock']
+
+PERIOD = 1e-6
+
+
+def counted(process, commands):
+    # passes on what process yields, counting each kind of command
+    def wrapper():
+        gen = process()
+        value = None
+        try:
+            while True:
+                command = gen.send(value)
+                commands[type(command).__name__] += 1
+                value = yield command
+        except StopIteration as stop:
+            return stop.value
+    return wrapper
+
+
+def measure(image, config, style, cycles=None, max_cycles=100_000, rom_words=2048,
+            profile=None):
+    """Times one run of image, cycles is how many the tick and clock styles run."""
+    times = {}
+    start = time.perf_counter()
+    cpu = make_cpu(image.code().region(0, 4 * rom_words), **CONFIGS[config])
+    m = Module()
+    m.domains.sync = ClockDomain('sync')
+    m.submodules.cpu = cpu
+    fragment = Fragment.get(m, None)
+    times['elaborate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sim = Simulator(fragment)
+    sim.add_clock(PERIOD)
+    add_models(sim, cpu)
+    cpu.ram.clear()
+    for segment in image.data().segments:
+        cpu.ram.load(segment.address - cpu.ram_base, segment.data)
+    times['construct'] = time.perf_counter() - start
+
+    result = {'cycles': cycles, 'retired': None, 'reason': None}
+    commands = Counter()
+
+    def settle():
+        yield from run_to_exit(cpu, result, max_cycles)
+
+    def tick():
+        for _ in range(cycles):
+            yield Tick()
+
+    if style == 'settle':
+        sim.add_sync_process(counted(settle, commands))
+    elif style == 'tick':
+        sim.add_sync_process(counted(tick, commands))
+    start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    if style == 'clock':
+        sim.run_until(cycles * PERIOD, run_passive=True)
+    else:
+        sim.run()
+    if profile is not None:
+        profile.disable()
+    times['run'] = time.perf_counter() - start
+
+    if style == 'settle' and result['reason'] != Exit.TOHOST:
+        raise RuntimeError(f'{config}: no exit after {max_cycles} cycles')
+    return {
+        'config': config,
+        'style': style,
+        'cycles': result['cycles'],
+        'retired': result['retired'],
+        'times': {name: round(value, 4) for name, value in times.items()},
+        'cycles_per_second': round(result['cycles'] / times['run'], 1),
+        'commands_per_cycle': round(sum(commands.values()) / result['cycles'], 2),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Runs whose cycles per second dropped more than threshold percent from baseline."""
+    old = {(run['config'], run['style']): run for run in baseline.get('runs', [])}
+    slower = []
+    for run in results:
+        before = old.get((run['config'], run['style']))
+        if before is None:
+            continue
+        change = (run['cycles_per_second'] - before['cycles_per_second']) / \
+            before['cycles_per_second'] * 100
+        if change < -threshold:
+            slower.append(f"{run['config']}/{run['style']} {before['cycles_per_second']:.0f} "
+                          f"-> {run['cycles_per_second']:.0f} cycles/s ({change:+.1f}%)")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure how many cycles per second the simulation of each core runs.')
+    parser.add_argument('program', nargs='?', default=os.path.join(BENCH_DIR, 'crc32.S'),
+                        help='.S source or .riscv file to run, default: the crc32 benchmark')
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS),
+                        default=['fsm', 'pipeline', 'bpred'])
+    parser.add_argument('--styles', nargs='+', choices=STYLES, default=STYLES)
+    parser.add_argument('--max-cycles', type=int, default=100_000)
+    parser.add_argument('--profile', type=int, metavar='N',
+                        help="print the N functions the settle runs spend the most time in")
+    parser.add_argument('--json', help='write the results')
+    parser.add_argument('--baseline', help='results of an earlier --json to compare with')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='percent fewer cycles per second allowed against --baseline')
+    args = parser.parse_args(argv)
+
+    image = load_program(args.program)
+    profile = cProfile.Profile() if args.profile else None
+    results = []
+    print(f"{'config':10s} {'style':8s} {'cycles':>8s} {'elaborate':>10s} {'construct':>10s} "
+          f"{'run':>8s} {'cycles/s':>9s} {'insts/s':>9s} {'cmds/cycle':>10s}")
+    for config in args.configs:
+        # the settle run finds the cycle count the others run for
+        styles = sorted(args.styles, key=lambda style: style != 'settle')
+        cycles = retired = None
+        for style in styles:
+            if style != 'settle' and cycles is None:
+                first = measure(image, config, 'settle', max_cycles=args.max_cycles)
+                cycles, retired = first['cycles'], first['retired']
+            run = measure(image, config, style, cycles, args.max_cycles,
+                          profile=profile if style == 'settle' else None)
+            if style == 'settle':
+                cycles, retired = run['cycles'], run['retired']
+            run['retired'] = retired
+            run['instructions_per_second'] = round(retired / run['times']['run'], 1) \
+                if retired else None
+            results.append(run)
+            times = run['times']
+            print(f"{config:10s} {style:8s} {run['cycles']:8d} {times['elaborate']:9.2f}s "
+                  f"{times['construct']:9.2f}s {times['run']:7.2f}s "
+                  f"{run['cycles_per_second']:9.0f} {run['instructions_per_second'] or 0:9.0f} "
+                  f"{run['commands_per_cycle']:10.2f}")
+
+    if profile is not None:
+        pstats.Stats(profile).sort_stats('tottime').print_stats(args.profile)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'program': args.program, 'runs': results}, f, indent=2)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        for line in slower:
+            print('SLOWER: ' + line)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
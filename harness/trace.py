@@ -0,0 +1,110 @@
+from collections import deque
+from vcd import VCDWriter
+from vcd.gtkw import GTKWSave
+
+
+SIGNALS = (
+    'pc', 'instruction', 'valid',
+    'regs.rs1_addr', 'regs.rs1_data', 'regs.rs2_addr', 'regs.rs2_data',
+    'regs.rd_addr', 'regs.rd_data', 'regs.rd_we',
+    'dbus.cyc', 'dbus.stb', 'dbus.we', 'dbus.sel', 'dbus.adr', 'dbus.dat_w', 'dbus.dat_r',
+    'dbus.ack',
+)
+
+
+def resolve(cpu, path):
+    # 'regs.rd_data' -> cpu.regs.rd_data
+    obj = cpu
+    for name in path.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+# triggers are called with the cycle number and the sampled values by signal path
+
+def pc_range(start, end=None):
+    end = start + 4 if end is None else end
+    return lambda cycle, values: start <= values['pc'] < end
+
+
+def address(addr, write=None):
+    # a data bus access to the word holding addr, optionally only writes (True) or reads (False)
+    def trigger(cycle, values):
+        return (values['dbus.stb'] and values['dbus.adr'] >> 2 == addr >> 2
+                and (write is None or values['dbus.we'] == write))
+    return trigger
+
+
+def after(cycles):
+    return lambda cycle, values: cycle >= cycles
+
+
+class Trace:
+    """Records the chosen signals of cpu every cycle it is sampled.
+
+    Until start fires only the last depth cycles are kept, so the capture includes the
+    history leading up to it (without start this ring buffer is all that is kept, e.g. the
+    cycles before a failure). After start every cycle is kept until stop fires, plus post
+    more cycles, then sampling does nothing.
+    """
+
+    def __init__(self, cpu, signals=SIGNALS, depth=1000, start=None, stop=None, post=0):
+        self.cpu = cpu
+        self.names = list(signals)
+        self.signals = [resolve(cpu, name) for name in self.names]
+        self.start = start
+        self.stop = stop
+        self.post = post
+        self.cycle = 0
+        self.records = deque(maxlen=depth)
+        self.triggered = None
+        self.stopped = None
+
+    @property
+    def done(self):
+        return self.stopped is not None and self.cycle - self.stopped > self.post
+
+    def sample(self):
+        self.cycle += 1
+        if self.done:
+            return
+        values = []
+        for signal in self.signals:
+            values.append((yield signal))
+        self.records.append((self.cycle, values))
+        if self.start is None and self.stop is None:
+            return
+        sampled = dict(zip(self.names, values))
+        if self.triggered is None and self.start is not None:
+            if not self.start(self.cycle, sampled):
+                return
+            self.triggered = self.cycle
+            # from here on every cycle is kept
+            self.records = deque(self.records)
+        if self.stop is not None and self.stopped is None and self.stop(self.cycle, sampled):
+            self.stopped = self.cycle
+
+    def write_vcd(self, path, gtkw_path=None):
+        first = self.records[0][0] if self.records else 0
+        with open(path, 'w') as f:
+            with VCDWriter(f, timescale='1 us', init_timestamp=first) as writer:
+                variables = []
+                for name, signal in zip(self.names, self.signals):
+                    scope, _, var = ('cpu.' + name).rpartition('.')
+                    variables.append(writer.register_var(scope, var, 'wire', size=len(signal)))
+                previous = [None] * len(variables)
+                for cycle, values in self.records:
+                    for i, value in enumerate(values):
+                        if value != previous[i]:
+                            writer.change(variables[i], cycle, value)
+                            previous[i] = value
+        if gtkw_path is not None:
+            with open(gtkw_path, 'w') as f:
+                save = GTKWSave(f)
+                save.dumpfile(path)
+                for name, signal in zip(self.names, self.signals):
+                    if len(signal) > 1:
+                        save.trace(f'cpu.{name}', datafmt='hex')
+                    else:
+                        save.trace(f'cpu.{name}')
+        return path
@@ -3,8 +3,6 @@
 #ifndef _ENV_PHYSICAL_SINGLE_CORE_H
 #define _ENV_PHYSICAL_SINGLE_CORE_H
 
-#include "encoding.h"
-
 //-----------------------------------------------------------------------
 // Begin Macro
 //-----------------------------------------------------------------------
@@ -1,30 +1,50 @@
+import sys
+from nmigen import *
 from nmigen.sim import *
 from core.cpu import CPU
+from core.memory import SparseMemory
+from harness.asm import assemble
+from harness.session import add_models
+from harness.trace import Trace
+
+
+PROGRAM = '''
+    lui   x1, 0xdeadc
+    addi  x1, x1, -273
+    auipc x3, 0x80004
+    sw    x1, -8(x3)        # 0x4000
+    auipc x2, 0x80004
+    lw    x2, -16(x2)       # 0x4000
+    beq   x2, x1, 1f
+    ecall
+1:  addi  x0, x0, 0
+'''
 
 
 if __name__ == '__main__':
-    prog = [
-        0xdead_c0b7, # lui   x1, 0xdeadc
-        0xeef0_8093, # addi  x1, x1,-273
-        0x8000_4197, # auipc x3,0x80004
-        0xfe11_ac23, # sw    x1,-8(x3) # 0x4000
-        0x8000_4117, # auipc x2,0x80004
-        0xff01_2103, # lw    x2,-16(x2) # 0x4000
-        0x0011_0463, # beq   x2,x1,80000020
-        0x0000_0073, # ecall
-        0x0000_0013, # addi x0,x0,0      	
-    ]
+    code = assemble(PROGRAM, text_base=0x8000_0000).code()
+    prog = list(code.region(0x8000_0000, code.end - 0x8000_0000))
 
-    cpu = CPU(reset_address=0x8000_0000, data=prog)
-    sim = Simulator(cpu)
+    ram = SparseMemory(64 * 1024)
+    cpu = CPU(reset_address=0x8000_0000, data=prog, ram=ram)
+    # a RAM passed in is elaborated by its owner, here the top module
+    m = Module()
+    m.submodules.cpu = cpu
+    m.submodules.ram = ram
+    sim = Simulator(m)
+    add_models(sim, cpu)
+    # only the pc, instruction, register and data bus signals, --full dumps every signal
+    trace = Trace(cpu)
     def step():
         clock = 0
         yield Tick()
         yield Settle()
+        yield from trace.sample()
         while (yield cpu.valid) != 1 and clock < 5:
             clock += 1
             yield Tick()
             yield Settle()
+            yield from trace.sample()
         assert(clock < 8)
 
     def proc():
@@ -125,5 +145,9 @@ if __name__ == '__main__':
 
     sim.add_clock(1e-6, domain='sync')
     sim.add_sync_process(proc)
-    with sim.write_vcd("cpu.vcd", "cpu.gtkw"):
+    if '--full' in sys.argv:
+        with sim.write_vcd("cpu.vcd", "cpu.gtkw"):
+            sim.run()
+    else:
         sim.run()
+        trace.write_vcd("cpu.vcd", "cpu.gtkw")
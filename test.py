@@ -1,49 +1,153 @@
-from core.cpu import CPU
+from core.csr import HpmEvent
+from harness.asm import load_program
+from harness.cosim import Cosim, Divergence
+from harness.profile import Profiler, write_profile
+from harness.runner import RAM_SIZE, make_cpu as make_core
+from harness.session import Exit, Session, run_to_exit
+from harness.trace import Trace, address, pc_range
 import os
+import sys
 from nmigen.sim import *
 
 BIN_FILE = os.environ.get('mem_file')
+BPRED = os.environ.get('bpred') == '1'
+CORE = 'pipeline' if BPRED else os.environ.get('core', 'fsm')
+DCACHE = os.environ.get('dcache') == '1'
+IFETCH = os.environ.get('ifetch') == '1'
+COSIM = os.environ.get('cosim') == '1'
+ROM_WORDS = int(os.environ.get('rom_words', 2048))
+RAM_SIZE = int(os.environ.get('ram_size', str(RAM_SIZE)), 0)
+ROM_WAIT_STATES = int(os.environ.get('rom_wait_states', 0))
+RAM_WAIT_STATES = int(os.environ.get('ram_wait_states', 0))
+MULDIV = os.environ.get('muldiv', 'single')
+COMPRESSED = os.environ.get('compressed') == '1'
+FUSION = os.environ.get('fusion') == '1'
+HARTS = int(os.environ.get('harts', 1))
+SHARED_ROM = os.environ.get('private_rom') != '1'
+MAX_CYCLES = int(os.environ.get('max_cycles', 100_000))
+PROFILE = os.environ.get('profile') == '1'
+TRACE = os.environ.get('trace') == '1'
+TRACE_DEPTH = int(os.environ.get('trace_depth', 1000))
+TRACE_START_PC = os.environ.get('trace_start_pc')
+TRACE_STOP_PC = os.environ.get('trace_stop_pc')
+TRACE_ADDR = os.environ.get('trace_addr')
 
 
-def read_prog(path):
-    prog = []
-    with open(path, 'rb') as f:
-        while True:
-            b = f.read(4)
-            if b == b'':
-                break
-            i = int.from_bytes(b, byteorder='little', signed=False)
-            prog.append(i)
-    return prog
-
-prog = read_prog(BIN_FILE)
-cpu = CPU(reset_address=0x200, data=prog)
-sim = Simulator(cpu)
-
-def step():
-    clock = 0
-    yield Tick()
-    yield Settle()
-    while (yield cpu.valid) != 1 and clock < 5:
-        clock += 1
-        yield Tick()
-        yield Settle()
-    assert(clock < 8)
-
-def proc():
-    for _ in range(len(prog)):
-        yield from step()
-
-    res = yield cpu.regs.mem[28]
+def test_name(path):
+    return os.path.basename(path).split('.')[0]
+
+def make_trace(cpu):
+    # the last TRACE_DEPTH cycles, or from TRACE_DEPTH cycles before the start trigger
+    # to the stop trigger
+    start = stop = None
+    if TRACE_START_PC:
+        start = pc_range(int(TRACE_START_PC, 0))
+    elif TRACE_ADDR:
+        start = address(int(TRACE_ADDR, 0))
+    if TRACE_STOP_PC:
+        stop = pc_range(int(TRACE_STOP_PC, 0))
+    return Trace(cpu, depth=TRACE_DEPTH, start=start, stop=stop)
+
+def make_cpu(data):
+    return make_core(data, CORE, BPRED, DCACHE, IFETCH, RAM_SIZE, ROM_WAIT_STATES,
+                     RAM_WAIT_STATES, MULDIV, COMPRESSED, HARTS, SHARED_ROM, fusion=FUSION)
+
+def proc(cpu, name):
+    # runs until the program writes its exit code to mtohost, MAX_CYCLES is the watchdog
+    result = {}
+    profiler = Profiler(cpu)
+    trace = make_trace(cpu)
+    monitors = []
+    if PROFILE:
+        monitors.append(profiler.sample)
+    if TRACE:
+        monitors.append(trace.sample)
+    yield from run_to_exit(cpu, result, MAX_CYCLES, monitors)
+    res = result['exit_code']
     pc = yield cpu.pc
     print('-'*20, '\n')
     if res == 0:
         print('PASSED')
     else:
         print('FAILED')
+    if result['reason'] == Exit.BUDGET:
+        print(f'NO EXIT AFTER {MAX_CYCLES} CYCLES')
     print(f'PC AT: {hex(pc)}')
+    print(f"CYCLES: {result['cycles']} RETIRED: {result['retired']}")
+    if BPRED:
+        predictions = yield cpu.predictor.predictions
+        mispredictions = yield cpu.predictor.mispredictions
+        print(f'PREDICTIONS: {predictions} MISPREDICTIONS: {mispredictions}')
+    if DCACHE:
+        hits = yield cpu.dcache.hits
+        misses = yield cpu.dcache.misses
+        writebacks = yield cpu.dcache.writebacks
+        print(f'DCACHE HITS: {hits} MISSES: {misses} WRITEBACKS: {writebacks}')
+    if IFETCH:
+        fetch_stalls = yield cpu.ifetch.fetch_stalls
+        flushes = yield cpu.ifetch.flushes
+        print(f'FETCH STALLS: {fetch_stalls} FLUSHES: {flushes}')
+    if FUSION:
+        fusions = yield cpu.csr.hpmcounters[HpmEvent.FUSED]
+        print(f'FUSIONS: {fusions}')
+    for i, hart in enumerate(getattr(cpu, 'harts', ())):
+        retired = yield hart.csr.instret
+        arb_stalls = yield cpu.arb_stalls[i]
+        print(f'HART {i} RETIRED: {retired} ARBITRATION STALLS: {arb_stalls}')
+    if PROFILE:
+        print()
+        print(profiler.report())
+        print(f"LISTING: {write_profile(profiler, name, 'logs')}")
+    if TRACE:
+        os.makedirs('logs', exist_ok=True)
+        path = trace.write_vcd(f'logs/{name}.vcd', f'logs/{name}.gtkw')
+        print(f'TRACE: {path} ({len(trace.records)} cycles)')
+    print('\n', '-'*20)
+
+def run_cosim(cpu, image, session=None):
+    # compare every commit against core.ISS, stop at the first mismatch
+    cosim = Cosim(cpu, image, reset_address=0x200)
+    print('-'*20, '\n')
+    try:
+        halted = cosim.run(MAX_CYCLES, session=session)
+        if halted and cosim.iss.exit_code == 0:
+            print('PASSED')
+        else:
+            print('FAILED')
+    except Divergence as divergence:
+        print('FAILED')
+        print(divergence.report())
+    print(f'COMMITS: {cosim.retired} CYCLES: {cosim.cycles}')
     print('\n', '-'*20)
 
-sim.add_clock(1e-6)
-sim.add_sync_process(proc)
-sim.run()
\ No newline at end of file
+def run_single(path):
+    image = load_program(path)
+    code = image.code()
+    cpu = make_cpu(list(code.region(0, code.end + -code.end % 4)))
+    if COSIM:
+        run_cosim(cpu, image)
+    else:
+        def process():
+            yield from proc(cpu, test_name(path))
+
+        Session(cpu).run(image, process)
+
+def run_session(paths):
+    # one elaborated design, programs are reloaded between runs
+    cpu = make_cpu([0] * ROM_WORDS)
+    session = Session(cpu)
+    for path in paths:
+        print(f'-- benchmark test: {os.path.basename(path)} --')
+        image = load_program(path)
+        if COSIM:
+            run_cosim(cpu, image, session)
+        else:
+            def process():
+                yield from proc(cpu, test_name(path))
+
+            session.run(image, process)
+
+if len(sys.argv) > 1:
+    run_session(sys.argv[1:])
+else:
+    run_single(BIN_FILE)
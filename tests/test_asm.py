@@ -0,0 +1,193 @@
+import pytest
+from harness.asm import AsmError, assemble
+
+
+def error(source):
+    with pytest.raises(AsmError) as info:
+        assemble(source, name='prog.S')
+    return str(info.value)
+
+
+def test_line_after_include():
+    source = '\n'.join([
+        '#include "riscv_test.h"',
+        '#include "test_macros.h"',
+        '',
+        'RVTEST_RV32U',
+        'RVTEST_CODE_BEGIN',
+        '',
+        '    li x1, 1',
+        '    la x2, missing',
+        '',
+        'RVTEST_CODE_END',
+    ])
+    assert error(source).startswith("prog.S:8: undefined symbol 'missing'")
+
+
+def test_line_after_define():
+    source = '\n'.join([
+        '#define VALUE 1',
+        '',
+        '    li x1, VALUE',
+        '    nop',
+        '    .aling 2',
+    ])
+    assert error(source) == "prog.S:5: unknown directive '.aling'"
+
+
+def test_line_after_continuation_and_comment():
+    source = '\n'.join([
+        '#define PAIR(a, b) \\',
+        '    li a, 1; \\',
+        '    li b, 2',
+        '/* two',
+        '   lines */',
+        'PAIR(x1, x2)',
+        '    addi x1, x1, 4096',
+    ])
+    assert error(source) == 'prog.S:7: immediate 4096 out of range'
+
+
+def test_line_in_include(tmp_path):
+    (tmp_path / 'inc.h').write_text('    nop\n    .aling 2\n')
+    (tmp_path / 'prog.S').write_text('#include "inc.h"\n    nop\n')
+    with pytest.raises(AsmError) as info:
+        with open(tmp_path / 'prog.S') as f:
+            assemble(f.read(), include_dirs=[str(tmp_path)])
+    assert str(info.value).startswith(f"{tmp_path / 'inc.h'}:2: unknown directive")
+
+
+def words(source):
+    image = assemble(source)
+    code = bytes(image.segments[0].data)
+    return [int.from_bytes(code[i:i + 4], 'little') for i in range(0, len(code), 4)]
+
+
+def test_formats():
+    source = '''
+        add x1, x2, x3
+        addi x1, x2, -1
+        slli x1, x2, 3
+        srai x1, x2, 3
+        lw x5, 8(x6)
+        sw x5, 8(x6)
+        beq x1, x2, 3f
+    1:  lui x1, 0x12345
+    3:  bne x1, x2, 1b
+        auipc x1, 1
+        jal ra, 2f
+        ret
+        mul x1, x2, x3
+        csrr x1, mcycle
+        amoadd.w x1, x2, (x3)
+        ecall
+    2:  ebreak
+    '''
+    assert words(source) == [
+        0x003100b3,   # R
+        0xfff10093,   # I
+        0x00311093,
+        0x40315093,
+        0x00832283,   # load
+        0x00532423,   # S
+        0x00208463,   # B, forward
+        0x123450b7,   # U
+        0xfe209ee3,   # B, backward
+        0x00001097,
+        0x018000ef,   # J
+        0x00008067,   # jalr
+        0x023100b3,   # RV32M
+        0xb00020f3,   # Zicsr
+        0x0021a0af,   # RV32A
+        0x00000073,
+        0x00100073,
+    ]
+
+
+def test_compressed():
+    image = assemble('c.addi x1, 1\nc.nop')
+    assert bytes(image.segments[0].data) == bytes([0x85, 0x00, 0x01, 0x00])
+
+
+def test_li_la_sizes():
+    source = '''
+        .equ BIG, 0x12345678
+        li x1, 5
+        li x1, 0x12345000
+        li x1, BIG
+        li x1, 2048
+        la x1, 1f
+    1:  li x1, end
+    end:
+    '''
+    assert words(source) == [
+        0x00500093,                 # addi only
+        0x123450b7,                 # lui only
+        0x123450b7, 0x67808093,     # lui + addi, the constant is sized exactly
+        0x000010b7, 0x80008093,     # 2048 does not fit addi
+        0x00000097, 0x00808093,     # la: auipc + addi, pc relative
+        0x000000b7, 0x22808093,     # a label is not known when li is sized
+    ]
+
+
+def test_data_layout():
+    image = assemble('nop\n.data\n.word 0x12345678\n.half 0x9abc\n.byte 1, 2\n.bss\n.space 8')
+    text, data = image.segments
+    assert (text.address, text.size) == (0x200, 4)
+    assert (data.address, data.size) == (0x1000, 16)
+    assert bytes(data.data) == bytes([0x78, 0x56, 0x34, 0x12, 0xbc, 0x9a, 1, 2])
+
+
+def test_division_truncates():
+    assert words('li x1, -7/2\nli x2, -7%2\nli x3, 7/-2') == [
+        0xffd00093,   # addi x1, x0, -3
+        0xfff00113,   # addi x2, x0, -1
+        0xffd00193,   # addi x3, x0, -3
+    ]
+    assert error('li x1, 1/0') == 'prog.S:1: division by zero'
+
+
+def test_elif():
+    source = '\n'.join([
+        '#if 0',
+        '    li x1, 1',
+        '#elif 1',
+        '    li x1, 2',
+        '#elif 1',
+        '    li x1, 3',
+        '#else',
+        '    li x1, 4',
+        '#endif',
+        '#ifdef MISSING',
+        '#error not taken',
+        '#else',
+        '    li x2, 5',
+        '#endif',
+    ])
+    assert words(source) == [0x00200093, 0x00500113]
+
+
+def test_directive_errors(tmp_path):
+    assert error('    nop\n#error boom') == 'prog.S:2: #error boom'
+    assert error('#pragma once') == "prog.S:1: unknown directive '#pragma'"
+    assert error('#include "missing.h"') == 'prog.S:1: cannot find missing.h'
+    assert error('#else') == 'prog.S:1: #else without #if'
+    assert error('#if 1\n    nop') == 'prog.S:2: #if without #endif'
+    # '# text' is a comment, not a directive
+    assert words('# pragma in a comment\n    nop') == [0x00000013]
+
+
+def test_if_expressions():
+    def taken(condition):
+        source = f'#define ZERO 0\n#define TWO 2\n#if {condition}\nnop\n#endif'
+        return bool(assemble(source).segments)
+    assert not taken('ZERO')
+    assert taken('TWO')
+    assert taken('defined(TWO)') and taken('defined TWO')
+    assert not taken('defined(MISSING)') and not taken('MISSING')
+    assert taken('!defined(MISSING) && TWO == 2')
+    assert taken('!ZERO == 1')
+    assert not taken('TWO > 1 ? ZERO : 1')
+    assert taken('(1 << TWO) - 4 == 0 || 0')
+    assert taken('-7 / 2 == -3')
+    assert error('#if 1 +\n#endif') == "prog.S:1: bad #if expression '1 +'"
@@ -0,0 +1,18 @@
+import pytest
+from core.iss import ISSError
+from harness.asm import assemble
+from harness.cosim import Cosim, Divergence
+from harness.runner import make_cpu
+
+
+@pytest.mark.parametrize('core', ['fsm', 'pipeline'])
+def test_iss_error_is_a_divergence(core):
+    # the RTL retires the illegal word without a register write, the model rejects it
+    image = assemble('li x1, 1\n.word 0\nli x2, 2')
+    code = image.code()
+    cpu = make_cpu(list(code.region(0, code.end + -code.end % 4)), core)
+    with pytest.raises(Divergence) as info:
+        Cosim(cpu, image, reset_address=0x200).run(200)
+    assert info.value.retired == 2
+    assert isinstance(info.value.error, ISSError)
+    assert 'illegal' in info.value.report()
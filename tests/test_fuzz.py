@@ -0,0 +1,21 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from harness.fuzz import Inst, Model
+
+
+def raw_points(program):
+    regs = np.zeros((32, 1), dtype=np.uint32)
+    return {point for point in Model().run(program, regs) if point[0] == 'raw'}
+
+
+def test_raw_distance():
+    write = Inst('addi', 5, 0, 0, 1)
+    read = Inst('add', 6, 5, 0, 0)
+    other = Inst('addi', 7, 0, 0, 1)
+    assert raw_points([write, read]) == {('raw', 'rs1', 1)}
+    assert raw_points([write, other, read]) == {('raw', 'rs1', 2)}
+    assert raw_points([write, other, other, read]) == {('raw', 'rs1', 3)}
+    assert raw_points([write, other, other, other, read]) == set()
+    assert raw_points([write, Inst('sub', 6, 0, 5, 0)]) == {('raw', 'rs2', 1)}